@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+
+# The asyncio API is Python 3 only; it is checked on Python 3
+collect_ignore = ['flask_bitmapist/aio.py'] if sys.version_info[0] == 2 else []
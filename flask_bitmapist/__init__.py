@@ -7,19 +7,21 @@
     :license: MIT, see LICENSE for more details
 """
 
-from core import FlaskBitmapist
-from decorators import mark
-from utils import chain_events, get_cohort, get_event_data
+from .core import FlaskBitmapist
+from .decorators import mark
+from .retention import EXPIRED
+from .utils import (chain_events, get_cohort, get_event_counts, get_event_data,
+                    get_event_members, get_event_names, iter_cohort, mark_event, mark_events,
+                    unmark_event)
 
 try:
     import flask_login
-    from extensions.flask_login import mark_login, mark_logout
+    from .extensions.flask_login import mark_login, mark_logout
 except ImportError:
     pass
 
-from bitmapist import (mark_event, unmark_event,
-                       MonthEvents, WeekEvents, DayEvents, HourEvents,
-                       BitOpAnd, BitOpOr, get_event_names)
+from bitmapist import (MonthEvents, WeekEvents, DayEvents, HourEvents,
+                       BitOpAnd, BitOpOr)
 
 
 __version__ = '0.1.2'
@@ -28,4 +30,5 @@ __versionfull__ = __version__
 __all__ = ['FlaskBitmapist', 'mark', 'mark_event', 'unmark_event',
            'MonthEvents', 'WeekEvents', 'DayEvents', 'HourEvents',
            'BitOpAnd', 'BitOpOr', 'get_event_names',
-           'chain_events', 'get_cohort', 'get_event_data']
+           'chain_events', 'get_cohort', 'get_event_counts', 'get_event_data', 'iter_cohort',
+           'get_event_members', 'mark_events', 'EXPIRED']
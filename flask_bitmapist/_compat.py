@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist._compat
+    ~~~~~~~~~~~~~~~~~~~~~~~
+    Python 2/3 compatibility helpers.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import sys
+
+
+PY2 = sys.version_info[0] == 2
+
+if PY2:
+    import Queue as queue
+    from StringIO import StringIO
+    from __builtin__ import basestring as string_types
+    from urlparse import urlparse
+else:
+    import queue
+    from io import StringIO
+    from urllib.parse import urlparse
+
+    string_types = str
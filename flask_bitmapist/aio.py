@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.aio
+    ~~~~~~~~~~~~~~~~~~~
+    asyncio versions of the marking and query functions, for async views
+    (Flask 2, Quart). Requires Python 3.7+ and redis-py 4.2+.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import asyncio
+import contextvars
+import weakref
+from datetime import datetime
+from functools import wraps
+
+import redis.asyncio as aioredis
+from dateutil.relativedelta import relativedelta
+from flask import current_app, has_app_context
+
+import bitmapist as _bitmapist
+from bitmapist import DayEvents, MonthEvents, WeekEvents
+
+from . import retention as _retention, rollup as _rollup, utils as _utils
+from ._compat import string_types
+from .idmap import _normalize
+from .scripting import ASSIGN_IDS_SCRIPT
+from .tempkeys import TempKeys
+from .utils import _connection_options, _mark_commands
+
+
+_systems = {}
+
+# Async connections belong to the event loop that opened them, so each loop
+# gets its own pools; an app served by a single loop (e.g., Quart) shares one
+# pool per system between all of its requests
+_pools = weakref.WeakKeyDictionary()
+
+# Temporary keys `bitop` writes its results to in the current context
+_temp_keys = contextvars.ContextVar('bitmapist_temp_keys', default=None)
+
+
+def setup_redis(name, redis_url, **options):
+    """
+    Set up a Redis system for async use; takes the same URLs and options as
+    ``BITMAPIST_REDIS_URL`` and the ``BITMAPIST_REDIS_*`` settings.
+    """
+    _systems[name] = (redis_url, _connection_options(redis_url, **options))
+    for pools in _pools.values():
+        pools.pop(name, None)
+
+
+def get_redis(system='default'):
+    """
+    An async Redis client for a system, using the running event loop's shared
+    pool. Systems that were not set up with :func:`setup_redis` use the
+    current app's FlaskBitmapist configuration.
+    """
+    if system not in _systems:
+        ext = current_app.extensions.get('bitmapist') if has_app_context() else None
+        if ext is None or ext.redis_system != system:
+            raise KeyError("Redis system %r has not been set up" % system)
+        setup_redis(system, ext.redis_url, **ext.redis_options)
+
+    pools = _pools.setdefault(asyncio.get_running_loop(), {})
+    if system not in pools:
+        redis_url, options = _systems[system]
+        pools[system] = aioredis.ConnectionPool.from_url(redis_url, **options)
+    return aioredis.Redis(connection_pool=pools[system])
+
+
+class Events(object):
+    """
+    Events held in a single Redis key; unlike bitmapist's collections, every
+    query on them is a coroutine. With ``ID_MAP``, :meth:`includes` takes
+    external ids, as ``in`` does for the sync queries' results.
+    """
+
+    def __init__(self, redis_key, system='default'):
+        self.redis_key = redis_key
+        self.system = system
+
+    async def get_count(self):
+        return await get_redis(self.system).bitcount(self.redis_key)
+
+    async def has_events_marked(self):
+        return bool(await get_redis(self.system).exists(self.redis_key))
+
+    async def includes(self, uuid):
+        if _utils.ID_MAP is not None:
+            uuid = (await _lookup_ids([uuid], self.system))[0]
+            if uuid is None:
+                return False
+        return bool(await get_redis(self.system).getbit(self.redis_key, uuid))
+
+
+async def bitop(op_name, *events, system='default'):
+    """
+    Run ``BITOP`` over several events, with the result held in a temporary
+    key (see :mod:`flask_bitmapist.tempkeys`) of the current context's query,
+    or in one left to expire outside of a query.
+    """
+    temp_keys = _temp_keys.get() or TempKeys(system)
+    # Concurrent tasks may run the same operation, so results are not reused
+    redis_key = temp_keys.key()
+    async with get_redis(system).pipeline(transaction=False) as pipe:
+        pipe.bitop(op_name, redis_key, *[event.redis_key for event in events])
+        pipe.expire(redis_key, temp_keys.ttl)
+        await pipe.execute()
+    return Events(redis_key, system)
+
+
+async def _cleanup(temp_keys, keep=None):
+    """
+    Delete a query's temporary keys, except for ``keep``, which is left to
+    expire; see :meth:`TempKeys.cleanup`
+    """
+    if keep in temp_keys.keys:
+        temp_keys.keys.remove(keep)
+    if temp_keys.keys:
+        async with get_redis(temp_keys.system).pipeline(transaction=False) as pipe:
+            for key in temp_keys.keys:
+                pipe.strlen(key)
+            pipe.delete(*temp_keys.keys)
+            temp_keys.record((await pipe.execute())[:-1])
+
+
+# MARKING
+
+async def mark_events(marks, system='default', track_hourly=None):
+    """
+    Mark several ``(event_name, uuid, now)`` events in a single round-trip;
+    see :func:`flask_bitmapist.utils.mark_events`. The ``script`` mark engine
+    is not used here.
+    """
+    if not marks:
+        return
+
+    if track_hourly is None:
+        track_hourly = _bitmapist.TRACK_HOURLY
+
+    if _utils.ID_MAP is not None:
+        marks = await _map_marks(marks, system)
+
+    async with get_redis(system).pipeline(transaction=False) as pipe:
+        for command in _mark_commands(marks, track_hourly, system):
+            pipe.execute_command(*command)
+        await pipe.execute()
+
+
+async def _map_marks(marks, system):
+    "See :meth:`flask_bitmapist.idmap.IdMap.map_marks`"
+    id_map = _utils.ID_MAP
+    external_ids = [_normalize(uuid) for _, uuid, _ in marks]
+    ids, missing = id_map._cached(external_ids, system)
+    if missing:
+        script = get_redis(system).register_script(ASSIGN_IDS_SCRIPT)
+        assigned = await script(keys=id_map.keys, args=missing)
+        id_map._remember(assigned, missing, system)
+        ids.update(zip(missing, assigned))
+    return [(event_name, ids[external_id], now)
+            for (event_name, _, now), external_id in zip(marks, external_ids)]
+
+
+async def _lookup_ids(external_ids, system):
+    "See :meth:`flask_bitmapist.idmap.IdMap.lookup`"
+    id_map = _utils.ID_MAP
+    external_ids = [_normalize(external_id) for external_id in external_ids]
+    ids, missing = id_map._cached(external_ids, system)
+    if missing:
+        found = [None if id is None else int(id)
+                 for id in await get_redis(system).hmget(id_map.keys[0], missing)]
+        id_map._remember(found, missing, system)
+        ids.update(zip(missing, found))
+    return [ids[external_id] for external_id in external_ids]
+
+
+async def mark_event(event_name, uuid, system='default', now=None, track_hourly=None):
+    await mark_events([(event_name, uuid, now)], system, track_hourly)
+
+
+def _resolve(value):
+    return value() if callable(value) else value
+
+
+def mark(event_name, uuid, system='default', now=None, track_hourly=None,
+         when='before', condition=None):
+    """
+    Decorator for async views; takes the same arguments as
+    :func:`flask_bitmapist.decorators.mark`, except that ``when`` may only be
+    ``before`` or ``after``, and that when marking ``after`` the condition is
+    given the view's return value.
+    """
+    if when not in ('before', 'after'):
+        raise ValueError("when must be one of before, after")
+
+    event_names = [event_name] if isinstance(event_name, string_types) else list(event_name)
+
+    async def write():
+        uuid_value = _resolve(uuid)
+        if uuid_value is not None:
+            now_value = _resolve(now)
+            await mark_events([(name, uuid_value, now_value) for name in event_names],
+                              system, track_hourly)
+
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if when == 'before' and (condition is None or condition()):
+                await write()
+            rv = await fn(*args, **kwargs)
+            if when == 'after' and (condition is None or condition(rv)):
+                await write()
+            return rv
+        return wrapper
+    return decorator
+
+
+# QUERIES
+
+async def get_event_data(event_name, time_group='days', now=None, system='default'):
+    """
+    Get the data for a single event at a single point in time; see
+    :func:`flask_bitmapist.utils.get_event_data`.
+
+    :returns: :class:`Events`, or ``EXPIRED`` if the period is past its
+              retention
+    """
+    now = now or datetime.utcnow()
+
+    if _retention.is_expired(now, time_group):
+        return _retention.EXPIRED
+    elif _utils.ROLLUP_MODE and time_group in ('weeks', 'week', 'months', 'month'):
+        return await _rollup_events(event_name, now, time_group, system)
+    elif time_group in ('days', 'day'):
+        return Events(DayEvents(event_name, now.year, now.month, now.day).redis_key, system)
+    elif time_group in ('weeks', 'week'):
+        return Events(WeekEvents(event_name, now.year, now.isocalendar()[1]).redis_key, system)
+    elif time_group in ('months', 'month'):
+        return Events(MonthEvents(event_name, now.year, now.month).redis_key, system)
+    elif time_group in ('years', 'year'):
+        months = await asyncio.gather(*[
+            get_event_data(event_name, 'months', datetime(now.year, month, 1), system)
+            for month in range(1, 13)])
+        return await bitop('OR', *months, system=system)
+
+
+async def _rollup_events(event_name, date, time_group, system):
+    "See :func:`flask_bitmapist.rollup.get_events`"
+    rolled_up = _rollup.ROLLED_UP.get(system)
+    if rolled_up is None:
+        rolled_up = set(name.decode() if isinstance(name, bytes) else name
+                        for name in await get_redis(system).smembers(_rollup.PERIODS_KEY))
+        _rollup.ROLLED_UP.set(system, rolled_up)
+
+    key, day_keys = _rollup.resolve(event_name, date, time_group, rolled_up)
+    if day_keys is not None and _rollup.BUILT.get((system, key)) is None:
+        async with get_redis(system).pipeline(transaction=False) as pipe:
+            pipe.bitop('OR', key, *day_keys)
+            pipe.expire(key, _rollup.ROLLUP_TTL * 2)
+            await pipe.execute()
+        _rollup.BUILT.set((system, key), True, ttl=_rollup.ROLLUP_TTL)
+    return Events(key, system)
+
+
+async def chain_events(base_event_name, events_to_chain, now, time_group,
+                       system='default'):
+    """
+    Chain additional events with a base set of events; see
+    :func:`flask_bitmapist.utils.chain_events`. Outside of a query, the
+    intermediate keys are deleted before returning, and the result's is
+    left to expire after ``TEMP_KEY_TTL`` seconds.
+
+    :returns: :class:`Events`, or None if the base event has no events marked
+    """
+    if _temp_keys.get() is not None:
+        return await _chain_events(base_event_name, events_to_chain, now, time_group, system)
+
+    temp_keys = TempKeys(system)
+    token = _temp_keys.set(temp_keys)
+    result = None
+    try:
+        result = await _chain_events(base_event_name, events_to_chain, now, time_group, system)
+    finally:
+        _temp_keys.reset(token)
+        await _cleanup(temp_keys, keep=getattr(result, 'redis_key', None))
+    return result
+
+
+async def _chain_events(base_event_name, events_to_chain, now, time_group, system):
+    base_event = await get_event_data(base_event_name, time_group, now, system)
+    if base_event is _retention.EXPIRED or not await base_event.has_events_marked():
+        return None
+
+    ops = [event.get('op') for event in events_to_chain]
+    chain = await asyncio.gather(*[get_event_data(event.get('name'), time_group, now, system)
+                                   for event in events_to_chain])
+    chain = list(chain)
+
+    # Each OR operates only on its immediate predecessor
+    for idx in reversed([idx for idx, op in enumerate(ops) if op == 'or']):
+        if idx > 0:
+            chain[idx - 1] = await bitop('OR', chain[idx - 1], chain.pop(idx), system=system)
+            ops.pop(idx)
+
+    for op, event in zip(ops, chain):
+        base_event = await bitop('OR' if op == 'or' else 'AND', base_event, event,
+                                 system=system)
+
+    return base_event
+
+
+async def get_cohort(primary_event_name, secondary_event_name,
+                     additional_events=[], time_group='days',
+                     num_rows=10, num_cols=10, system='default',
+                     with_replacement=False):
+    """
+    Get the cohort data for multiple chained events at multiple points in
+    time; see :func:`flask_bitmapist.utils.get_cohort`.
+
+    Rows are computed concurrently, as are a row's cells when counting with
+    replacement (without it, each cell depends on the ones before it).
+    Intermediate keys created by the call are deleted once it is done.
+
+    :returns: Tuple of (list of lists of cohort results, list of dates for
+              cohort, primary event total for each date)
+    """
+    def increment_delta(t):
+        return relativedelta(**{time_group: t})
+
+    now = datetime.utcnow()
+    event_time = now - relativedelta(**{time_group: num_rows - 1})
+    if time_group == 'months':
+        event_time -= relativedelta(days=event_time.day - 1)
+    dates = [event_time + increment_delta(i) for i in range(num_rows)]
+
+    async def get_cell(primary_event, incremented):
+        if incremented > now:
+            return None, None
+        chained = await chain_events(secondary_event_name, additional_events,
+                                     incremented, time_group, system)
+        if chained is None:
+            return 0, None
+        combined = await bitop('AND', chained, primary_event, system=system)
+        return await combined.get_count(), combined
+
+    async def get_row(event_time):
+        primary_event = await get_event_data(primary_event_name, time_group, event_time, system)
+        if primary_event is _retention.EXPIRED:
+            return [primary_event] * num_cols, primary_event
+        primary_total = await primary_event.get_count()
+        if not primary_total:
+            return [None] * num_cols, primary_total
+
+        incremented = [event_time + increment_delta(j) for j in range(num_cols)]
+        if with_replacement:
+            cells = await asyncio.gather(*[get_cell(primary_event, date)
+                                           for date in incremented])
+            return [count for count, _ in cells], primary_total
+
+        row = []
+        for date in incremented:
+            count, combined = await get_cell(primary_event, date)
+            if combined is not None:
+                primary_event = await bitop('XOR', primary_event, combined, system=system)
+            row.append(count)
+        return row, primary_total
+
+    # Tasks started by `gather` share this context's temporary keys
+    temp_keys = TempKeys(system)
+    token = _temp_keys.set(temp_keys)
+    try:
+        rows = await asyncio.gather(*[get_row(date) for date in dates])
+    finally:
+        _temp_keys.reset(token)
+        await _cleanup(temp_keys)
+
+    return [row for row, _ in rows], dates, [total for _, total in rows]
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.cache
+    ~~~~~~~~~~~~~~~~~~~~~
+    Caches for bitmapist.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from bitmapist import get_redis
+
+
+# Prefix for cohort results shared through Redis
+COHORT_CACHE_PREFIX = 'flask_bitmapist:cohort_cell:'
+
+# Seconds a cached cohort result lives unless the cache is given a ttl, so
+# that neither tier keeps results forever
+COHORT_CACHE_TTL = 86400
+
+
+def version_ttl(ttl=None):
+    """
+    Seconds a version lives after it was last bumped, for results cached for
+    ``ttl`` seconds (defaults to ``COHORT_CACHE_TTL``); longer than any result
+    cached before the bump lives, so that a version starting over from 0
+    never matches one of them again.
+    """
+    return 2 * int(ttl or COHORT_CACHE_TTL)
+
+
+class LRUCache(object):
+    """
+    A thread-safe cache holding at most ``maxsize`` entries, evicting the
+    least recently used one first; entries may also expire after a time to
+    live.
+
+    :param int maxsize: Maximum number of entries
+    :param float ttl: Default number of seconds an entry lives; None to keep
+                      entries until they are evicted
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= time.time():
+                self.misses += 1
+                return default
+
+            # Move the entry to the most recently used end
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        "Store a value; ``ttl`` overrides the cache's default time to live"
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+class CohortCache(object):
+    """
+    Cohort cells and primary event totals from periods that have ended, kept
+    in an in-process :class:`LRUCache` and, when ``shared``, in Redis too, so
+    that every process can use what any one of them has computed.
+
+    :param int maxsize: Maximum number of results kept in-process
+    :param int ttl: Seconds a result lives; defaults to ``COHORT_CACHE_TTL``
+    :param bool shared: Whether results are also kept in Redis
+    """
+
+    def __init__(self, maxsize=10000, ttl=None, shared=False):
+        self.ttl = int(ttl or COHORT_CACHE_TTL)
+        self.local = LRUCache(maxsize, self.ttl)
+        self.shared = shared
+
+        self._lock = threading.Lock()
+        self.shared_hits = 0
+        self.cells_cached = 0
+        self.cells_computed = 0
+        self.commands_saved = 0
+
+    def get_many(self, keys, system='default'):
+        "The cached results for any of ``keys``, as a dict"
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+
+        if self.shared and missing:
+            values = get_redis(system).mget([COHORT_CACHE_PREFIX + key for key in missing])
+            for key, value in zip(missing, values):
+                if value is not None:
+                    found[key] = int(value)
+                    self.local.set(key, found[key])
+                    with self._lock:
+                        self.shared_hits += 1
+        return found
+
+    def set_many(self, values, system='default'):
+        for key, value in values.items():
+            self.local.set(key, value)
+
+        if self.shared and values:
+            pipe = get_redis(system).pipeline()
+            for key, value in values.items():
+                pipe.set(COHORT_CACHE_PREFIX + key, value, ex=self.ttl)
+            pipe.execute()
+
+    @property
+    def version_ttl(self):
+        "Seconds a version lives after it was last bumped; see :func:`version_ttl`"
+        return version_ttl(self.ttl)
+
+    def record(self, cached, computed, commands_saved):
+        "Count the results of a cohort that were cached and computed"
+        with self._lock:
+            self.cells_cached += cached
+            self.cells_computed += computed
+            self.commands_saved += commands_saved
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        lookups = self.cells_cached + self.cells_computed
+        return {
+            'size': len(self.local),
+            'maxsize': self.local.maxsize,
+            'local_hits': self.cells_cached - self.shared_hits,
+            'shared_hits': self.shared_hits,
+            'cells_cached': self.cells_cached,
+            'cells_computed': self.cells_computed,
+            'hit_ratio': float(self.cells_cached) / lookups if lookups else 0.0,
+            'commands_saved': self.commands_saved,
+        }
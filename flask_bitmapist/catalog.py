@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.catalog
+    ~~~~~~~~~~~~~~~~~~~~~~~
+    A catalog of event names kept up to date as events are marked, so that
+    they can be listed without scanning the Redis keyspace: a set of every
+    event name, plus a set per day, week, month and year of the events with a
+    key for it.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+from datetime import datetime
+
+from bitmapist import get_redis
+
+from . import retention
+from .cache import LRUCache
+
+
+CATALOG_PREFIX = 'flask_bitmapist:catalog:'
+EVENTS_KEY = CATALOG_PREFIX + 'events'
+
+TIME_GROUPS = ('days', 'weeks', 'months', 'years')
+
+# Event names each process has already added to the catalog for a period;
+# they only save repeating the same SADD, so they may be forgotten any time
+RECORDED = LRUCache(maxsize=10000, ttl=3600)
+
+
+def period_id(date, time_group):
+    "Identifies the period a date falls in, as bitmapist's key names do"
+    if time_group in ('days', 'day'):
+        return '%s-%s-%s' % (date.year, date.month, date.day)
+    elif time_group in ('weeks', 'week'):
+        return 'W%s-%s' % (date.year, date.isocalendar()[1])
+    elif time_group in ('months', 'month'):
+        return '%s-%s' % (date.year, date.month)
+    elif time_group in ('years', 'year'):
+        return '%s' % date.year
+
+
+def period_key(date, time_group):
+    "Key of the set of events marked in the period a date falls in"
+    if not time_group.endswith('s'):
+        time_group += 's'
+    return '%s%s:%s' % (CATALOG_PREFIX, time_group, period_id(date, time_group))
+
+
+def catalog_commands(marks, system='default'):
+    """
+    SADD commands adding a batch of marks' event names to the catalog,
+    leaving out the ones this process has already added, followed by the
+    EXPIREAT commands of any period sets under retention.
+    """
+    names = {}
+    periods = {}
+    for event_name, uuid, now in marks:
+        now = now or datetime.utcnow()
+        for key in [EVENTS_KEY] + [period_key(now, time_group) for time_group in TIME_GROUPS]:
+            if RECORDED.get((system, key, event_name)) is None:
+                RECORDED.set((system, key, event_name), True)
+                names.setdefault(key, set()).add(event_name)
+        for time_group in TIME_GROUPS:
+            periods[period_key(now, time_group)] = (now, time_group)
+
+    commands = [['SADD', key] + sorted(names[key]) for key in sorted(names)]
+    # Each period's set is kept as long as the period's event keys are
+    periods = dict((key, period) for key, period in periods.items() if key in names)
+    return commands + retention.expire_commands(periods, system)
+
+
+def get_event_names(system='default', prefix=''):
+    "Every event name in the catalog, or just the ones starting with ``prefix``"
+    names = get_redis(system).smembers(EVENTS_KEY)
+    names = [name.decode() if isinstance(name, bytes) else name for name in names]
+    return [name for name in names if name.startswith(prefix)]
+
+
+def marked_events(event_names, date, time_group, system='default', pipe=None):
+    """
+    The names among ``event_names`` with a key for the period a date falls
+    in; with a pipeline, the lookup is added to it and a function taking its
+    result is returned instead.
+    """
+    def result(members):
+        members = set(name.decode() if isinstance(name, bytes) else name for name in members)
+        return set(name for name in event_names if name in members)
+
+    if pipe is not None:
+        pipe.smembers(period_key(date, time_group))
+        return result
+    return result(get_redis(system).smembers(period_key(date, time_group)))
+
+
+def _parse_key(key):
+    """
+    The event name and the periods of a bitmapist event key, as ``(time
+    group, period id)`` pairs; a month key is counted for its year as well,
+    and a day key for its week, month and year (whose keys a rollup mode mark
+    does not write). Hour and BITOP keys have none.
+    """
+    if not key.startswith('trackist_') or key.startswith('trackist_bitop_'):
+        return None, []
+    event_name, _, period = key[len('trackist_'):].rpartition('_')
+    if not event_name:
+        return None, []
+
+    if period.startswith('W'):
+        return event_name, [('weeks', period)]
+    parts = period.split('-')
+    if len(parts) == 2:
+        return event_name, [('months', period), ('years', parts[0])]
+    elif len(parts) == 3:
+        try:
+            date = datetime(*[int(part) for part in parts])
+        except ValueError:
+            return event_name, [('days', period)]
+        return event_name, [(time_group, period_id(date, time_group))
+                            for time_group in TIME_GROUPS]
+    return event_name, []
+
+
+def rebuild(system='default', batch=10000):
+    """
+    Backfill the catalog from the event keys already in Redis, e.g. ones
+    written before the catalog was turned on or by ``bitmapist.mark_event``
+    directly. The keyspace is scanned once, in batches of ``batch`` keys.
+
+    :returns: Number of event names found
+    """
+    cli = get_redis(system)
+    names = set()
+    periods = {}
+    for key in cli.scan_iter(match='trackist_*', count=batch):
+        event_name, key_periods = _parse_key(key.decode() if isinstance(key, bytes) else key)
+        if event_name is None:
+            continue
+        names.add(event_name)
+        for time_group, period in key_periods:
+            catalog_key = '%s%s:%s' % (CATALOG_PREFIX, time_group, period)
+            periods.setdefault(catalog_key, set()).add(event_name)
+
+    pipe = cli.pipeline(transaction=False)
+    if names:
+        pipe.sadd(EVENTS_KEY, *sorted(names))
+    for catalog_key in sorted(periods):
+        pipe.sadd(catalog_key, *sorted(periods[catalog_key]))
+    pipe.execute()
+
+    RECORDED.clear()
+    return len(names)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.cli
+    ~~~~~~~~~~~~~~~~~~~
+    ``flask bitmapist`` commands, registered with apps on Flask 0.11+.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import json
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from . import catalog, memory, retention, rollup
+from .utils import get_event_names
+
+
+@click.group('bitmapist')
+def bitmapist_cli():
+    "Flask-Bitmapist maintenance commands."
+
+
+@bitmapist_cli.command('rebuild-catalog')
+@with_appcontext
+def rebuild_catalog():
+    "Backfill the event catalog from the event keys in Redis."
+    ext = current_app.extensions['bitmapist']
+    count = catalog.rebuild(ext.redis_system)
+    click.echo('Cataloged %s event names' % count)
+
+
+@bitmapist_cli.command('rollup')
+@click.option('--periods', default=2, help='How many ended weeks and months to roll up.')
+@click.option('--force', is_flag=True, help='Roll up periods again, even if they have been.')
+@with_appcontext
+def rollup_periods(periods, force):
+    "Roll up the weeks and months that have ended from their days."
+    ext = current_app.extensions['bitmapist']
+    rolled_up = rollup.rollup(get_event_names(ext.redis_system), ext.redis_system,
+                              periods=periods, force=force)
+    click.echo('Rolled up %s' % (', '.join(rolled_up) or 'nothing'))
+
+
+@bitmapist_cli.command('sweep')
+@with_appcontext
+def sweep():
+    "Set the expiry of the keys already in Redis, deleting those past their retention."
+    ext = current_app.extensions['bitmapist']
+    expired, expiring = retention.sweep(ext.redis_system)
+    click.echo('Expired %s keys, set %s keys to expire' % (expired, expiring))
+
+
+@bitmapist_cli.command('memory')
+@click.option('--top', default=10, help='How many sparse keys and growing events to list.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the report as JSON.')
+@with_appcontext
+def memory_usage(top, as_json):
+    "Report the memory event keys take, by event and time group."
+    ext = current_app.extensions['bitmapist']
+    report = memory.memory_report(ext.redis_system, top=top)
+    if as_json:
+        click.echo(json.dumps(report, indent=4))
+        return
+
+    row = '%-40s %-6s %8s %14s %14s %8s'
+    click.echo(row % ('Event', 'Group', 'Keys', 'Bytes', 'Bits set', 'Density'))
+    for group in report['events']:
+        click.echo(row % (group['event'], group['time_group'], group['keys'], group['bytes'],
+                          group['bits'], '%.2f%%' % (group['density'] * 100)))
+    click.echo('Total: %(keys)s keys, %(bytes)s bytes' % report['total'])
+
+    if report['sparse']:
+        click.echo('\nSparse keys (under %g%% of bits set):' % (memory.SPARSE_DENSITY * 100))
+        for key in report['sparse']:
+            click.echo('  %s: %s bytes, %.4f%% set' % (
+                key['key'], key['bytes'], key['density'] * 100))
+    if report['growing']:
+        click.echo('\nFastest-growing events (bytes of new hour and day keys, last %s days '
+                   'vs. the %s before):' % (memory.GROWTH_DAYS, memory.GROWTH_DAYS))
+        for event in report['growing']:
+            click.echo('  %(event)s: %(recent_bytes)s vs. %(previous_bytes)s' % event)
@@ -8,10 +8,23 @@
     :license: MIT, see LICENSE for more details.
 """
 
+from collections import defaultdict
+from datetime import datetime
+
+import redis
+from flask import current_app, g, has_app_context, has_request_context
+
 import bitmapist as _bitmapist
 
-from .utils import _get_redis_connection
+from . import (cache as _cache, catalog as _catalog, metrics as _metrics,
+               retention as _retention, rollup as _rollup, tempkeys as _tempkeys,
+               utils as _utils)
+from ._compat import string_types
+from .cache import CohortCache, LRUCache
+from .idmap import IdMap
+from .utils import _get_connection_pool, mark_event, mark_events
 from .views import bitmapist_bp
+from .worker import MarkWorker
 
 
 class FlaskBitmapist(object):
@@ -21,6 +34,15 @@ class FlaskBitmapist(object):
 
     app = None
     redis_url = None
+    redis_system = 'default'
+    pool = None
+    buffer_marks = False
+    worker = None
+    activity_event = None
+    activity_uuid = None
+    suppression_cache = None
+    cohort_cache = None
+    id_map = None
     SYSTEMS = _bitmapist.SYSTEMS
     TRACK_HOURLY = _bitmapist.TRACK_HOURLY
 
@@ -37,16 +59,93 @@ class FlaskBitmapist(object):
         "This is used to initialize bitmapist with your app object"
         self.app = app
         self.redis_url = app.config.get('BITMAPIST_REDIS_URL', 'redis://localhost:6379')
-
-        if self.redis_url not in _bitmapist.SYSTEMS.values():
-            host, port = _get_redis_connection(self.redis_url)
-            _bitmapist.setup_redis(
-                app.config.get('BITMAPIST_REDIS_SYSTEM', 'default'),
-                host,
-                port)
+        self.redis_system = app.config.get('BITMAPIST_REDIS_SYSTEM', 'default')
+        self.redis_options = {
+            'max_connections': app.config.get('BITMAPIST_REDIS_MAX_CONNECTIONS'),
+            'socket_timeout': app.config.get('BITMAPIST_REDIS_SOCKET_TIMEOUT'),
+            'socket_connect_timeout': app.config.get('BITMAPIST_REDIS_CONNECT_TIMEOUT'),
+            'socket_keepalive': app.config.get('BITMAPIST_REDIS_KEEPALIVE'),
+            'health_check_interval': app.config.get('BITMAPIST_REDIS_HEALTH_CHECK_INTERVAL'),
+        }
+        _metrics.ENABLED = app.config.get('BITMAPIST_METRICS', False)
+        self._connect()
 
         _bitmapist.TRACK_HOURLY = app.config.get('BITMAPIST_TRACK_HOURLY', False)
 
+        mark_engine = app.config.get('BITMAPIST_MARK_ENGINE', 'pipeline')
+        if mark_engine not in _utils.MARK_ENGINES:
+            raise ValueError("BITMAPIST_MARK_ENGINE must be one of %s" %
+                             ', '.join(_utils.MARK_ENGINES))
+        _utils.MARK_ENGINE = mark_engine
+
+        cohort_engine = app.config.get('BITMAPIST_COHORT_ENGINE', 'bitop')
+        if cohort_engine not in _utils.COHORT_ENGINES:
+            raise ValueError("BITMAPIST_COHORT_ENGINE must be one of %s" %
+                             ', '.join(_utils.COHORT_ENGINES))
+        _utils.COHORT_ENGINE = cohort_engine
+
+        # Read whether or not this process caches cohorts, since marks always
+        # bump the cache's versions for the processes that do
+        _cache.COHORT_CACHE_TTL = app.config.get('BITMAPIST_COHORT_CACHE_TTL') or 86400
+        if app.config.get('BITMAPIST_COHORT_CACHE', False):
+            self.cohort_cache = CohortCache(
+                maxsize=app.config.get('BITMAPIST_COHORT_CACHE_SIZE', 10000),
+                ttl=app.config.get('BITMAPIST_COHORT_CACHE_TTL'),
+                shared=app.config.get('BITMAPIST_COHORT_CACHE_SHARED', False))
+        else:
+            self.cohort_cache = None
+        _utils.COHORT_CACHE = self.cohort_cache
+
+        _utils.EVENT_CATALOG = app.config.get('BITMAPIST_EVENT_CATALOG', False)
+        _tempkeys.TEMP_KEY_TTL = app.config.get('BITMAPIST_TEMP_KEY_TTL', 60)
+        _catalog.RECORDED.clear()
+
+        _utils.ROLLUP_MODE = app.config.get('BITMAPIST_ROLLUP_MODE', False)
+        _rollup.ROLLUP_TTL = app.config.get('BITMAPIST_ROLLUP_TTL', 60)
+        _rollup.BUILT.clear()
+        _rollup.ROLLED_UP.clear()
+
+        # Days each time group's keys are kept after their period ends
+        self.retention = dict(app.config.get('BITMAPIST_RETENTION') or {})
+        for time_group in self.retention:
+            if time_group not in _retention.TIME_GROUPS:
+                raise ValueError("BITMAPIST_RETENTION keys must be among %s" %
+                                 ', '.join(_retention.TIME_GROUPS))
+        _retention.RETENTION = dict((time_group, days)
+                                    for time_group, days in self.retention.items()
+                                    if days is not None)
+        _retention.EXPIRING.clear()
+
+        if app.config.get('BITMAPIST_ID_MAP', False):
+            self.id_map = IdMap(maxsize=app.config.get('BITMAPIST_ID_MAP_CACHE_SIZE', 100000))
+        else:
+            self.id_map = None
+        _utils.ID_MAP = self.id_map
+
+        self.buffer_marks = app.config.get('BITMAPIST_BUFFER_MARKS', False)
+        if self.buffer_marks:
+            app.after_request(self._defer_buffered_marks)
+            app.teardown_request(self._flush_buffered_marks)
+
+        if app.config.get('BITMAPIST_ASYNC_MARKING', False):
+            self.worker = MarkWorker(
+                maxsize=app.config.get('BITMAPIST_ASYNC_QUEUE_SIZE', 10000),
+                batch_size=app.config.get('BITMAPIST_ASYNC_BATCH_SIZE', 500),
+                batch_interval=app.config.get('BITMAPIST_ASYNC_BATCH_INTERVAL', 50),
+                policy=app.config.get('BITMAPIST_ASYNC_FULL_POLICY', 'block'),
+                on_drop=self._forget_marks)
+            self.worker.start()
+
+        self.suppression_cache = LRUCache(
+            maxsize=app.config.get('BITMAPIST_SUPPRESSION_CACHE_SIZE', 100000),
+            ttl=app.config.get('BITMAPIST_SUPPRESSION_CACHE_TTL', 3600))
+
+        # Registered after the buffering hooks, so that it runs before them
+        self.activity_event = app.config.get('BITMAPIST_ACTIVITY_EVENT')
+        self.activity_uuid = app.config.get('BITMAPIST_ACTIVITY_UUID', _current_user_id)
+        if self.activity_event:
+            app.after_request(self._mark_activity)
+
         if not hasattr(app, 'extensions'):
             app.extensions = {}
 
@@ -54,3 +153,174 @@ class FlaskBitmapist(object):
 
         if not app.config.get('BITMAPIST_DISABLE_BLUEPRINT', False):
             app.register_blueprint(bitmapist_bp)
+
+        if hasattr(app, 'cli'):
+            # Flask 0.11+
+            from .cli import bitmapist_cli
+            app.cli.add_command(bitmapist_cli)
+
+    def _connect(self):
+        "Set up the Redis system with a connection pool that each process starts over"
+        self.pool = _get_connection_pool(self.redis_url, **self.redis_options)
+        client_class = _metrics.CountingRedis if _metrics.ENABLED else redis.Redis
+        _bitmapist.SYSTEMS[self.redis_system] = client_class(connection_pool=self.pool)
+
+    def mark(self, event_name, uuid, system='default', now=None, track_hourly=None):
+        """
+        Mark an event; when ``BITMAPIST_BUFFER_MARKS`` is enabled, marks made
+        during a request are held on ``flask.g`` and written in one pipeline
+        once the response has been sent. When ``BITMAPIST_ASYNC_MARKING`` is
+        enabled, marks are handed to the background worker instead of being
+        written directly.
+        """
+        with _metrics.time_mark(event_name):
+            if not (self.buffer_marks and has_request_context()):
+                if self.worker is not None:
+                    return self.worker.enqueue(event_name, uuid, now or datetime.utcnow(),
+                                               system, track_hourly)
+                return mark_events([(event_name, uuid, now)], system, track_hourly)
+
+            marks = getattr(g, '_bitmapist_marks', None)
+            if marks is None:
+                marks = g._bitmapist_marks = defaultdict(list)
+            marks[(system, track_hourly)].append((event_name, uuid, now or datetime.utcnow()))
+
+    def mark_once(self, event_name, uuid, system='default', now=None, track_hourly=None):
+        """
+        Mark an event unless this process has already marked it for the same
+        uuid in the same day (or hour, when tracking hourly); every key the
+        mark would write is already set in that case.
+
+        Marks are remembered in ``suppression_cache``, bounded by
+        ``BITMAPIST_SUPPRESSION_CACHE_SIZE`` and
+        ``BITMAPIST_SUPPRESSION_CACHE_TTL``, and forgotten again if they fail
+        to be written or are dropped by the background worker.
+        """
+        now = now or datetime.utcnow()
+        key = _suppression_key(event_name, uuid, system, now, track_hourly)
+        if self.suppression_cache.get(key):
+            return
+        # Remembered before the mark is handed on, so that a worker dropping
+        # it straight away can forget it again
+        self.suppression_cache.set(key, True)
+        try:
+            self.mark(event_name, uuid, system, now, track_hourly)
+        except Exception:
+            self.suppression_cache.delete(key)
+            raise
+
+    def _forget_marks(self, system, track_hourly, marks):
+        "Let ``mark_once`` write ``(event_name, uuid, now)`` marks that were lost again"
+        for event_name, uuid, now in marks:
+            self.suppression_cache.delete(
+                _suppression_key(event_name, uuid, system, now, track_hourly))
+
+    def _mark_activity(self, response):
+        uuid = self.activity_uuid()
+        if uuid is not None:
+            self.mark_once(self.activity_event, uuid, self.redis_system)
+        return response
+
+    def mark_events(self, marks, system='default', track_hourly=None):
+        """
+        Mark several ``(event_name, uuid, now)`` events; see :meth:`mark` for
+        how buffering and background marking apply.
+        """
+        if (self.buffer_marks and has_request_context()) or self.worker is not None:
+            for event_name, uuid, now in marks:
+                self.mark(event_name, uuid, system, now, track_hourly)
+        else:
+            mark_events(marks, system, track_hourly)
+
+    def _pop_buffered_marks(self):
+        marks = getattr(g, '_bitmapist_marks', None)
+        g._bitmapist_marks = None
+        return marks
+
+    def _defer_buffered_marks(self, response):
+        marks = self._pop_buffered_marks()
+        if marks:
+            response.call_on_close(lambda: self._write_marks(marks))
+        return response
+
+    def _flush_buffered_marks(self, exc=None):
+        # Catches anything marked after `after_request` ran, or marks from a
+        # request that failed before a response was built
+        marks = self._pop_buffered_marks()
+        if marks:
+            self._write_marks(marks)
+
+    def _write_marks(self, marks):
+        groups = list(marks.items())
+        for i, ((system, track_hourly), events) in enumerate(groups):
+            if self.worker is not None:
+                for event_name, uuid, now in events:
+                    self.worker.enqueue(event_name, uuid, now, system, track_hourly)
+                continue
+            try:
+                mark_events(events, system, track_hourly)
+            except Exception:
+                # Neither this group nor the ones after it have been written
+                for (system, track_hourly), events in groups[i:]:
+                    self._forget_marks(system, track_hourly, events)
+                raise
+
+
+def _suppression_key(event_name, uuid, system, now, track_hourly):
+    "The ``suppression_cache`` key of a mark, for the day (or hour) it falls in"
+    hourly = _bitmapist.TRACK_HOURLY if track_hourly is None else track_hourly
+    return (system, event_name, uuid, now.strftime('%Y-%m-%d-%H' if hourly else '%Y-%m-%d'))
+
+
+def _get_extension():
+    if has_app_context():
+        return current_app.extensions.get('bitmapist')
+
+
+def _current_user_id():
+    "The id of Flask-Login's current user, if one is logged in"
+    if not hasattr(current_app, 'login_manager'):
+        return None
+
+    from flask_login import current_user
+    if current_user.is_authenticated:
+        return current_user.id
+
+
+def _mark(event_name, uuid, system='default', now=None, track_hourly=None,
+          use_pipeline=True):
+    """
+    Mark an event through the current app's FlaskBitmapist extension, falling
+    back to :func:`~flask_bitmapist.utils.mark_event` outside of an app or when
+    the caller manages its own pipeline.
+    """
+    ext = _get_extension()
+    if ext is None or not use_pipeline or not isinstance(system, string_types):
+        return mark_event(event_name, uuid, system, now, track_hourly, use_pipeline)
+
+    return ext.mark(event_name, uuid, system, now, track_hourly)
+
+
+def _mark_once(event_name, uuid, system='default', now=None, track_hourly=None):
+    """
+    Mark an event through the current app's FlaskBitmapist extension, skipping
+    marks it already wrote for the current period; see
+    :meth:`FlaskBitmapist.mark_once`.
+    """
+    ext = _get_extension()
+    if ext is None or not isinstance(system, string_types):
+        return mark_event(event_name, uuid, system, now, track_hourly)
+
+    return ext.mark_once(event_name, uuid, system, now, track_hourly)
+
+
+def _mark_events(marks, system='default', track_hourly=None):
+    """
+    Mark several events through the current app's FlaskBitmapist extension,
+    falling back to :func:`~flask_bitmapist.utils.mark_events`.
+    """
+    ext = _get_extension()
+    if ext is None:
+        return mark_events(marks, system, track_hourly)
+
+    return ext.mark_events(marks, system, track_hourly)
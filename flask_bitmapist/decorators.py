@@ -10,25 +10,40 @@
 
 from functools import wraps
 
-from bitmapist import mark_event
+from flask import after_this_request, current_app
 
+from ._compat import string_types
+from .core import _mark, _mark_events
 
-def mark(event_name, uuid, system='default', now=None, track_hourly=None, use_pipeline=True):
+
+# When the `mark` decorator writes its marks, relative to the view
+WHEN = ('before', 'after', 'after_response')
+
+
+def _resolve(value):
+    return value() if callable(value) else value
+
+
+def mark(event_name, uuid, system='default', now=None, track_hourly=None, use_pipeline=True,
+         when='before', condition=None):
     """
     A wrapper around bitmapist.mark_event
 
     Marks an event for hours, days, weeks and months.
 
-    :param :event_name The name of the event, could be "active" or "new_signups"
+    :param :event_name The name of the event, could be "active" or "new_signups";
+        a list of names marks every one of them in a single pipeline
 
     :param :uuid An unique id, typically user id. The id should not be huge,
-        read Redis documentation why (bitmaps)
+        read Redis documentation why (bitmaps). May be a callable (e.g.,
+        ``lambda: current_user.id``), called each time the view runs; nothing
+        is marked when it returns None
 
     :param :system The Redis system to use (string, Redis instance, or Pipeline
         instance).
 
     :param :now Which date should be used as a reference point, default is
-        `datetime.utcnow()`
+        `datetime.utcnow()`. May be a callable, called each time the view runs
 
     :param :track_hourly Should hourly stats be tracked, defaults to
         bitmapist.TRACK_HOURLY
@@ -37,14 +52,60 @@ def mark(event_name, uuid, system='default', now=None, track_hourly=None, use_pi
         pipelines or not. You may want to avoid using pipeline within the
         command if you provide the pipeline object in `system` argument and
         want to manage the pipe execution yourself.
+
+    :param :when When to mark: ``before`` the view runs (the default),
+        ``after`` it has returned a response, or ``after_response`` has been
+        sent to the client, so that marking adds no latency to the request
+
+    :param :condition Callable deciding whether to mark at all; it is called
+        with the response when marking ``after`` or ``after_response`` (e.g.,
+        ``lambda response: response.status_code < 300``), and with no
+        arguments when marking ``before``
+
+    When ``BITMAPIST_BUFFER_MARKS`` is enabled, the mark is held until the end
+    of the request and written together with the request's other marks.
     """
+    if when not in WHEN:
+        raise ValueError("when must be one of %s" % ', '.join(WHEN))
+
+    event_names = [event_name] if isinstance(event_name, string_types) else list(event_name)
+
+    def write(uuid_value, now_value):
+        if uuid_value is None:
+            return
+        if len(event_names) == 1 or not use_pipeline or not isinstance(system, string_types):
+            for name in event_names:
+                _mark(name, uuid_value, system, now_value, track_hourly, use_pipeline)
+        else:
+            marks = [(name, uuid_value, now_value) for name in event_names]
+            _mark_events(marks, system, track_hourly)
+
+    def after(response):
+        if condition is None or condition(response):
+            write(_resolve(uuid), _resolve(now))
+        return response
+
+    def after_response(response):
+        if condition is None or condition(response):
+            # The request context is gone by the time the response is closed,
+            # so resolve the uuid and time now and only defer the write
+            marked = (_resolve(uuid), _resolve(now))
+            app = current_app._get_current_object()
 
-    # print('called with', event_name)
+            def close():
+                with app.app_context():
+                    write(*marked)
+            response.call_on_close(close)
+        return response
 
     def decorator(fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            mark_event(event_name, uuid, system, now, track_hourly, use_pipeline)
+            if when == 'before':
+                if condition is None or condition():
+                    write(_resolve(uuid), _resolve(now))
+            else:
+                after_this_request(after if when == 'after' else after_response)
             return fn(*args, **kwargs)
         return wrapper
     return decorator
@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
 
-from flask.ext.login import user_logged_in, user_logged_out
+from __future__ import absolute_import
 
-from bitmapist import mark_event
+from flask_login import user_logged_in, user_logged_out
+
+from ..core import _mark_once
+from ..metrics import track
 
 
 @user_logged_in.connect
 def mark_login(sender, user, **extra):
-    mark_event('user:logged_in', user.id)
+    with track('flask_login_mark'):
+        _mark_once('user:logged_in', user.id)
 
 
 @user_logged_out.connect
 def mark_logout(sender, user, **extra):
-    mark_event('user:logged_out', user.id)
+    with track('flask_login_mark'):
+        _mark_once('user:logged_out', user.id)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.idmap
+    ~~~~~~~~~~~~~~~~~~~~~
+    Compact ids for external ids, for ``BITMAPIST_ID_MAP``.
+
+    A bitmap takes a bit for every id up to the highest one set, so large
+    ids (e.g., 64-bit snowflakes) make every key huge, and ids that are not
+    integers (e.g., UUIDs) cannot be marked at all. The id map gives each
+    external id the next sequential integer the first time it is marked, in
+    Redis hashes shared by every process, and marks set that integer's bit
+    instead. Ids never change once assigned, so each process keeps the ones
+    it has used in an LRU cache.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+from bitmapist import get_redis
+
+from ._compat import string_types
+from .cache import LRUCache
+from .local import fetch as _local_fetch
+from .scripting import assign_ids_script
+
+
+ID_MAP_PREFIX = 'flask_bitmapist:ids:'
+
+
+def _normalize(external_id):
+    "External ids are compared as strings, so ``123`` and ``'123'`` share an id"
+    return external_id if isinstance(external_id, string_types) else str(external_id)
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class IdMap(object):
+    """
+    Maps external ids to compact ids and back; every method takes a batch of
+    ids, and only asks Redis about the ones that are not cached, in a single
+    round-trip.
+
+    :param int maxsize: Number of ids each direction's cache holds
+    :param str prefix: Prefix of the Redis keys: a hash of external id to id
+                       (``forward``), one of id to external id (``reverse``),
+                       and a counter of the ids assigned (``next``)
+    """
+
+    def __init__(self, maxsize=100000, prefix=ID_MAP_PREFIX):
+        self.keys = [prefix + 'forward', prefix + 'reverse', prefix + 'next']
+        self.ids = LRUCache(maxsize=maxsize)
+        self.external_ids = LRUCache(maxsize=maxsize)
+
+    def _cached(self, external_ids, system):
+        "The cached ids of external ids, and the external ids that are not cached"
+        ids = {}
+        missing = set()
+        for external_id in external_ids:
+            id = self.ids.get((system, external_id))
+            if id is None:
+                missing.add(external_id)
+            else:
+                ids[external_id] = id
+        return ids, sorted(missing)
+
+    def _remember(self, ids, external_ids, system):
+        for id, external_id in zip(ids, external_ids):
+            if id is not None and external_id is not None:
+                self.ids.set((system, external_id), id)
+                self.external_ids.set((system, id), external_id)
+
+    def lookup(self, external_ids, system='default'):
+        """
+        The ids of external ids, without assigning any; None for external ids
+        that have never been marked.
+
+        :returns: List of ids, in the same order
+        """
+        external_ids = [_normalize(external_id) for external_id in external_ids]
+        ids, missing = self._cached(external_ids, system)
+        if missing:
+            found = [None if id is None else int(id)
+                     for id in get_redis(system).hmget(self.keys[0], missing)]
+            self._remember(found, missing, system)
+            ids.update(zip(missing, found))
+        return [ids[external_id] for external_id in external_ids]
+
+    def assign(self, external_ids, system='default'):
+        """
+        The ids of external ids, assigning the next ones to those that have
+        none, atomically; see :func:`flask_bitmapist.scripting.assign_ids_script`.
+
+        :returns: List of ids, in the same order
+        """
+        external_ids = [_normalize(external_id) for external_id in external_ids]
+        ids, missing = self._cached(external_ids, system)
+        if missing:
+            assigned = assign_ids_script(self.keys, missing, system)
+            self._remember(assigned, missing, system)
+            ids.update(zip(missing, assigned))
+        return [ids[external_id] for external_id in external_ids]
+
+    def to_external(self, ids, system='default'):
+        """
+        The external ids of ids, e.g. for exporting the members of a bitmap;
+        None for ids that have not been assigned.
+
+        :returns: List of external ids, as strings, in the same order
+        """
+        ids = list(ids)
+        external_ids = {}
+        missing = set()
+        for id in ids:
+            external_id = self.external_ids.get((system, id))
+            if external_id is None:
+                missing.add(id)
+            else:
+                external_ids[id] = external_id
+        if missing:
+            missing = sorted(missing)
+            found = [_decode(value) for value in get_redis(system).hmget(self.keys[1], missing)]
+            self._remember(missing, found, system)
+            external_ids.update(zip(missing, found))
+        return [external_ids[id] for id in ids]
+
+    def map_marks(self, marks, system='default'):
+        "``(event_name, uuid, now)`` marks with their uuids replaced by assigned ids"
+        ids = self.assign([uuid for _, uuid, _ in marks], system)
+        return [(event_name, id, now) for (event_name, _, now), id in zip(marks, ids)]
+
+    def clear(self):
+        "Forget the cached ids; the ones in Redis are kept"
+        self.ids.clear()
+        self.external_ids.clear()
+
+
+def _unwrap(events):
+    return events.events if isinstance(events, MappedEvents) else events
+
+
+class MappedEvents(object):
+    """
+    A bitmapist events collection whose ``in`` checks take external ids, and
+    whose iteration gives them, for ``BITMAPIST_ID_MAP``; everything else,
+    e.g. counts and bit operations, is passed through to the collection.
+
+    :param events: The events collection, holding the ids marks set
+    :param IdMap id_map: The id map the ids were assigned by
+    :param str system: Which bitmapist should be used
+    """
+
+    def __init__(self, events, id_map, system='default'):
+        self.events = events
+        self.id_map = id_map
+        self.system = system
+
+    def __getattr__(self, name):
+        return getattr(self.events, name)
+
+    def __contains__(self, external_id):
+        id = self.id_map.lookup([external_id], self.system)[0]
+        return id is not None and id in self.events
+
+    def get_uuids(self):
+        key = self.events.redis_key
+        ids = _local_fetch([key], self.system)[key].ids()
+        return iter(self.id_map.to_external(ids, self.system))
+
+    def __iter__(self):
+        return self.get_uuids()
+
+    def __len__(self):
+        return len(self.events)
+
+    def __eq__(self, other):
+        return self.events == _unwrap(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def _wrap(self, events):
+        return MappedEvents(events, self.id_map, self.system)
+
+    def __and__(self, other):
+        return self._wrap(self.events & _unwrap(other))
+
+    def __or__(self, other):
+        return self._wrap(self.events | _unwrap(other))
+
+    def __xor__(self, other):
+        return self._wrap(self.events ^ _unwrap(other))
+
+    def __invert__(self):
+        return self._wrap(~self.events)
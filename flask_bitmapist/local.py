@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.local
+    ~~~~~~~~~~~~~~~~~~~~~
+    Bitmap operations run in this process rather than with Redis ``BITOP``
+    commands; NumPy is used when it is installed, Python ints otherwise, and
+    sparse bitmaps are held in roaring containers.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+from bitmapist import get_redis
+
+from .roaring import CHUNK_BITS, CHUNK_BYTES, CHUNK_MASK, REVERSE, RoaringBitmap, \
+    _positions, int_from_bytes, popcount
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+# Whether bitmaps are held in NumPy arrays; can be turned off to use Python
+# ints even when NumPy is installed
+USE_NUMPY = np is not None
+
+# Bitmaps with fewer nonzero bytes than this share of their length are held in
+# roaring containers, taking memory in proportion to their ids rather than to
+# the highest of them; 0 to hold every bitmap densely
+SPARSE_THRESHOLD = 1 / 16.0
+
+if np is not None:
+    _POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class Bitmap(object):
+    """
+    An event bitmap fetched from Redis (or the result of operations on such
+    bitmaps). Sparse bitmaps are held in a
+    :class:`flask_bitmapist.roaring.RoaringBitmap`. Dense ones are held in a
+    ``uint8`` array viewing the fetched bytes without copying them with
+    NumPy, or otherwise in a Python int with bit ``n`` standing for id ``n``.
+
+    :param bits: ``uint8`` array, int or ``RoaringBitmap``
+    :param bool exists: Whether the key the bitmap came from exists; like
+                        bitmapist's ``has_events_marked``, this is True for a
+                        key whose bits have all been unset
+    """
+
+    def __init__(self, bits, exists=True):
+        self.bits = bits
+        self.exists = exists
+
+    @classmethod
+    def from_bytes(cls, data):
+        "Build a bitmap from a Redis string, or None for a key that does not exist"
+        if data is None:
+            return cls.empty(exists=False)
+        if len(data) - data.count(b'\x00') < len(data) * SPARSE_THRESHOLD:
+            return cls(RoaringBitmap.from_bytes(data))
+        if USE_NUMPY:
+            return cls(np.frombuffer(data, dtype=np.uint8))
+        return cls(int_from_bytes(data.translate(REVERSE)))
+
+    @classmethod
+    def empty(cls, exists=False):
+        if SPARSE_THRESHOLD:
+            return cls(RoaringBitmap(), exists)
+        return cls(np.zeros(0, dtype=np.uint8) if USE_NUMPY else 0, exists)
+
+    def __len__(self):
+        return self.count()
+
+    def __contains__(self, uuid):
+        if isinstance(self.bits, RoaringBitmap):
+            return uuid in self.bits
+        if _is_array(self.bits):
+            byte, bit = divmod(uuid, 8)
+            return byte < len(self.bits) and bool(self.bits[byte] & (0x80 >> bit))
+        return bool(self.bits >> uuid & 1)
+
+    def ids(self):
+        "The ids set, in ascending order"
+        if isinstance(self.bits, RoaringBitmap):
+            return self.bits.ids()
+        if _is_array(self.bits):
+            # Bits are unpacked most significant first, as Redis numbers them
+            return np.flatnonzero(np.unpackbits(self.bits)).tolist()
+        return _positions(self.bits) if self.bits else []
+
+    def is_sparse(self):
+        return isinstance(self.bits, RoaringBitmap)
+
+    def count(self):
+        "Number of bits set, like ``BITCOUNT``"
+        if isinstance(self.bits, RoaringBitmap):
+            return self.bits.count()
+        if _is_array(self.bits):
+            return int(_POPCOUNT[self.bits].sum(dtype=np.uint64))
+        return popcount(self.bits)
+
+    def has_events_marked(self):
+        return self.exists
+
+    def get_count(self):
+        return self.count()
+
+    def includes(self, uuid):
+        return uuid in self
+
+    def __and__(self, other):
+        return bitop('AND', self, other)
+
+    def __or__(self, other):
+        return bitop('OR', self, other)
+
+    def __xor__(self, other):
+        return bitop('XOR', self, other)
+
+    def __sub__(self, other):
+        return bitop('ANDNOT', self, other)
+
+
+def _is_array(bits):
+    return np is not None and isinstance(bits, np.ndarray)
+
+
+def _pad(bits, size):
+    if len(bits) == size:
+        return bits
+    padded = np.zeros(size, dtype=np.uint8)
+    padded[:len(bits)] = bits
+    return padded
+
+
+def _chunk(bits, high):
+    "A chunk of 65536 bits of a dense bitmap, as an int"
+    if _is_array(bits):
+        data = bits[high * CHUNK_BYTES:(high + 1) * CHUNK_BYTES].tobytes()
+        return int_from_bytes(data.translate(REVERSE))
+    return bits >> (high * CHUNK_BITS) & CHUNK_MASK
+
+
+def _densify(bits, like):
+    if _is_array(like):
+        return np.frombuffer(bits.to_bytes(), dtype=np.uint8)
+    return bits.to_int()
+
+
+def _bitop2(op_name, a, b):
+    a_sparse = isinstance(a, RoaringBitmap)
+    b_sparse = isinstance(b, RoaringBitmap)
+
+    if a_sparse and b_sparse:
+        return a.bitop(op_name, b)
+
+    # A sparse bitmap is only compared with the chunks of a dense one it has
+    # ids in; ORs and XORs with dense bitmaps are dense anyway
+    if a_sparse and op_name in ('AND', 'ANDNOT'):
+        return a.bitop_chunks(op_name, lambda high: _chunk(b, high))
+    if b_sparse and op_name == 'AND':
+        return b.bitop_chunks(op_name, lambda high: _chunk(a, high))
+    if a_sparse:
+        a = _densify(a, b)
+    if b_sparse:
+        b = _densify(b, a)
+
+    if _is_array(a):
+        size = max(len(a), len(b))
+        a, b = _pad(a, size), _pad(b, size)
+        if op_name == 'AND':
+            return a & b
+        elif op_name == 'OR':
+            return a | b
+        elif op_name == 'XOR':
+            return a ^ b
+        elif op_name == 'ANDNOT':
+            return a & ~b
+
+    if op_name == 'AND':
+        return a & b
+    elif op_name == 'OR':
+        return a | b
+    elif op_name == 'XOR':
+        return a ^ b
+    elif op_name == 'ANDNOT':
+        return a & ~b
+
+
+def bitop(op_name, *bitmaps):
+    """
+    Run ``AND``, ``OR``, ``XOR`` or ``ANDNOT`` (the first bitmap without any of
+    the others) over bitmaps; shorter bitmaps are treated as zero-padded, as
+    with ``BITOP``. The result exists if any of the bitmaps do.
+    """
+    exists = any(bitmap.exists for bitmap in bitmaps)
+    bits = bitmaps[0].bits
+    for bitmap in bitmaps[1:]:
+        bits = _bitop2(op_name, bits, bitmap.bits)
+    return Bitmap(bits, exists)
+
+
+def fetch(keys, system='default'):
+    "Fetch each of ``keys`` once, in a single pipeline, as a dict of bitmaps"
+    keys = sorted(set(keys))
+    pipe = get_redis(system).pipeline(transaction=False)
+    for key in keys:
+        pipe.get(key)
+    return dict((key, Bitmap.from_bytes(data)) for key, data in zip(keys, pipe.execute()))
+
+
+def chain(bitmaps, base, steps):
+    """
+    Chain steps onto the union of ``base``'s bitmaps; each step is an ``(op,
+    keys)`` pair ORing its keys' bitmaps together. Returns None if none of the
+    base keys exist.
+    """
+    result = bitop('OR', *[bitmaps[key] for key in base])
+    if not result.exists:
+        return None
+    for op_name, keys in steps:
+        result = bitop(op_name.upper(), result, bitop('OR', *[bitmaps[key] for key in keys]))
+    return result
+
+
+def get_cohort_local(spec, system='default'):
+    """
+    Compute a whole cohort in this process, from every bitmap it needs
+    fetched once in a single pipeline; Redis only serves ``GET`` commands.
+
+    :param dict spec: A cohort spec, as taken by
+                      :func:`flask_bitmapist.scripting.get_cohort_script`
+    :param str system: Which bitmapist should be used
+    :returns: Tuple of (list of lists of cohort results, primary event total
+              for each row)
+    """
+    keys = [key for row in spec['rows'] for key in row['primary']]
+    for spec_chain in spec['chains']:
+        keys.extend(spec_chain['base'])
+        keys.extend(key for step in spec_chain['steps'] for key in step['keys'])
+    bitmaps = fetch(keys, system)
+
+    chains = [chain(bitmaps, spec_chain['base'],
+                    [(step['op'], step['keys']) for step in spec_chain['steps']])
+              for spec_chain in spec['chains']]
+
+    cohort = []
+    totals = []
+    for row in spec['rows']:
+        remaining = bitop('OR', *[bitmaps[key] for key in row['primary']])
+        total = row['total'] if 'total' in row else remaining.count()
+        counts = []
+        for p in row['cells']:
+            # A negative index is a cell whose count is already known
+            known = p < 0
+            p = abs(p)
+            if total == 0 or p == 0:
+                counts.append(None)
+            elif chains[p - 1] is None:
+                counts.append(0)
+            else:
+                cell = bitop('AND', chains[p - 1], remaining)
+                counts.append(None if known else cell.count())
+                if not spec['with_replacement']:
+                    remaining = bitop('XOR', remaining, cell)
+        cohort.append(counts)
+        totals.append(total)
+    return cohort, totals
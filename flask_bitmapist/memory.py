@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.memory
+    ~~~~~~~~~~~~~~~~~~~~~~
+    A report of the Redis memory event bitmaps take, by event and time group,
+    for capacity planning and for picking the events to expire (see
+    :mod:`flask_bitmapist.retention`) or map to compact ids (see
+    :mod:`flask_bitmapist.idmap`).
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import heapq
+from datetime import datetime, timedelta
+
+from bitmapist import get_redis
+from redis.exceptions import ResponseError
+
+from .retention import parse_period
+
+
+# Keys with fewer of their bits set than this share are flagged as sparse...
+SPARSE_DENSITY = 0.01
+
+# ...if they take at least this many bytes
+SPARSE_MIN_BYTES = 4096
+
+# Days of new hour and day keys an event's growth is measured over, against
+# as many days before them
+GROWTH_DAYS = 7
+
+
+def _density(bits, size):
+    "Share of the bits of a string of ``size`` bytes that are set"
+    return float(bits) / (size * 8) if size else 0.0
+
+
+def memory_report(system='default', batch=1000, top=10, now=None):
+    """
+    Report the memory the event keys in Redis take. The keyspace is scanned
+    once, in batches of ``batch`` keys, with each batch's ``MEMORY USAGE``
+    (``STRLEN`` before Redis 4), ``STRLEN`` and ``BITCOUNT`` commands sent in a
+    single pipeline.
+
+    :param str system: Which bitmapist should be used
+    :param int batch: Number of keys scanned and measured at a time
+    :param int top: Number of sparse keys and growing events to list
+    :param datetime now: Time point growth is measured up to (defaults to
+                         current time if None)
+    :returns: Dict of ``events``, a list of ``{'event', 'time_group', 'keys',
+              'bytes', 'bits', 'density'}`` totals by event and time group,
+              largest first; ``total``, the number of keys and bytes; ``sparse``,
+              the largest keys with fewer than ``SPARSE_DENSITY`` of their bits
+              set; and ``growing``, the events whose new hour and day keys took
+              the most more bytes in the last ``GROWTH_DAYS`` days than in as
+              many days before
+    """
+    report = _Report(get_redis(system), now or datetime.utcnow(), top)
+    keys = []
+    for key in report.cli.scan_iter(match='trackist_*', count=batch):
+        key = key.decode() if isinstance(key, bytes) else key
+        if key.startswith('trackist_bitop_'):
+            continue
+        event_name, _, period = key[len('trackist_'):].rpartition('_')
+        period = parse_period(period)
+        if event_name and period is not None:
+            keys.append((key, event_name, period))
+        if len(keys) >= batch:
+            report.add(keys)
+            keys = []
+    if keys:
+        report.add(keys)
+    return report.result()
+
+
+class _Reversed(object):
+    "Orders strings the other way around"
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class _Report(object):
+    "Totals of the event keys measured so far"
+
+    def __init__(self, cli, now, top):
+        self.cli = cli
+        self.top = top
+        self.recent = now - timedelta(days=GROWTH_DAYS)
+        self.previous = self.recent - timedelta(days=GROWTH_DAYS)
+        self.use_memory = True
+        self.groups = {}
+        self.growth = {}
+        # The ``top`` largest sparse keys so far, as a heap with the
+        # smallest first
+        self.sparse = []
+
+    def measure(self, keys):
+        "The bytes used, length and set-bit count of each key; None for keys to leave out"
+        pipe = self.cli.pipeline(transaction=False)
+        for key, _, _ in keys:
+            if self.use_memory:
+                pipe.execute_command('MEMORY', 'USAGE', key)
+            pipe.strlen(key)
+            pipe.bitcount(key)
+        results = pipe.execute(raise_on_error=False)
+
+        if self.use_memory and isinstance(results[0], ResponseError):
+            # MEMORY USAGE came in Redis 4; STRLEN leaves out the keys' overhead
+            self.use_memory = False
+            return self.measure(keys)
+
+        step = 3 if self.use_memory else 2
+        measured = []
+        for i in range(len(keys)):
+            size, bits = results[i * step + step - 2:(i + 1) * step]
+            used = results[i * step] if self.use_memory else size
+            # Keys that are not strings, or that are gone since they were
+            # scanned, are left out
+            if isinstance(size, Exception) or isinstance(bits, Exception) or not used:
+                measured.append(None)
+            else:
+                measured.append((used, size, bits))
+        return measured
+
+    def add(self, keys):
+        for (key, event_name, (date, time_group)), measured in zip(keys, self.measure(keys)):
+            if measured is None:
+                continue
+            used, size, bits = measured
+            group = self.groups.setdefault((event_name, time_group), {
+                'event': event_name, 'time_group': time_group, 'keys': 0, 'bytes': 0,
+                'bits': 0, 'size': 0})
+            group['keys'] += 1
+            group['bytes'] += used
+            group['bits'] += bits
+            group['size'] += size
+
+            density = _density(bits, size)
+            if density < SPARSE_DENSITY and size >= SPARSE_MIN_BYTES:
+                self.add_sparse({'key': key, 'event': event_name, 'time_group': time_group,
+                                 'bytes': used, 'bits': bits, 'density': density})
+
+            if time_group in ('hours', 'days') and date >= self.previous:
+                growth = self.growth.setdefault(event_name, [0, 0])
+                growth[0 if date >= self.recent else 1] += used
+
+    def add_sparse(self, sparse):
+        # Keys of the same size are ranked by name, so that the smallest entry
+        # is the largest name; e.g., of two the same size, ``a`` is kept
+        entry = (sparse['bytes'], _Reversed(sparse['key']), sparse)
+        heapq.heappush(self.sparse, entry)
+        if len(self.sparse) > self.top:
+            heapq.heappop(self.sparse)
+
+    def result(self):
+        top = self.top
+        events = sorted(self.groups.values(),
+                        key=lambda group: (-group['bytes'], group['event'], group['time_group']))
+        for group in events:
+            group['density'] = _density(group['bits'], group.pop('size'))
+
+        growing = [{'event': event_name, 'recent_bytes': recent, 'previous_bytes': previous}
+                   for event_name, (recent, previous) in self.growth.items() if recent > previous]
+        growing.sort(key=lambda event: (event['previous_bytes'] - event['recent_bytes'],
+                                        event['event']))
+        sparse = [entry[-1] for entry in sorted(self.sparse, reverse=True)]
+
+        return {
+            'events': events,
+            'total': {'keys': sum(group['keys'] for group in events),
+                      'bytes': sum(group['bytes'] for group in events)},
+            'sparse': sparse,
+            'growing': growing[:top],
+        }
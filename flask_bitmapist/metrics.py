@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~
+    Counters and histograms of marks, queries and the Redis commands they
+    send, for ``BITMAPIST_METRICS``, in the Prometheus text format.
+
+    While metrics are off, the instrumented functions only check
+    :data:`ENABLED`, and Redis clients are not wrapped at all.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+import redis
+from redis.client import Pipeline
+
+
+# Whether calls are timed and Redis commands counted
+ENABLED = False
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """
+    A count that only goes up, for each combination of label values.
+
+    :param str name: Metric name
+    :param str documentation: Help text
+    :param tuple labels: Label names
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def inc_many(self, amounts):
+        "Add several amounts at once, from a dict of label values to amount"
+        with self._lock:
+            for label_values, amount in amounts.items():
+                self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, _labels(self.labels, label_values), value)
+                for label_values, value in values]
+
+
+class Histogram(object):
+    """
+    Observations counted into cumulative buckets, with their sum and count,
+    for each combination of label values.
+
+    :param str name: Metric name
+    :param str documentation: Help text
+    :param tuple labels: Label names
+    :param tuple buckets: Upper bounds of the buckets, in ascending order
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # a count per bucket, then the sum of the observations
+                counts = self._values[label_values] = [0] * len(self.buckets) + [0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def get(self, *label_values):
+        "The number and sum of the observations"
+        counts = self._values.get(label_values)
+        return (sum(counts[:-1]), counts[-1]) if counts else (0, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((label_values, list(counts))
+                            for label_values, counts in self._values.items())
+        samples = []
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket',
+                                _labels(self.labels, label_values, [('le', _number(bound))]),
+                                cumulative))
+            samples.append((self.name + '_sum', _labels(self.labels, label_values), counts[-1]))
+            samples.append((self.name + '_count', _labels(self.labels, label_values),
+                            cumulative))
+        return samples
+
+
+REGISTRY = []
+
+CALL_SECONDS = Histogram('bitmapist_call_duration_seconds',
+                         'Time taken by marks and queries', ['operation'])
+CALL_COMMANDS = Histogram('bitmapist_call_redis_commands',
+                          'Redis commands sent by each mark or query', ['operation'],
+                          COUNT_BUCKETS)
+CALL_ROUND_TRIPS = Histogram('bitmapist_call_redis_round_trips',
+                             'Redis round-trips made by each mark or query', ['operation'],
+                             COUNT_BUCKETS)
+MARK_SECONDS = Histogram('bitmapist_mark_duration_seconds',
+                         'Time FlaskBitmapist.mark takes to write, buffer or queue a mark',
+                         ['event'])
+MARKS = Counter('bitmapist_marks_total', 'Events marked', ['event'])
+REDIS_COMMANDS = Counter('bitmapist_redis_commands_total', 'Redis commands sent')
+REDIS_ROUND_TRIPS = Counter('bitmapist_redis_round_trips_total', 'Redis round-trips made')
+TEMP_KEYS = Counter('bitmapist_temp_keys_total', 'Temporary keys queries created')
+TEMP_KEY_BYTES = Counter('bitmapist_temp_key_bytes_total',
+                         'Bytes temporary keys held when they were cleaned up')
+
+
+def render():
+    "Every metric, in the Prometheus text format"
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append('%s%s %s' % (name, labels, _number(value)))
+    return '\n'.join(lines) + '\n'
+
+
+# The calls being tracked in each thread, innermost last, with the Redis
+# commands and round-trips each has made so far
+_local = threading.local()
+
+
+class _Tracker(object):
+    def __init__(self, operation):
+        self.operation = operation
+        self.commands = 0
+        self.round_trips = 0
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        CALL_SECONDS.observe(time.time() - self.start, self.operation)
+        CALL_COMMANDS.observe(self.commands, self.operation)
+        CALL_ROUND_TRIPS.observe(self.round_trips, self.operation)
+        _local.stack.remove(self)
+
+
+class _MarkTimer(object):
+    def __init__(self, event_name):
+        self.event_name = event_name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        MARK_SECONDS.observe(time.time() - self.start, self.event_name)
+
+
+class _NotTracking(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NOT_TRACKING = _NotTracking()
+
+
+def track(operation):
+    """
+    Context manager timing a call and counting the Redis commands and
+    round-trips it makes; calls inside it are tracked as well, and count
+    towards it.
+    """
+    return _Tracker(operation) if ENABLED else _NOT_TRACKING
+
+
+def tracked(operation):
+    "Decorator tracking each call of a function; see :func:`track`"
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with _Tracker(operation):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def time_mark(event_name):
+    "Context manager timing a :meth:`~flask_bitmapist.FlaskBitmapist.mark` of an event"
+    return _MarkTimer(event_name) if ENABLED else _NOT_TRACKING
+
+
+def count_marks(marks):
+    "Count a batch of ``(event_name, uuid, now)`` marks by event"
+    counts = {}
+    for event_name, _, _ in marks:
+        counts[(event_name,)] = counts.get((event_name,), 0) + 1
+    MARKS.inc_many(counts)
+
+
+def count_temp_keys(sizes):
+    "Count temporary keys cleaned up, from the bytes each held"
+    TEMP_KEYS.inc(len(sizes))
+    TEMP_KEY_BYTES.inc(sum(sizes))
+
+
+def _count_commands(commands):
+    REDIS_COMMANDS.inc(commands)
+    REDIS_ROUND_TRIPS.inc()
+    for tracker in getattr(_local, 'stack', ()):
+        tracker.commands += commands
+        tracker.round_trips += 1
+
+
+class CountingPipeline(Pipeline):
+    "A pipeline counting its commands, and a round-trip per execution"
+
+    def execute(self, raise_on_error=True):
+        if self.command_stack:
+            _count_commands(len(self.command_stack))
+        return super(CountingPipeline, self).execute(raise_on_error)
+
+
+class CountingRedis(redis.Redis):
+    "A Redis client counting its commands, each a round-trip, and its pipelines'"
+
+    def execute_command(self, *args, **options):
+        _count_commands(1)
+        return super(CountingRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(self.connection_pool, self.response_callbacks, transaction,
+                                shard_hint)
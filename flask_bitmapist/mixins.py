@@ -8,28 +8,133 @@
     :license: MIT, see LICENSE for more details.
 """
 
+from datetime import datetime
+
 from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
 
-from bitmapist import mark_event
+from .core import _mark, _mark_events
+from .metrics import track
 
 
 class Bitmapistable(object):
-    """A mixin class to make a model Bitmapist-ready."""
+    """
+    A mixin class to make a model Bitmapist-ready.
+
+    Marks are not written while the session flushes; they are kept on the
+    session and written together in one pipeline once the transaction
+    commits, or thrown away if it rolls back.
+
+    Bulk ``query.update()`` and ``query.delete()`` calls are marked too, as
+    long as they use ``synchronize_session='fetch'``; it is the only strategy
+    that knows every row it touched. ``Session.bulk_save_objects()`` and the
+    other bulk mapping methods bypass ORM events and are not marked.
+    """
 
     @staticmethod
     def bitmapist_after_insert(mapper, connection, target):
-        mark_event('%s:created' % target.__class__.__name__.lower(), target.id)
+        _add_pending_mark(target, '%s:created' % target.__class__.__name__.lower())
 
     @staticmethod
     def bitmapist_before_update(mapper, connection, target):
-        mark_event('%s:updated' % target.__class__.__name__.lower(), target.id)
+        _add_pending_mark(target, '%s:updated' % target.__class__.__name__.lower())
 
     @staticmethod
     def bitmapist_before_delete(mapper, connection, target):
-        mark_event('%s:deleted' % target.__class__.__name__.lower(), target.id)
+        _add_pending_mark(target, '%s:deleted' % target.__class__.__name__.lower())
 
     @classmethod
     def __declare_last__(self):
         event.listen(self, 'after_insert', self.bitmapist_after_insert)
         event.listen(self, 'before_update', self.bitmapist_before_update)
         event.listen(self, 'before_delete', self.bitmapist_before_delete)
+
+        for name, fn in _session_listeners:
+            if not event.contains(Session, name, fn):
+                event.listen(Session, name, fn)
+
+
+def _add_pending_mark(target, event_name):
+    session = object_session(target)
+    if session is None:
+        with track('mixin_mark'):
+            return _mark(event_name, target.id)
+
+    pending = session.info.setdefault('bitmapist_marks', [])
+    pending.append((event_name, target.id, datetime.utcnow()))
+
+
+# Pending marks are kept in `session.info` as a flat list; each open SAVEPOINT
+# remembers how long that list was when it began, so that rolling it back
+# only discards the marks made inside it
+
+def _after_transaction_create(session, transaction):
+    if transaction.nested:
+        pending = session.info.setdefault('bitmapist_marks', [])
+        savepoints = session.info.setdefault('bitmapist_savepoints', [])
+        savepoints.append((transaction, len(pending)))
+
+
+def _after_bulk_update(update_context):
+    _add_pending_bulk_marks(update_context, 'updated')
+
+
+def _after_bulk_delete(delete_context):
+    _add_pending_bulk_marks(delete_context, 'deleted')
+
+
+def _add_pending_bulk_marks(context, action):
+    mapper = context.mapper
+    if mapper is None or not issubclass(mapper.class_, Bitmapistable):
+        return
+
+    rows = getattr(context, 'matched_rows', None)
+    if not rows:
+        return
+
+    event_name = '%s:%s' % (mapper.class_.__name__.lower(), action)
+    now = datetime.utcnow()
+
+    pending = context.session.info.setdefault('bitmapist_marks', [])
+    pending.extend([(event_name, row[0], now) for row in rows])
+
+
+def _after_commit(session):
+    # Releasing a SAVEPOINT; wait for the enclosing transaction
+    if session.transaction.nested:
+        return
+
+    pending = session.info.pop('bitmapist_marks', None)
+    if pending:
+        with track('mixin_mark'):
+            _mark_events(pending)
+
+
+def _after_rollback(session):
+    savepoints = session.info.get('bitmapist_savepoints')
+    if savepoints:
+        _, num_marks = savepoints.pop()
+        del session.info['bitmapist_marks'][num_marks:]
+    else:
+        session.info.pop('bitmapist_marks', None)
+
+
+def _after_transaction_end(session, transaction):
+    savepoints = session.info.get('bitmapist_savepoints')
+    if savepoints and savepoints[-1][0] is transaction:
+        savepoints.pop()
+
+    # The outermost transaction ended (its marks were written if it committed)
+    if session.transaction is None:
+        session.info.pop('bitmapist_marks', None)
+        session.info.pop('bitmapist_savepoints', None)
+
+
+_session_listeners = [
+    ('after_transaction_create', _after_transaction_create),
+    ('after_commit', _after_commit),
+    ('after_rollback', _after_rollback),
+    ('after_transaction_end', _after_transaction_end),
+    ('after_bulk_update', _after_bulk_update),
+    ('after_bulk_delete', _after_bulk_delete),
+]
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.retention
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+    How long each granularity's keys are kept, for ``BITMAPIST_RETENTION``.
+
+    A key expires a set number of days after its period ends, with
+    ``EXPIREAT``, so that the expiry is the same however many times it is
+    set. Marks set it on the keys they write, the first time each process
+    writes a key, and :func:`sweep` sets it on the keys already in Redis.
+    Queries report periods past their retention as :data:`EXPIRED`, rather
+    than counting what is left of them.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import calendar
+from datetime import datetime, timedelta
+
+from bitmapist import get_redis, iso_to_gregorian
+from dateutil.relativedelta import relativedelta
+
+from .cache import LRUCache
+
+
+TIME_GROUPS = ('hours', 'days', 'weeks', 'months', 'years')
+
+# Days each time group's keys are kept after their period ends, by time
+# group; time groups left out are kept forever
+RETENTION = {}
+
+# Keys each process has already set the expiry of; they only save repeating
+# the same EXPIREAT, so they may be forgotten any time
+EXPIRING = LRUCache(maxsize=100000, ttl=3600)
+
+
+class Expired(object):
+    """
+    Stands in for the data of a period past its retention, whose keys have
+    been or are about to be expired. It is falsy, and shown as ``expired``.
+    """
+
+    def __bool__(self):
+        return False
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return 'EXPIRED'
+
+    def __str__(self):
+        return 'expired'
+
+
+EXPIRED = Expired()
+
+
+def _plural(time_group):
+    return time_group if time_group.endswith('s') else time_group + 's'
+
+
+def period_end(date, time_group):
+    "When the period a date falls in ends"
+    time_group = _plural(time_group)
+    if time_group == 'hours':
+        return date.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    start = datetime(date.year, date.month, date.day)
+    if time_group == 'days':
+        return start + timedelta(days=1)
+    elif time_group == 'weeks':
+        return start + timedelta(days=7 - date.weekday())
+    elif time_group == 'months':
+        return datetime(date.year, date.month, 1) + relativedelta(months=1)
+    return datetime(date.year + 1, 1, 1)
+
+
+def expires_at(date, time_group):
+    "When the keys of the period a date falls in expire, or None if they are kept"
+    days = RETENTION.get(_plural(time_group))
+    if days is None:
+        return None
+    return period_end(date, time_group) + timedelta(days=days)
+
+
+def is_expired(date, time_group, now=None):
+    "Whether the period a date falls in is past its retention"
+    expires = expires_at(date, time_group)
+    return expires is not None and expires <= (now or datetime.utcnow())
+
+
+def expire_commands(periods, system='default'):
+    """
+    EXPIREAT commands for the keys of ``periods``, a dict of key to ``(date,
+    time group)``, leaving out the ones this process has already set. They
+    only apply once the keys exist, so they go after the writes.
+    """
+    commands = []
+    for key in sorted(periods):
+        expires = expires_at(*periods[key])
+        if expires is not None and EXPIRING.get((system, key)) is None:
+            EXPIRING.set((system, key), True)
+            commands.append(('EXPIREAT', key, calendar.timegm(expires.utctimetuple())))
+    return commands
+
+
+def parse_period(period):
+    """
+    The date and time group of a bitmapist period, as in its key names (e.g.,
+    ``2016-3-5-7``, ``2016-3-5``, ``W2016-9``, ``2016-3``); None for anything
+    else.
+    """
+    try:
+        if period.startswith('W'):
+            year, week = [int(part) for part in period[1:].split('-')]
+            start = iso_to_gregorian(year, week, 1)
+            return datetime(start.year, start.month, start.day), 'weeks'
+        parts = [int(part) for part in period.split('-')]
+    except ValueError:
+        return None
+    if len(parts) == 4:
+        return datetime(*parts), 'hours'
+    elif len(parts) == 3:
+        return datetime(*parts), 'days'
+    elif len(parts) == 2:
+        return datetime(parts[0], parts[1], 1), 'months'
+    elif len(parts) == 1:
+        return datetime(parts[0], 1, 1), 'years'
+
+
+def sweep(system='default', batch=10000, now=None):
+    """
+    Set the expiry of the event keys already in Redis, and of the event
+    catalog's sets for each period, scanning the keyspace once in batches of
+    ``batch`` keys. Keys past their retention are deleted.
+
+    :returns: Tuple of (keys deleted, keys set to expire)
+    """
+    from .catalog import CATALOG_PREFIX
+
+    now = now or datetime.utcnow()
+    cli = get_redis(system)
+    expired = expiring = 0
+    for match in ('trackist_*', CATALOG_PREFIX + '*'):
+        pipe = cli.pipeline(transaction=False)
+        for key in cli.scan_iter(match=match, count=batch):
+            key = key.decode() if isinstance(key, bytes) else key
+            if key.startswith('trackist_bitop_'):
+                continue
+            parsed = parse_period(key.rpartition('_' if match == 'trackist_*' else ':')[2])
+            expires = parsed and expires_at(*parsed)
+            if expires is None:
+                continue
+
+            pipe.expireat(key, calendar.timegm(expires.utctimetuple()))
+            if expires <= now:
+                expired += 1
+            else:
+                expiring += 1
+            if len(pipe.command_stack) >= batch:
+                pipe.execute()
+        pipe.execute()
+    return expired, expiring
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.roaring
+    ~~~~~~~~~~~~~~~~~~~~~~~
+    A compressed bitmap for sparse events, after Roaring bitmaps
+    (https://roaringbitmap.org): ids are split into chunks of 65536 by their
+    high 16 bits, and each chunk holding any ids is kept in the smallest of
+    three containers:
+
+    - an array container, a sorted ``array('H')`` of the low 16 bits, for
+      chunks of up to 4096 ids;
+    - a bitmap container, a 65536-bit int, for fuller chunks;
+    - a run container, a :class:`Runs` tuple of ``(start, length)`` pairs,
+      for chunks made of few long runs of consecutive ids.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import binascii
+import re
+from array import array
+from bisect import bisect_right
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+CHUNK_BITS = 1 << 16
+CHUNK_BYTES = CHUNK_BITS // 8
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Most ids an array container holds; past it, a bitmap container is smaller
+ARRAY_MAX = 4096
+
+# Reverses the bits of a byte; Redis numbers the bits of a byte from its
+# most significant one, while containers number them from the least
+REVERSE = bytes(bytearray(int('{0:08b}'.format(i)[::-1], 2) for i in range(256)))
+
+# Offsets of the bits set in a byte, in Redis's order
+_REDIS_OFFSETS = [[j for j in range(8) if i & (0x80 >> j)] for i in range(256)]
+_OFFSETS = [[j for j in range(8) if i & (1 << j)] for i in range(256)]
+
+_NONZERO = re.compile(b'[^\x00]+')
+
+
+def int_from_bytes(data):
+    "A little-endian int from bytes"
+    return int(binascii.hexlify(data[::-1]), 16) if data else 0
+
+
+def int_to_bytes(value, size):
+    "Little-endian bytes of an int"
+    return binascii.unhexlify('%0*x' % (size * 2, value))[::-1]
+
+
+def popcount(value):
+    return bin(value).count('1')
+
+
+class Runs(tuple):
+    "A run container: sorted ``(start, length)`` pairs"
+
+
+def _nonzero_bytes(data, start=0, end=None, block=4096):
+    """
+    Offsets of the nonzero bytes of a string, in ascending order; without
+    NumPy, blocks of zeros are skipped by comparing them with a zero block.
+    """
+    if np is not None:
+        return np.flatnonzero(np.frombuffer(data, dtype=np.uint8)).tolist()
+
+    end = len(data) if end is None else end
+    if block < 16:
+        buf = bytearray(data[start:end])
+        return [start + i for i, value in enumerate(buf) if value]
+
+    zeros = b'\x00' * block
+    offsets = []
+    for i in range(start, end, block):
+        if data[i:i + block] != zeros[:min(block, end - i)]:
+            offsets.extend(_nonzero_bytes(data, i, min(i + block, end), block // 16))
+    return offsets
+
+
+def _positions(value):
+    "Offsets of the bits set in an int, in ascending order"
+    data = bytearray(int_to_bytes(value, (value.bit_length() + 7) // 8))
+    positions = []
+    for match in _NONZERO.finditer(bytes(data)):
+        for i in range(match.start(), match.end()):
+            base = i * 8
+            positions.extend(base + j for j in _OFFSETS[data[i]])
+    return positions
+
+
+def _card(container):
+    if isinstance(container, Runs):
+        return sum(length for _, length in container)
+    if isinstance(container, array):
+        return len(container)
+    return popcount(container)
+
+
+def _to_int(container):
+    if isinstance(container, Runs):
+        value = 0
+        for start, length in container:
+            value |= ((1 << length) - 1) << start
+        return value
+    if isinstance(container, array):
+        data = bytearray(CHUNK_BYTES)
+        for low in container:
+            data[low >> 3] |= 1 << (low & 7)
+        return int_from_bytes(bytes(data))
+    return container
+
+
+def _contains(container, low):
+    if isinstance(container, Runs):
+        i = bisect_right(container, (low, CHUNK_BITS)) - 1
+        return i >= 0 and low < container[i][0] + container[i][1]
+    if isinstance(container, array):
+        i = bisect_right(container, low) - 1
+        return i >= 0 and container[i] == low
+    return bool(container >> low & 1)
+
+
+def _runs(lows):
+    runs = []
+    for low in lows:
+        if runs and runs[-1][0] + runs[-1][1] == low:
+            runs[-1][1] += 1
+        else:
+            runs.append([low, 1])
+    return Runs((start, length) for start, length in runs)
+
+
+def _optimize(container):
+    """
+    The smallest container for a chunk, or None if it is empty; a run takes
+    4 bytes, an id in an array 2, and a bitmap container 8192 bytes.
+    """
+    if isinstance(container, Runs):
+        container = _to_int(container)
+
+    if isinstance(container, array):
+        if not container:
+            return None
+        runs = 1 + sum(1 for a, b in zip(container, container[1:]) if b != a + 1)
+        return _runs(container) if runs * 4 < len(container) * 2 else container
+
+    card = popcount(container)
+    if not card:
+        return None
+    if card <= ARRAY_MAX:
+        return array('H', _positions(container))
+
+    # Runs start at bits set whose lower neighbour is not
+    starts = container & ~(container << 1)
+    if popcount(starts) * 4 < CHUNK_BYTES:
+        return _runs(_positions(container))
+    return container
+
+
+def _container_op(op_name, a, b):
+    "Run an operation over two containers; returns None for an empty result"
+    if isinstance(a, array) and isinstance(b, array):
+        if op_name == 'AND':
+            lows = set(a).intersection(b)
+        elif op_name == 'OR':
+            lows = set(a).union(b)
+        elif op_name == 'XOR':
+            lows = set(a).symmetric_difference(b)
+        elif op_name == 'ANDNOT':
+            lows = set(a).difference(b)
+        if len(lows) > ARRAY_MAX:
+            return _optimize(_to_int(array('H', lows)))
+        return _optimize(array('H', sorted(lows)))
+
+    if op_name in ('AND', 'ANDNOT') and isinstance(a, array):
+        keep = op_name == 'AND'
+        return _optimize(array('H', [low for low in a if _contains(b, low) == keep]))
+    if op_name == 'AND' and isinstance(b, array):
+        return _optimize(array('H', [low for low in b if _contains(a, low)]))
+
+    a, b = _to_int(a), _to_int(b)
+    if op_name == 'AND':
+        return _optimize(a & b)
+    elif op_name == 'OR':
+        return _optimize(a | b)
+    elif op_name == 'XOR':
+        return _optimize(a ^ b)
+    elif op_name == 'ANDNOT':
+        return _optimize(a & ~b)
+
+
+class RoaringBitmap(object):
+    """
+    A compressed bitmap taking memory in proportion to the ids it holds,
+    rather than to the highest of them.
+
+    :param dict containers: Containers by the high 16 bits of their ids
+    """
+
+    def __init__(self, containers=None):
+        self.containers = containers or {}
+
+    @classmethod
+    def from_bytes(cls, data):
+        "Decode a Redis string; only its nonzero bytes are looked at"
+        offsets = {}
+        for i in _nonzero_bytes(data):
+            offsets.setdefault(i // CHUNK_BYTES, []).append(i)
+
+        containers = {}
+        for high, chunk_offsets in offsets.items():
+            start = high * CHUNK_BYTES
+            if len(chunk_offsets) > ARRAY_MAX // 8:
+                # Possibly too many ids for an array
+                chunk = data[start:start + CHUNK_BYTES].translate(REVERSE)
+                containers[high] = _optimize(int_from_bytes(chunk))
+                continue
+
+            buf = bytearray(data[start:start + CHUNK_BYTES])
+            lows = []
+            for i in chunk_offsets:
+                i -= start
+                lows.extend(i * 8 + j for j in _REDIS_OFFSETS[buf[i]])
+            containers[high] = _optimize(array('H', lows))
+        return cls(containers)
+
+    def __len__(self):
+        return self.count()
+
+    def __contains__(self, uuid):
+        high, low = divmod(uuid, CHUNK_BITS)
+        return high in self.containers and _contains(self.containers[high], low)
+
+    def count(self):
+        return sum(_card(container) for container in self.containers.values())
+
+    def bitop(self, op_name, other):
+        "Run ``AND``, ``OR``, ``XOR`` or ``ANDNOT`` with another roaring bitmap"
+        if op_name == 'AND':
+            highs = set(self.containers) & set(other.containers)
+        elif op_name == 'ANDNOT':
+            highs = set(self.containers)
+        else:
+            highs = set(self.containers) | set(other.containers)
+
+        containers = {}
+        for high in highs:
+            a = self.containers.get(high)
+            b = other.containers.get(high)
+            if a is None or b is None:
+                # OR and XOR with nothing, or ANDNOT nothing, keep what is there
+                result = b if a is None else a
+            else:
+                result = _container_op(op_name, a, b)
+            if result is not None:
+                containers[high] = result
+        return RoaringBitmap(containers)
+
+    def bitop_chunks(self, op_name, chunk):
+        """
+        Run ``AND`` or ``ANDNOT`` with a dense bitmap, given as a function
+        returning each of its chunks as an int; only the chunks this bitmap
+        has ids in are looked at.
+        """
+        containers = {}
+        for high, container in self.containers.items():
+            result = _container_op(op_name, container, chunk(high))
+            if result is not None:
+                containers[high] = result
+        return RoaringBitmap(containers)
+
+    def ids(self):
+        "The ids held, in ascending order"
+        ids = []
+        for high in sorted(self.containers):
+            container = self.containers[high]
+            base = high * CHUNK_BITS
+            if isinstance(container, Runs):
+                for start, length in container:
+                    ids.extend(range(base + start, base + start + length))
+            elif isinstance(container, array):
+                ids.extend(base + low for low in container)
+            else:
+                ids.extend(base + low for low in _positions(container))
+        return ids
+
+    def to_int(self):
+        "The ids as an int with their bits set"
+        value = 0
+        for high, container in self.containers.items():
+            value |= _to_int(container) << (high * CHUNK_BITS)
+        return value
+
+    def to_bytes(self):
+        "The ids as a Redis string"
+        if not self.containers:
+            return b''
+        data = bytearray((max(self.containers) + 1) * CHUNK_BYTES)
+        for high, container in self.containers.items():
+            start = high * CHUNK_BYTES
+            data[start:start + CHUNK_BYTES] = int_to_bytes(_to_int(container),
+                                                           CHUNK_BYTES).translate(REVERSE)
+        return bytes(data)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.rollup
+    ~~~~~~~~~~~~~~~~~~~~~~
+    Week and month bitmaps rolled up from days, for ``BITMAPIST_ROLLUP_MODE``.
+
+    In rollup mode, a mark in the current week or month only sets its day
+    (and hour) bit. Once a week or month has ended, :func:`rollup` ORs its
+    days into bitmapist's own key for it, and notes that it has. Until then,
+    the period is read from a key ORed together from its days on demand,
+    which each process reuses for ``ROLLUP_TTL`` seconds.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+from datetime import datetime, timedelta
+
+from bitmapist import DayEvents, MonthEvents, WeekEvents, get_redis
+from dateutil.relativedelta import relativedelta
+
+from . import retention as _retention
+from .cache import LRUCache
+from .tempkeys import TempBitOp
+
+
+ROLLUP_PREFIX = 'flask_bitmapist:rollup:'
+
+# Set of the periods that have been rolled up, e.g. ``weeks:W2016-3``
+PERIODS_KEY = ROLLUP_PREFIX + 'periods'
+
+# Seconds a process reuses a period's bitmap built from its days; marks made
+# since it was built are not counted until it is built again
+ROLLUP_TTL = 60
+
+TIME_GROUPS = ('weeks', 'months')
+
+_EVENTS = {'weeks': WeekEvents, 'months': MonthEvents}
+
+# Keys this process has built, and the periods each system has rolled up
+BUILT = LRUCache(maxsize=10000)
+ROLLED_UP = LRUCache(maxsize=100, ttl=60)
+
+
+def _plural(time_group):
+    return time_group if time_group.endswith('s') else time_group + 's'
+
+
+def period_name(date, time_group):
+    "Name of the period a date falls in, as noted once it is rolled up"
+    if _plural(time_group) == 'weeks':
+        year, week, _ = date.isocalendar()
+        return 'weeks:W%s-%s' % (year, week)
+    return 'months:%s-%s' % (date.year, date.month)
+
+
+def is_open(date, time_group, now=None):
+    "Whether a date falls in the current week or month (never for other time groups)"
+    time_group = _plural(time_group)
+    if time_group not in TIME_GROUPS:
+        return False
+    start = _EVENTS[time_group].from_date('', date).period_start()
+    return start == _EVENTS[time_group].from_date('', now or datetime.utcnow()).period_start()
+
+
+def period_days(date, time_group):
+    "The days of the week or month a date falls in"
+    events = _EVENTS[_plural(time_group)].from_date('', date)
+    day, end = events.period_start(), events.period_end()
+    days = []
+    while day <= end:
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def _day_keys(event_name, date, time_group):
+    return [DayEvents.from_date(event_name, day).redis_key
+            for day in period_days(date, time_group)]
+
+
+def resolve(event_name, date, time_group, rolled_up, now=None):
+    """
+    The key to read an event's week or month from, and the day keys to build
+    it from; None instead of day keys means bitmapist's own key is read, as
+    the period has been rolled up or is still to come.
+
+    :param set rolled_up: Names of the periods that have been rolled up
+    """
+    time_group = _plural(time_group)
+    now = now or datetime.utcnow()
+    key = _EVENTS[time_group].from_date(event_name, date).redis_key
+    start = _EVENTS[time_group].from_date('', date).period_start()
+    current = _EVENTS[time_group].from_date('', now).period_start()
+    if start > current or (start < current and period_name(date, time_group) in rolled_up):
+        return key, None
+    return ROLLUP_PREFIX + key, _day_keys(event_name, date, time_group)
+
+
+def rolled_up_periods(system='default'):
+    "Names of the periods that have been rolled up, cached for a minute"
+    periods = ROLLED_UP.get(system)
+    if periods is None:
+        periods = set(name.decode() if isinstance(name, bytes) else name
+                      for name in get_redis(system).smembers(PERIODS_KEY))
+        ROLLED_UP.set(system, periods)
+    return periods
+
+
+def get_events(event_name, date, system='default', time_group='weeks'):
+    """
+    An event's collection for the week or month a date falls in: bitmapist's
+    own, once the period has been rolled up, or one ORed together from its
+    days otherwise.
+    """
+    key, day_keys = resolve(event_name, date, time_group, rolled_up_periods(system))
+    if day_keys is None:
+        return _EVENTS[_plural(time_group)].from_date(event_name, date, system)
+
+    if BUILT.get((system, key)) is None:
+        pipe = get_redis(system).pipeline(transaction=False)
+        pipe.bitop('OR', key, *day_keys)
+        # Outlives this process's use of it, so it is never read once expired
+        pipe.expire(key, ROLLUP_TTL * 2)
+        pipe.execute()
+        BUILT.set((system, key), True, ttl=ROLLUP_TTL)
+    return TempBitOp(key, system)
+
+
+def rollup(event_names, system='default', periods=2, now=None, force=False):
+    """
+    Roll up the last ``periods`` weeks and months that have ended: OR each
+    event's days into bitmapist's key for the period, then note that the
+    period has been rolled up. Periods already rolled up are skipped, unless
+    ``force`` is set. A period's existing key is ORed in as well, so bits
+    whose days have since expired are kept, and keys under retention get
+    their expiry in the same pipeline.
+
+    :param list event_names: Names of events to roll up
+    :returns: Names of the periods rolled up
+    """
+    now = now or datetime.utcnow()
+    cli = get_redis(system)
+    done = set(name.decode() if isinstance(name, bytes) else name
+               for name in cli.smembers(PERIODS_KEY))
+
+    rolled_up = []
+    for time_group in TIME_GROUPS:
+        for i in range(1, periods + 1):
+            date = now - relativedelta(**{time_group: i})
+            name = period_name(date, time_group)
+            if name in done and not force:
+                continue
+
+            pipe = cli.pipeline(transaction=False)
+            keys = {}
+            for event_name in event_names:
+                key = _EVENTS[time_group].from_date(event_name, date).redis_key
+                pipe.bitop('OR', key, key, *_day_keys(event_name, date, time_group))
+                keys[key] = (date, time_group)
+            for command in _retention.expire_commands(keys, system):
+                pipe.execute_command(*command)
+            pipe.sadd(PERIODS_KEY, name)
+            pipe.execute()
+            rolled_up.append(name)
+
+    ROLLED_UP.delete(system)
+    return rolled_up
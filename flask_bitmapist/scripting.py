@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.scripting
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+    Server-side Lua scripts for bitmapist.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import calendar
+import json
+from datetime import datetime
+
+from bitmapist import get_redis
+
+
+# Largest number of marks sent in a single script call
+SCRIPT_BATCH_SIZE = 1000
+
+# Civil date helpers for Lua, after Howard Hinnant's `days_from_civil` and
+# `civil_from_days` (http://howardhinnant.github.io/date_algorithms.html)
+LUA_DATES = """
+local function days_from_civil(y, m, d)
+    if m <= 2 then y = y - 1 end
+    local era = math.floor(y / 400)
+    local yoe = y - era * 400
+    local mp = m > 2 and m - 3 or m + 9
+    local doy = math.floor((153 * mp + 2) / 5) + d - 1
+    local doe = yoe * 365 + math.floor(yoe / 4) - math.floor(yoe / 100) + doy
+    return era * 146097 + doe - 719468
+end
+
+local function civil_from_days(z)
+    z = z + 719468
+    local era = math.floor(z / 146097)
+    local doe = z - era * 146097
+    local yoe = math.floor((doe - math.floor(doe / 1460) + math.floor(doe / 36524)
+                            - math.floor(doe / 146096)) / 365)
+    local doy = doe - (365 * yoe + math.floor(yoe / 4) - math.floor(yoe / 100))
+    local mp = math.floor((5 * doy + 2) / 153)
+    local d = doy - math.floor((153 * mp + 2) / 5) + 1
+    local m = mp < 10 and mp + 3 or mp - 9
+    local y = yoe + era * 400
+    if m <= 2 then y = y + 1 end
+    return y, m, d
+end
+
+-- ISO 8601 year and week number of a day (days since the epoch)
+local function iso_week(days)
+    local thursday = days - (days + 3) % 7 + 3
+    local year = civil_from_days(thursday)
+    return year, math.floor((thursday - days_from_civil(year, 1, 1)) / 7) + 1
+end
+"""
+
+# ARGV: an (event name, uuid, UTC unix timestamp, granularities) quadruple for
+# every mark, where the granularities are the keys to write (any of "M", "W",
+# "D" and "H"). Key names match the ones built by bitmapist's MonthEvents,
+# WeekEvents, DayEvents and HourEvents.
+#
+# The script builds the names of the keys it writes itself, so they are not
+# declared in KEYS. That is fine on a single Redis instance (and its
+# replicas), but Redis Cluster cannot route the call, nor check that its keys
+# share a slot, so the script engine is for single instances only.
+MARK_SCRIPT = LUA_DATES + """
+for i = 1, #ARGV, 4 do
+    local uuid = ARGV[i + 1]
+    local ts = tonumber(ARGV[i + 2])
+    local granularities = ARGV[i + 3]
+    local days = math.floor(ts / 86400)
+    local y, m, d = civil_from_days(days)
+    local prefix = 'trackist_' .. ARGV[i] .. '_'
+
+    if string.find(granularities, 'M', 1, true) then
+        redis.call('SETBIT', prefix .. y .. '-' .. m, uuid, 1)
+    end
+    if string.find(granularities, 'W', 1, true) then
+        local wy, w = iso_week(days)
+        redis.call('SETBIT', prefix .. 'W' .. wy .. '-' .. w, uuid, 1)
+    end
+    if string.find(granularities, 'D', 1, true) then
+        redis.call('SETBIT', prefix .. y .. '-' .. m .. '-' .. d, uuid, 1)
+    end
+    if string.find(granularities, 'H', 1, true) then
+        local h = math.floor((ts % 86400) / 3600)
+        redis.call('SETBIT', prefix .. y .. '-' .. m .. '-' .. d .. '-' .. h, uuid, 1)
+    end
+end
+
+return #ARGV / 4
+"""
+
+# Prefix for the keys the cohort script works in; they are deleted before the
+# script returns, so they are never seen outside of it
+COHORT_SCRIPT_PREFIX = 'flask_bitmapist:cohort:'
+
+# Largest number of cohort rows computed in a single script call. A script
+# holds up every other client while it runs, so larger cohorts are split into
+# several calls, sent in one pipeline, each building the chains its rows use
+COHORT_SCRIPT_ROWS = 10
+
+# ARGV[1]: a JSON cohort spec (see `get_cohort_script`). Each operand is a list
+# of keys OR'd together, so that a year can be passed as its twelve months.
+# Returns a `{primary total, {cell counts}}` pair per row, with -1 standing in
+# for cells that are left empty.
+#
+# Like the mark script, it reads and writes keys it does not declare in KEYS
+# (the event keys come in the spec, and the working keys are built from its
+# prefix), so it only runs on a single Redis instance, not Redis Cluster.
+COHORT_SCRIPT = """
+local spec = cjson.decode(ARGV[1])
+local prefix = spec.prefix
+local operand = prefix .. 'operand'
+local primary = prefix .. 'primary'
+local cell = prefix .. 'cell'
+local temp = {operand, primary, cell}
+
+local function union(dest, keys)
+    if #keys == 1 then return keys[1] end
+    redis.call('BITOP', 'OR', dest, unpack(keys))
+    return dest
+end
+
+-- The secondary event's chain for each distinct period, or false when the
+-- secondary event has nothing marked
+local chains = {}
+for p, chain in ipairs(spec.chains) do
+    local dest = prefix .. 'chain:' .. p
+    temp[#temp + 1] = dest
+    local result = union(dest, chain.base)
+    if redis.call('EXISTS', result) == 0 then
+        chains[p] = false
+    else
+        for _, step in ipairs(chain.steps) do
+            redis.call('BITOP', step.op, dest, result, union(operand, step.keys))
+            result = dest
+        end
+        chains[p] = result
+    end
+end
+
+local rows = {}
+for i, row in ipairs(spec.rows) do
+    local remaining = union(primary, row.primary)
+    local total = row.total or redis.call('BITCOUNT', remaining)
+    local counts = {}
+    for j, p in ipairs(row.cells) do
+        -- A negative index is a cell whose count is already known
+        local known = p < 0
+        p = math.abs(p)
+        if total == 0 or p == 0 then
+            counts[j] = -1
+        elseif not chains[p] then
+            counts[j] = 0
+        else
+            redis.call('BITOP', 'AND', cell, chains[p], remaining)
+            counts[j] = known and -1 or redis.call('BITCOUNT', cell)
+            if not spec.with_replacement then
+                redis.call('BITOP', 'XOR', primary, remaining, cell)
+                remaining = primary
+            end
+        end
+    end
+    rows[i] = {total, counts}
+end
+
+for i = 1, #temp, 1000 do
+    redis.call('DEL', unpack(temp, i, math.min(i + 999, #temp)))
+end
+return rows
+"""
+
+# KEYS: the id map's forward hash, reverse hash and counter (see
+# `flask_bitmapist.idmap`); ARGV: external ids. Returns the id of each,
+# assigning the next ones to ids that have none.
+ASSIGN_IDS_SCRIPT = """
+local ids = {}
+for i, external in ipairs(ARGV) do
+    local id = redis.call('HGET', KEYS[1], external)
+    if not id then
+        id = redis.call('INCR', KEYS[3]) - 1
+        redis.call('HSET', KEYS[1], external, id)
+        redis.call('HSET', KEYS[2], id, external)
+    end
+    ids[i] = tonumber(id)
+end
+return ids
+"""
+
+_scripts = {}
+
+
+def _get_script(source, system='default'):
+    "Register a script once per system; redis-py sends it with SCRIPT LOAD and runs it via EVALSHA"
+    key = (source, system)
+    if key not in _scripts:
+        _scripts[key] = get_redis(system).register_script(source)
+    return _scripts[key]
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+def mark_events_script(marks, system='default', track_hourly=False, granularities=None,
+                       commands=()):
+    """
+    Mark several events with the server-side mark script; each call derives
+    every period key for its marks in Redis and sets all of their bits
+    atomically. The keys are not declared to Redis, so this only works
+    against a single instance, not Redis Cluster (see ``MARK_SCRIPT``).
+    Batches of more than ``SCRIPT_BATCH_SIZE`` marks, or marks with
+    ``commands`` to follow them, are sent in a single pipeline.
+
+    :param list marks: List of ``(event_name, uuid, now)`` tuples; ``now`` may
+                       be None to use the current time
+    :param str system: Which bitmapist should be used
+    :param bool track_hourly: Whether hourly stats should be tracked
+    :param list granularities: The granularities each mark writes (see
+                               ``MARK_SCRIPT``), overriding ``track_hourly``
+    :param list commands: Commands to send once the bits are set
+    :returns: Number of marks written
+    """
+    script = _get_script(MARK_SCRIPT, system)
+    if granularities is None:
+        granularities = ['MWDH' if track_hourly else 'MWD'] * len(marks)
+
+    args = []
+    for (event_name, uuid, now), mark_granularities in zip(marks, granularities):
+        args.extend((event_name, uuid, _timestamp(now or datetime.utcnow()),
+                     mark_granularities))
+
+    if len(marks) <= SCRIPT_BATCH_SIZE and not commands:
+        return script(args=args)
+
+    pipe = get_redis(system).pipeline()
+    for i in range(0, len(args), SCRIPT_BATCH_SIZE * 4):
+        script(args=args[i:i + SCRIPT_BATCH_SIZE * 4], client=pipe)
+    batches = len(pipe.command_stack)
+    for command in commands:
+        pipe.execute_command(*command)
+    return sum(pipe.execute()[:batches])
+
+
+def _cohort_batches(spec):
+    "Split a cohort spec into specs of up to ``COHORT_SCRIPT_ROWS`` rows and the chains they use"
+    rows = spec['rows']
+    for i in range(0, len(rows), COHORT_SCRIPT_ROWS):
+        chains = []
+        index = {}  # of each chain used in the batch, by its index in the spec
+        batch = []
+        for row in rows[i:i + COHORT_SCRIPT_ROWS]:
+            cells = []
+            for p in row['cells']:
+                if p and abs(p) not in index:
+                    chains.append(spec['chains'][abs(p) - 1])
+                    index[abs(p)] = len(chains)
+                cells.append(index[p] if p > 0 else -index[-p] if p < 0 else 0)
+            batch.append(dict(row, cells=cells))
+        yield dict(spec, chains=chains, rows=batch)
+
+
+def get_cohort_script(spec, system='default'):
+    """
+    Compute a whole cohort with the server-side cohort script, in a single
+    round-trip and without leaving any keys behind. Cohorts of more than
+    ``COHORT_SCRIPT_ROWS`` rows take several script calls, so that none of
+    them holds up other clients for long. The keys are not declared to
+    Redis, so this only works against a single instance, not Redis Cluster.
+
+    :param dict spec: ``with_replacement``; ``chains``, a list of ``{'base':
+                      keys, 'steps': [{'op': 'AND' or 'OR', 'keys': keys}]}``
+                      secondary event chains; and ``rows``, a list of
+                      ``{'primary': keys, 'cells': [chain index]}`` rows,
+                      where chain indexes start at 1 and 0 leaves a cell empty;
+                      a row may also give its known primary event ``total``,
+                      and a negative chain index marks a cell whose count is
+                      known, so it is only taken out of the primary event
+    :param str system: Which bitmapist should be used
+    :returns: Tuple of (list of lists of cohort results, primary event total
+              for each row)
+    """
+    script = _get_script(COHORT_SCRIPT, system)
+    batches = [json.dumps(dict(batch, prefix=COHORT_SCRIPT_PREFIX))
+               for batch in _cohort_batches(spec)]
+    if len(batches) <= 1:
+        rows = [row for batch in batches for row in script(args=[batch])]
+    else:
+        pipe = get_redis(system).pipeline(transaction=False)
+        for batch in batches:
+            script(args=[batch], client=pipe)
+        rows = [row for batch_rows in pipe.execute() for row in batch_rows]
+
+    cohort = [[count if count >= 0 else None for count in counts] for _, counts in rows]
+    return cohort, [total for total, _ in rows]
+
+
+def assign_ids_script(keys, external_ids, system='default'):
+    """
+    Look up the ids of several external ids with the server-side assign
+    script, atomically assigning the next ones to those that have none.
+
+    :param list keys: The forward hash, reverse hash and counter keys
+    :param list external_ids: External ids, as strings
+    :returns: List of ids, in the same order
+    """
+    script = _get_script(ASSIGN_IDS_SCRIPT, system)
+    if len(external_ids) <= SCRIPT_BATCH_SIZE:
+        return script(keys=keys, args=external_ids)
+
+    pipe = get_redis(system).pipeline()
+    for i in range(0, len(external_ids), SCRIPT_BATCH_SIZE):
+        script(keys=keys, args=external_ids[i:i + SCRIPT_BATCH_SIZE], client=pipe)
+    return [id for ids in pipe.execute() for id in ids]
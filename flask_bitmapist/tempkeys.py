@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.tempkeys
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+    Temporary keys for the intermediate results of a query.
+
+    Unlike bitmapist's ``trackist_bitop_`` keys, which are named after their
+    operands and so shared by every query computing the same operation, each
+    query writes its keys under a namespace of its own, and deletes only
+    those. Every key expires after ``TEMP_KEY_TTL`` seconds on the server as
+    well, so a query that never gets to clean up does not leave it behind.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import logging
+from uuid import uuid4
+
+from bitmapist import BitOperation, get_redis
+
+from . import metrics as _metrics
+
+
+logger = logging.getLogger(__name__)
+
+TEMP_KEY_PREFIX = 'flask_bitmapist:tmp:'
+
+# Seconds a temporary key lives on the server; it should be longer than the
+# slowest query takes
+TEMP_KEY_TTL = 60
+
+
+class TempBitOp(BitOperation):
+    """
+    The result of a ``BITOP`` held in a temporary key; it supports the same
+    queries as bitmapist's ``BitOpAnd``/``BitOpOr``/``BitOpXor``.
+    """
+
+    def __init__(self, redis_key, system='default'):
+        self.system = system
+        self.redis_key = redis_key
+
+
+class TempKeys(object):
+    """
+    The temporary keys of a single query. Operations repeated within the
+    query reuse the key of their first result.
+
+    Can be used as a context manager, cleaning up on exit::
+
+        with TempKeys() as temp_keys:
+            active = temp_keys.bitop('AND', DayEvents('active'), DayEvents('paid'))
+            count = len(active)
+
+    :param str system: Which bitmapist should be used
+    :param int ttl: Seconds each key lives on the server; defaults to
+                    ``TEMP_KEY_TTL``
+    """
+
+    def __init__(self, system='default', ttl=None):
+        self.system = system
+        self.ttl = TEMP_KEY_TTL if ttl is None else ttl
+        self.namespace = '%s%s:' % (TEMP_KEY_PREFIX, uuid4().hex)
+
+        self.keys = []
+        self._bitops = {}
+
+        # Keys created and the bytes they held when they were cleaned up, over
+        # the life of the query
+        self.created = 0
+        self.memory = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+    def key(self, name=None):
+        "A key in this query's namespace; the caller sets its expiry"
+        key = '%s%s' % (self.namespace, self.created if name is None else name)
+        if key not in self.keys:
+            self.keys.append(key)
+            self.created += 1
+        return key
+
+    def bitop_key(self, op_name, keys):
+        """
+        The key for the result of an operation over keys, and whether it is a
+        new one (rather than one already holding the result).
+        """
+        operation = (op_name, tuple(keys))
+        if operation in self._bitops:
+            return self._bitops[operation], False
+        key = self._bitops[operation] = self.key()
+        return key, True
+
+    def bitop(self, op_name, *events):
+        "Run ``BITOP`` over events, with the result held in a temporary key"
+        keys = [event.redis_key for event in events]
+        key, created = self.bitop_key(op_name, keys)
+        if created:
+            pipe = get_redis(self.system).pipeline(transaction=False)
+            pipe.bitop(op_name, key, *keys)
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        return TempBitOp(key, self.system)
+
+    def cleanup(self, pipe=None):
+        """
+        Delete this query's keys, noting how much memory they held; with a
+        pipeline, the commands are added to it and a function taking its
+        results is returned instead.
+        """
+        if not self.keys:
+            return lambda results: None
+
+        execute = pipe is None
+        if execute:
+            pipe = get_redis(self.system).pipeline(transaction=False)
+        start = len(pipe.command_stack)
+        for key in self.keys:
+            pipe.strlen(key)
+        pipe.delete(*self.keys)
+
+        def finish(results):
+            self.record(results[start:start + len(self.keys)])
+
+        if execute:
+            return finish(pipe.execute())
+        return finish
+
+    def record(self, sizes):
+        "Note the sizes of the keys, in bytes, once they have been deleted"
+        self.memory += sum(sizes)
+        if _metrics.ENABLED:
+            _metrics.count_temp_keys(sizes)
+        logger.debug('Cleaned up %s temporary keys holding %s bytes', len(self.keys), sum(sizes))
+        self.keys = []
+        self._bitops = {}
+
+    def stats(self):
+        "How many keys the query created, and the bytes they held"
+        return {'keys': self.created, 'bytes': self.memory}
@@ -9,21 +9,330 @@
 
 """
 
+import hashlib
+import json
+import os
+import threading
 from datetime import datetime
-from urlparse import urlparse
+from functools import partial
 
+import redis
 from dateutil.relativedelta import relativedelta
 
-from bitmapist import (DayEvents, WeekEvents, MonthEvents, YearEvents,
-                       BitOpAnd, BitOpOr, BitOpXor, delete_runtime_bitop_keys)
+import bitmapist as _bitmapist
+from bitmapist import (HourEvents, DayEvents, WeekEvents, MonthEvents, YearEvents,
+                       get_redis)
 
+from ._compat import string_types, urlparse
+from . import (catalog as _catalog, metrics as _metrics, retention as _retention,
+               rollup as _rollup)
+from .cache import LRUCache, version_ttl as _version_ttl
+from .catalog import period_id as _period_id
+from .idmap import MappedEvents
+from .local import (bitop as _local_bitop, chain as _local_chain, fetch as _local_fetch,
+                    get_cohort_local)
+from .scripting import get_cohort_script, mark_events_script
+from .tempkeys import TempKeys
 
-def _get_redis_connection(redis_url=None):
-    url = urlparse(redis_url)
-    return url.hostname, url.port
 
+# Connection options that only apply to TCP connections
+_TCP_OPTIONS = ('socket_connect_timeout', 'socket_keepalive')
 
-def get_event_data(event_name, time_group='days', now=None, system='default'):
+
+def _connection_options(redis_url, **options):
+    """
+    Options that are None are left out, so that redis-py's own defaults apply
+    and options unknown to older redis-py versions are never passed along.
+    """
+    options = dict((k, v) for k, v in options.items() if v is not None)
+    if urlparse(redis_url).scheme == 'unix':
+        for name in _TCP_OPTIONS:
+            options.pop(name, None)
+    return options
+
+
+class _ProcessConnectionPool(redis.ConnectionPool):
+    """
+    A connection pool owned by a single process: after a fork (e.g., gunicorn
+    workers of a preloaded app), the first command the child sends from any
+    path (a request, a CLI command, the mark worker) starts it over without
+    the parent's connections. They are kept referenced rather than
+    disconnected, since that would shut down the sockets the parent is still
+    using.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_ProcessConnectionPool, self).__init__(*args, **kwargs)
+        self.inherited = []
+        self._fork_lock = threading.Lock()
+
+    def get_connection(self, command_name, *keys, **options):
+        if self.pid != os.getpid():
+            with self._fork_lock:
+                if self.pid != os.getpid():
+                    self.inherited.append((self._available_connections,
+                                           self._in_use_connections))
+                    self.reset()
+        return super(_ProcessConnectionPool, self).get_connection(command_name, *keys,
+                                                                  **options)
+
+
+def _get_connection_pool(redis_url, **options):
+    """
+    Build a connection pool from a full ``redis://``, ``rediss://`` or
+    ``unix://`` URL, keeping its db index and password.
+    """
+    return _ProcessConnectionPool.from_url(redis_url,
+                                           **_connection_options(redis_url, **options))
+
+
+# How mark_events writes marks: 'pipeline' sends SETBIT/BITFIELD commands
+# from here, while 'script' has the server-side mark script set every bit
+MARK_ENGINES = ('pipeline', 'script')
+MARK_ENGINE = 'pipeline'
+
+# Largest number of SET operations sent in a single BITFIELD command
+BITFIELD_CHUNK_SIZE = 4096
+
+# How get_cohort computes a cohort: 'bitop' runs a BITOP/BITCOUNT command per
+# step from here, 'script' has the cohort script compute the whole matrix in
+# one call, and 'local' fetches every bitmap once and computes it in-process
+COHORT_ENGINES = ('bitop', 'script', 'local')
+COHORT_ENGINE = 'bitop'
+
+# Cache of cohort results from periods that have ended (a
+# `flask_bitmapist.cache.CohortCache`), or None to always compute them
+COHORT_CACHE = None
+
+# Whether marks keep the event catalog (see `flask_bitmapist.catalog`) up to
+# date, and event names and existence checks are read from it
+EVENT_CATALOG = False
+
+# Whether marks in the current week or month only write their day (and hour)
+# keys, with weeks and months rolled up from days (see
+# `flask_bitmapist.rollup`)
+ROLLUP_MODE = False
+
+# Map of external ids to the compact ids marks set (a
+# `flask_bitmapist.idmap.IdMap`), or None to set external ids' bits directly
+ID_MAP = None
+
+# Prefix for the per-event, per-period counters that back-dated marks bump
+VERSION_KEY_PREFIX = 'flask_bitmapist:version:'
+
+# Event counts that chain_events orders events by; they only decide the order,
+# so they may be a little out of date
+CARDINALITY_CACHE = LRUCache(maxsize=10000, ttl=60)
+
+
+@_metrics.tracked('mark')
+def mark_events(marks, system='default', track_hourly=None, engine=None):
+    """
+    Mark several events at once, sending every write in a single round-trip.
+
+    With the ``pipeline`` engine, bits headed for the same key are coalesced;
+    a key with only one bit to set gets a ``SETBIT``, while a key with several
+    gets multi-op ``BITFIELD`` commands (Redis 3.2+) of up to
+    ``BITFIELD_CHUNK_SIZE`` bits each. With the ``script`` engine, a Lua
+    script derives the period keys and sets the bits on the server.
+
+    :param list marks: List of ``(event_name, uuid, now)`` tuples; ``now`` may
+                       be None to use the current time
+    :param str system: Which bitmapist should be used
+    :param bool track_hourly: Whether hourly stats should be tracked; defaults
+                              to ``bitmapist.TRACK_HOURLY``
+    :param str engine: ``pipeline`` or ``script``; defaults to ``MARK_ENGINE``
+    """
+    if not marks:
+        return
+
+    if track_hourly is None:
+        track_hourly = _bitmapist.TRACK_HOURLY
+
+    if _metrics.ENABLED:
+        _metrics.count_marks(marks)
+
+    if ID_MAP is not None:
+        marks = ID_MAP.map_marks(marks, system)
+
+    if (engine or MARK_ENGINE) == 'script':
+        # Sent in the same round-trip as the script, once it has written the
+        # bits: expiries only apply to keys that exist, and versions must not
+        # be bumped before the bits they stand for are set
+        commands = []
+        if _retention.RETENTION:
+            commands.extend(_retention.expire_commands(_mark_keys(marks, track_hourly)[1],
+                                                       system))
+        commands.extend(_bookkeeping_commands(marks, system))
+
+        granularities = None
+        if ROLLUP_MODE:
+            # Each mark is sent with the granularities it writes
+            current = datetime.utcnow()
+            granularities = [''.join(time_group[0].upper() for time_group in
+                                     _mark_time_groups(now or current, track_hourly, current))
+                             for _, _, now in marks]
+        return mark_events_script(marks, system, track_hourly, granularities, commands)
+
+    pipe = get_redis(system).pipeline()
+    for command in _mark_commands(marks, track_hourly, system):
+        pipe.execute_command(*command)
+    pipe.execute()
+
+
+def mark_event(event_name, uuid, system='default', now=None, track_hourly=None,
+               use_pipeline=True):
+    """
+    Mark an event, as ``bitmapist.mark_event`` does, with the id mapping and
+    bookkeeping of :func:`mark_events`; ``system`` may also be a Redis client
+    or pipeline the caller manages.
+    """
+    if isinstance(system, string_types) and use_pipeline:
+        return mark_events([(event_name, uuid, now)], system, track_hourly)
+    if _metrics.ENABLED:
+        _metrics.count_marks([(event_name, uuid, now)])
+    name = _system_name(system)
+    if ID_MAP is not None:
+        uuid = ID_MAP.assign([uuid], name)[0]
+    _write_event(_bitmapist.mark_event, _bookkeeping_commands, event_name, uuid, system, name,
+                 now, track_hourly, use_pipeline)
+
+
+def unmark_event(event_name, uuid, system='default', now=None, track_hourly=None,
+                 use_pipeline=True):
+    """
+    Unmark an event, as ``bitmapist.unmark_event`` does, bumping the cohort
+    cache's versions of the periods it falls in. With ``ID_MAP``, ``uuid``
+    is an external id; one that was never marked is left alone.
+    """
+    name = _system_name(system)
+    if ID_MAP is not None:
+        uuid = ID_MAP.lookup([uuid], name)[0]
+        if uuid is None:
+            return
+    _write_event(_bitmapist.unmark_event, _unmark_commands, event_name, uuid, system, name,
+                 now, track_hourly, use_pipeline)
+
+
+def _system_name(system):
+    """
+    The name of a bitmapist system, given its name or one of its Redis
+    clients or pipelines; ids are mapped in that system's Redis
+    """
+    if isinstance(system, string_types):
+        return system
+    for name, client in _bitmapist.SYSTEMS.items():
+        if client.connection_pool is system.connection_pool:
+            return name
+    if ID_MAP is not None:
+        raise ValueError("With BITMAPIST_ID_MAP, system must be the name, or a client or "
+                         "pipeline, of a bitmapist system")
+    return 'default'
+
+
+def _write_event(write, bookkeeping, event_name, uuid, system, name, now, track_hourly,
+                 use_pipeline):
+    "Set or clear an event's bits with bitmapist, followed by ``bookkeeping``'s commands"
+    client = get_redis(system)
+    if use_pipeline:
+        client = client.pipeline()
+    write(event_name, uuid, client, now, track_hourly, use_pipeline=False)
+    for command in bookkeeping([(event_name, uuid, now)], name):
+        client.execute_command(*command)
+    if use_pipeline:
+        client.execute()
+
+
+_MARK_CLASSES = {'months': MonthEvents, 'weeks': WeekEvents, 'days': DayEvents,
+                 'hours': HourEvents}
+
+
+def _mark_time_groups(now, track_hourly, current):
+    """
+    The time groups a mark writes keys for; in rollup mode, a mark in the
+    current week or month leaves it out, to be rolled up from its days.
+    """
+    time_groups = ['months', 'weeks', 'days'] + (['hours'] if track_hourly else [])
+    if ROLLUP_MODE:
+        time_groups = [time_group for time_group in time_groups
+                       if not _rollup.is_open(now, time_group, current)]
+    return time_groups
+
+
+def _mark_keys(marks, track_hourly):
+    """
+    The ids to set in each key a batch of marks writes, and the ``(date, time
+    group)`` period of each key.
+    """
+    current = datetime.utcnow()
+    keys = {}
+    periods = {}
+    event_keys = {}  # bulk marks tend to share their event and time
+    for event_name, uuid, now in marks:
+        now = now or current
+        if (event_name, now) not in event_keys:
+            event_keys[(event_name, now)] = []
+            for time_group in _mark_time_groups(now, track_hourly, current):
+                key = _MARK_CLASSES[time_group].from_date(event_name, now).redis_key
+                event_keys[(event_name, now)].append(key)
+                periods[key] = (now, time_group)
+        for key in event_keys[(event_name, now)]:
+            keys.setdefault(key, set()).add(uuid)
+    return keys, periods
+
+
+def _mark_commands(marks, track_hourly, system='default'):
+    "The SETBIT and BITFIELD commands that write a batch of marks"
+    keys, periods = _mark_keys(marks, track_hourly)
+
+    commands = []
+    for key, uuids in keys.items():
+        if len(uuids) == 1:
+            commands.append(('SETBIT', key, uuids.pop(), 1))
+            continue
+
+        uuids = sorted(uuids)
+        for i in range(0, len(uuids), BITFIELD_CHUNK_SIZE):
+            command = ['BITFIELD', key]
+            for uuid in uuids[i:i + BITFIELD_CHUNK_SIZE]:
+                command.extend(('SET', 'u1', uuid, 1))
+            commands.append(command)
+
+    commands.extend(_retention.expire_commands(periods, system))
+    commands.extend(_bookkeeping_commands(marks, system))
+    return commands
+
+
+def _bookkeeping_commands(marks, system):
+    "Commands keeping the cohort cache's versions and the event catalog up to date"
+    commands = _version_commands(marks)
+    if EVENT_CATALOG:
+        commands.extend(_catalog.catalog_commands(marks, system))
+    return commands
+
+
+def _unmark_commands(marks, system):
+    "Commands keeping the cohort cache's versions up to date as marks are cleared"
+    return _version_commands(marks)
+
+
+def get_event_names(system='default', prefix=''):
+    """
+    Get the names of every event marked, or just the ones starting with
+    ``prefix``; from the event catalog when ``EVENT_CATALOG`` is on, and
+    otherwise by scanning the keyspace with ``bitmapist.get_event_names``.
+
+    :param str system: Which bitmapist should be used
+    :param str prefix: Only return event names starting with this
+    :returns: List of event names, in no particular order
+    """
+    if EVENT_CATALOG:
+        return _catalog.get_event_names(system, prefix)
+    return _bitmapist.get_event_names(system, prefix)
+
+
+@_metrics.tracked('get_event_data')
+def get_event_data(event_name, time_group='days', now=None, system='default', temp_keys=None):
     """
     Get the data for a single event at a single event in time.
 
@@ -33,14 +342,110 @@ def get_event_data(event_name, time_group='days', now=None, system='default'):
     :param datetime now: Time point at which to get event data (defaults to
                          current time if None)
     :param str system: Which bitmapist should be used
-    :returns: Bitmapist events collection
+    :param TempKeys temp_keys: Temporary keys to hold a year's months ORed
+                               together in, with ``ROLLUP_MODE``, for the
+                               caller to clean up once done with them;
+                               defaults to new ones, left to expire after
+                               ``TEMP_KEY_TTL`` seconds
+    :returns: Bitmapist events collection (taking and giving external ids
+              with ``ID_MAP``), or ``EXPIRED`` if the period is past its
+              retention
+    """
+    now = now or datetime.utcnow()
+    if _retention.is_expired(now, time_group):
+        return _retention.EXPIRED
+    if ROLLUP_MODE and time_group in ('years', 'year'):
+        # YearEvents ORs bitmapist's own month keys, which in rollup mode are
+        # only written once each month has ended
+        events = _period_events(event_name, now, time_group, system,
+                                temp_keys or TempKeys(system))
+    else:
+        events = _events_fn(time_group)(event_name, now, system)
+    if ID_MAP is not None:
+        return MappedEvents(events, ID_MAP, system)
+    return events
+
+
+def get_event_members(event_name, time_group='days', now=None, system='default'):
+    """
+    Get the ids of the users who did an event in a single point in time,
+    e.g. for exporting them. With ``ID_MAP``, these are the external ids
+    marked, as strings.
+
+    :param str event_name: Name of event for retrieval
+    :param str time_group: Time scale by which to group results; can be `days`,
+                           `weeks`, `months`, `years`
+    :param datetime now: Time point at which to get event data (defaults to
+                         current time if None)
+    :param str system: Which bitmapist should be used
+    :returns: List of ids, in the order of their bits, or ``EXPIRED`` if the
+              period is past its retention
+    """
+    now = now or datetime.utcnow()
+    if _retention.is_expired(now, time_group):
+        return _retention.EXPIRED
+
+    keys = _event_keys(event_name, now, time_group, system)
+    bitmaps = _local_fetch(keys, system)
+    ids = _local_bitop('OR', *[bitmaps[key] for key in keys]).ids()
+    if ID_MAP is not None:
+        return ID_MAP.to_external(ids, system)
+    return ids
+
+
+def get_event_counts(event_names, time_groups=('days', 'weeks', 'months', 'years'),
+                     now=None, system='default'):
+    """
+    Count the users who did each of several events in each of several time
+    groups, with every ``BITCOUNT`` sent in a single pipeline; unlike taking
+    ``len()`` of :func:`get_event_data`'s collections one at a time, no ids
+    are fetched and Redis is only asked once.
+
+    :param list event_names: Names of events to count
+    :param list time_groups: Time scales to count each event over; can be
+                             `days`, `weeks`, `months`, `years`
+    :param datetime now: Time point at which to count events (defaults to
+                         current time if None)
+    :param str system: Which bitmapist should be used
+    :returns: Dict of event name to list of counts, one per time group;
+              ``EXPIRED`` for time groups past their retention
     """
     now = now or datetime.utcnow()
-    return _events_fn(time_group)(event_name, now, system)
+    event_names = list(event_names)
+    if not event_names:
+        return {}
+
+    # A year is the union of its months, worked out in a temporary key
+    temp_keys = TempKeys(system)
+    pipe = get_redis(system).pipeline(transaction=False)
+    counted = []  # index of each BITCOUNT's result
+    for event_name in event_names:
+        for time_group in time_groups:
+            if _retention.is_expired(now, time_group):
+                counted.append(None)
+                continue
+            keys = _event_keys(event_name, now, time_group, system)
+            if len(keys) > 1:
+                working_key = temp_keys.key('counts')
+                pipe.bitop('OR', working_key, *keys)
+                pipe.expire(working_key, temp_keys.ttl)
+                pipe.bitcount(working_key)
+            else:
+                pipe.bitcount(keys[0])
+            counted.append(len(pipe.command_stack) - 1)
+    cleaned_up = temp_keys.cleanup(pipe)
+    results = pipe.execute()
+    cleaned_up(results)
+
+    counts = iter(_retention.EXPIRED if index is None else results[index] for index in counted)
+    return dict((event_name, [next(counts) for _ in time_groups])
+                for event_name in event_names)
 
 
 def _events_fn(time_group='days'):
-    if time_group == 'days' or time_group == 'day':
+    if ROLLUP_MODE and time_group in ('weeks', 'week', 'months', 'month'):
+        return partial(_rollup.get_events, time_group=time_group)
+    elif time_group == 'days' or time_group == 'day':
         return _day_events_fn
     elif time_group == 'weeks' or time_group == 'week':
         return _week_events_fn
@@ -50,13 +455,18 @@ def _events_fn(time_group='days'):
         return _year_events_fn
 
 
+@_metrics.tracked('get_cohort')
 def get_cohort(primary_event_name, secondary_event_name,
                additional_events=[], time_group='days',
                num_rows=10, num_cols=10, system='default',
-               with_replacement=False):
+               with_replacement=False, engine=None, temp_keys=None):
     """
     Get the cohort data for multiple chained events at multiple points in time.
 
+    When a cohort cache is set up (see ``COHORT_CACHE``), cells and primary
+    event totals for periods that have already ended are taken from it, and
+    only the rest are computed.
+
     :param str primary_event_name: Name of primary event for defining cohort
     :param str secondary_event_name: Name of secondary event for defining cohort
     :param list additional_events: List of additional events by which to filter
@@ -73,79 +483,397 @@ def get_cohort(primary_event_name, secondary_event_name,
                                   should be counted for a given user; e.g., if
                                   a user logged in multiple times, whether to
                                   include subsequent logins for the cohort
+    :param str engine: ``bitop``, ``script`` or ``local``; defaults to
+                       ``COHORT_ENGINE``
+    :param TempKeys temp_keys: Temporary keys to hold intermediate results
+                               in, deleted before returning; their
+                               ``stats()`` report the keys created and the
+                               memory they held. Defaults to new ones.
     :returns: Tuple of (list of lists of cohort results, list of dates for
-              cohort, primary event total for each date)
+              cohort, primary event total for each date); the total and
+              results of rows whose period is past its retention are
+              ``EXPIRED``
     """
+    now, dates = _cohort_dates(time_group, num_rows)
+    cohort, primary_event_totals = _compute_cohort(
+        primary_event_name, secondary_event_name, additional_events, time_group, num_cols,
+        system, with_replacement, engine, temp_keys, now, dates)
+    return cohort, dates, primary_event_totals
+
+
+def iter_cohort(primary_event_name, secondary_event_name,
+                additional_events=[], time_group='days',
+                num_rows=10, num_cols=10, system='default',
+                with_replacement=False, engine=None, temp_keys=None, chunk_size=30,
+                first_chunk_size=None):
+    """
+    Get the same cohort data as :func:`get_cohort`, row by row as it is
+    computed. Rows are computed ``chunk_size`` at a time, so only a chunk is
+    held in memory and the first rows come before the rest are computed;
+    each chunk chains the secondary events it needs anew.
+
+    :param int chunk_size: How many rows to compute at a time
+    :param int first_chunk_size: How many rows to compute first, with each
+                                 chunk after that twice the size of the one
+                                 before, up to ``chunk_size``; smaller first
+                                 chunks get the first rows sooner. Defaults
+                                 to ``chunk_size``.
+    :returns: Generator of (date, primary event total, list of cohort results)
+              for each row
+    """
+    now, dates = _cohort_dates(time_group, num_rows)
+    temp_keys = temp_keys or TempKeys(system)
+    start, size = 0, first_chunk_size or chunk_size
+    while start < len(dates):
+        chunk = dates[start:start + size]
+        cohort, primary_event_totals = _compute_cohort(
+            primary_event_name, secondary_event_name, additional_events, time_group,
+            num_cols, system, with_replacement, engine, temp_keys, now, chunk)
+        for row in zip(chunk, primary_event_totals, cohort):
+            yield row
+        start, size = start + size, min(size * 2, chunk_size)
+
+
+def _compute_cohort(primary_event_name, secondary_event_name, additional_events, time_group,
+                    num_cols, system, with_replacement, engine, temp_keys, now, dates):
+    "The cohort results and primary event totals for the rows of ``dates``"
+    # Results that are already known, by (row, col), or (row, None) for the
+    # row's primary event total
+    known = {}
+    cache_keys = {}
+    if COHORT_CACHE is not None:
+        cache_keys = _cohort_cache_keys(primary_event_name, secondary_event_name,
+                                        additional_events, time_group, num_cols, system,
+                                        with_replacement, now, dates)
+        cached = COHORT_CACHE.get_many(cache_keys.values(), system)
+        known = dict((cell, cached[key]) for cell, key in cache_keys.items() if key in cached)
+        # BITOP per chain step, EXISTS, AND, BITCOUNT and (without replacement) XOR
+        commands_per_cell = (len(_chain_groups(additional_events)) + 3 +
+                             (0 if with_replacement else 1))
+
+    args = (primary_event_name, secondary_event_name, additional_events, time_group,
+            num_cols, system, with_replacement, now, dates, known)
+    engine = engine or COHORT_ENGINE
+    if engine == 'script':
+        cohort, primary_event_totals = _get_cohort_spec(get_cohort_script, *args)
+    elif engine == 'local':
+        cohort, primary_event_totals = _get_cohort_spec(get_cohort_local, *args)
+    else:
+        temp_keys = temp_keys or TempKeys(system)
+        try:
+            cohort, primary_event_totals = _get_cohort_bitop(*args, temp_keys=temp_keys)
+        finally:
+            temp_keys.cleanup()
+
+    if COHORT_CACHE is not None:
+        computed = {}
+        for (i, j), key in cache_keys.items():
+            value = primary_event_totals[i] if j is None else cohort[i][j]
+            if (i, j) not in known and value is not None:
+                computed[key] = value
+        COHORT_CACHE.set_many(computed, system)
+        COHORT_CACHE.record(
+            len(known), len(computed),
+            sum(1 if j is None else commands_per_cell for i, j in known))
+
+    # A row's cells are never older than it, so only rows can be past their
+    # retention as a whole
+    for i, event_time in enumerate(dates):
+        if _retention.is_expired(event_time, time_group, now):
+            primary_event_totals[i] = _retention.EXPIRED
+            cohort[i] = [_retention.EXPIRED] * num_cols
 
+    return cohort, primary_event_totals
+
+
+def _get_cohort_bitop(primary_event_name, secondary_event_name, additional_events,
+                      time_group, num_cols, system, with_replacement, now, dates, known,
+                      temp_keys):
+    cli = get_redis(system)
+
+    # Working keys, overwritten in place from cell to cell
+    remaining_key = temp_keys.key('remaining')
+    cell_key = temp_keys.key('cell')
+
+    primary_keys = [_period_events(primary_event_name, event_time, time_group, system,
+                                   temp_keys).redis_key
+                    for event_time in dates]
+
+    primary_event_totals = [known.get((i, None)) for i in range(len(dates))]
+    uncounted = [i for i, total in enumerate(primary_event_totals) if total is None]
+    if uncounted:
+        pipe = cli.pipeline(transaction=False)
+        for i in uncounted:
+            pipe.bitcount(primary_keys[i])
+        for i, total in zip(uncounted, pipe.execute()):
+            primary_event_totals[i] = total
+
+    # Each period's secondary chain is the same for every row, so it is only
+    # chained once; None when the secondary event has nothing marked
+    chains = {}
+
+    def get_chain(date):
+        period = _period_id(date, time_group)
+        if period not in chains:
+            chained_events = chain_events(secondary_event_name, additional_events, date,
+                                          time_group, system, engine='bitop',
+                                          temp_keys=temp_keys)
+            chains[period] = (None if isinstance(chained_events, string_types)
+                              else chained_events.redis_key)
+        return chains[period]
+
+    # Every cell is worked out in a single pipeline; without replacement, the
+    # users a cell matches are taken out of the row's remaining primary event
+    # before the next cell is worked out
     cohort = []
-    dates = []
-    primary_event_totals = []  # for percents
+    counted = []  # (row, col, index of its BITCOUNT's result)
+    pipe = cli.pipeline(transaction=False)
+    for i, event_time in enumerate(dates):
+        row = [None] * num_cols
+        cohort.append(row)
+        if not primary_event_totals[i]:
+            continue
+
+        cells = []
+        for j in range(num_cols):
+            incremented = event_time + relativedelta(**{time_group: j})
+            if incremented > now:
+                break
+            if (i, j) in known:
+                row[j] = known[(i, j)]
+                if with_replacement or not known[(i, j)]:
+                    continue
+            chain_key = get_chain(incremented)
+            if chain_key is None:
+                row[j] = 0
+            else:
+                cells.append((j, chain_key))
 
-    fn_get_events = _events_fn(time_group)
+        if not cells:
+            continue
 
-    # TIMES
+        if with_replacement:
+            for j, chain_key in cells:
+                pipe.bitop('AND', cell_key, chain_key, primary_keys[i])
+                pipe.bitcount(cell_key)
+                counted.append((i, j, len(pipe.command_stack) - 1))
+        else:
+            pipe.bitop('OR', remaining_key, primary_keys[i])
+            for n, (j, chain_key) in enumerate(cells):
+                pipe.bitop('AND', cell_key, chain_key, remaining_key)
+                if (i, j) not in known:
+                    pipe.bitcount(cell_key)
+                    counted.append((i, j, len(pipe.command_stack) - 1))
+                if n < len(cells) - 1:
+                    pipe.bitop('XOR', remaining_key, remaining_key, cell_key)
+            pipe.expire(remaining_key, temp_keys.ttl)
+
+        # Writing a key drops its expiry, so it is set again after each row
+        pipe.expire(cell_key, temp_keys.ttl)
+
+    cleaned_up = temp_keys.cleanup(pipe)
+    results = pipe.execute()
+    cleaned_up(results)
+    for i, j, index in counted:
+        cohort[i][j] = results[index]
 
-    def increment_delta(t):
-        return relativedelta(**{time_group: t})
+    return cohort, primary_event_totals
 
+
+def _cohort_dates(time_group, num_rows):
+    "The current time and the date of each cohort row"
     now = datetime.utcnow()
     # - 1 for deltas between time points (?)
     event_time = now - relativedelta(**{time_group: num_rows - 1})
-
     if time_group == 'months':
         event_time -= relativedelta(days=event_time.day - 1)  # (?)
+    return now, [event_time + relativedelta(**{time_group: i}) for i in range(num_rows)]
 
-    # COHORT
 
-    for i in range(num_rows):
-        # get results for each date interval from current time point for the row
-        row = []
-        primary_event = fn_get_events(primary_event_name, event_time, system)
+def _version_key(event_name, period):
+    return '%s%s:%s' % (VERSION_KEY_PREFIX, event_name, period)
 
-        primary_total = len(primary_event)
-        primary_event_totals.append(primary_total)
 
-        dates.append(event_time)
+def _version_commands(marks):
+    """
+    INCR commands bumping the versions of every period a batch's back-dated
+    marks (ones from before today) fall in, so that cached cohort cells
+    depending on those periods are no longer looked up, each followed by an
+    EXPIRE once every cell cached before the bump has expired. Versions are
+    bumped whether or not this process caches cohorts, as other processes
+    may.
+    """
+    today = datetime.utcnow().date()
+    keys = set()
+    for event_name, uuid, now in marks:
+        if now is not None and now.date() < today:
+            for time_group in ('days', 'weeks', 'months', 'years'):
+                keys.add(_version_key(event_name, _period_id(now, time_group)))
+    if not keys:
+        return []
+    # Without a cache of its own, a process goes by the configured TTL, which
+    # every process caching cohorts shares
+    version_ttl = (COHORT_CACHE.version_ttl if COHORT_CACHE is not None
+                   else _version_ttl())
+    commands = []
+    for key in sorted(keys):
+        commands.append(('INCR', key))
+        commands.append(('EXPIRE', key, version_ttl))
+    return commands
 
-        if not primary_total:
-            row = [None] * num_cols
-        else:
-            for j in range(num_cols):
-                # get results for each event chain for current incremented time
-                incremented = event_time + increment_delta(j)
 
-                if incremented > now:
-                    # date in future; no events and no need to go through chain
-                    combined_total = None
+def _cohort_cache_keys(primary_event_name, secondary_event_name, additional_events,
+                       time_group, num_cols, system, with_replacement, now, dates):
+    """
+    Cache keys for a cohort's cells and primary event totals from periods that
+    have ended, by (row, col) or (row, None).
 
-                else:
-                    chained_events = chain_events(secondary_event_name,
-                                                  additional_events,
-                                                  incremented, time_group, system)
+    Each key is a hash of the cohort's definition, the cell's position and
+    the versions of the event periods the cell was computed from.
+    """
+    current = _period_id(now, time_group)
+    chain_names = [secondary_event_name] + [event.get('name') for event in additional_events]
+    definition = [system, primary_event_name, secondary_event_name,
+                  [[event.get('name'), event.get('op')] for event in additional_events],
+                  time_group, bool(with_replacement)]
 
-                    if chained_events:
-                        combined_events = BitOpAnd(chained_events, primary_event)
-                        combined_total = len(combined_events)
+    # Event periods each closed result depends on
+    depends = {}
+    for i, event_time in enumerate(dates):
+        row_period = _period_id(event_time, time_group)
+        if row_period == current:
+            continue
+        depends[(i, None)] = [_version_key(primary_event_name, row_period)]
 
-                        if not with_replacement:
-                            primary_event = BitOpXor(primary_event, combined_events)
+        chain_keys = []
+        for j in range(num_cols):
+            incremented = event_time + relativedelta(**{time_group: j})
+            period = _period_id(incremented, time_group)
+            if incremented > now or period == current:
+                break
+            keys = [_version_key(name, period) for name in chain_names]
+            # Without replacement, a cell depends on every cell before it
+            chain_keys = keys if with_replacement else chain_keys + keys
+            depends[(i, j)] = depends[(i, None)] + chain_keys
 
-                    else:
-                        combined_total = 0
+    version_keys = sorted(set(key for keys in depends.values() for key in keys))
+    if not version_keys:
+        return {}
+    versions = dict(zip(version_keys, get_redis(system).mget(version_keys)))
 
-                row.append(combined_total)
+    cache_keys = {}
+    for (i, j), keys in depends.items():
+        cell = definition + [_period_id(dates[i], time_group), j,
+                             [int(versions[key] or 0) for key in keys]]
+        cache_keys[(i, j)] = hashlib.sha1(json.dumps(cell).encode('utf-8')).hexdigest()
+    return cache_keys
 
-        cohort.append(row)
-        event_time += increment_delta(1)
 
-    # Clean up results of BitOps
-    delete_runtime_bitop_keys()
+def _event_keys(event_name, date, time_group, system='default'):
+    "Keys holding an event's bitmap for a period; a year is the union of its months"
+    if time_group in ('years', 'year'):
+        return [event.redis_key for event in _year_months(event_name, date, system)]
+    return [_events_fn(time_group)(event_name, date, system).redis_key]
 
-    return cohort, dates, primary_event_totals
+
+def _year_months(event_name, date, system):
+    "An event's collection for each month of the year a date falls in"
+    return [_events_fn('months')(event_name, datetime(date.year, month, 1), system)
+            for month in range(1, 13)]
+
+
+def _period_events(event_name, date, time_group, system, temp_keys):
+    """
+    An event's collection for the period a date falls in; a year's months are
+    ORed together in a temporary key, rather than in a ``YearEvents``
+    shared with other queries.
+    """
+    if time_group in ('years', 'year'):
+        return temp_keys.bitop('OR', *_year_months(event_name, date, system))
+    return _events_fn(time_group)(event_name, date, system)
 
 
+def _chain_groups(events_to_chain):
+    """
+    Group events to chain into ``(op, [event names])`` steps, where each step
+    ORs its events together; an OR joins its direct predecessor's step, as
+    described in :func:`chain_events`.
+    """
+    groups = []
+    for idx, event in enumerate(events_to_chain):
+        if event.get('op') == 'or' and idx > 0:
+            groups[-1][1].append(event.get('name'))
+        else:
+            groups.append(('or' if event.get('op') == 'or' else 'and', [event.get('name')]))
+    return groups
+
+
+def _get_cohort_spec(compute, primary_event_name, secondary_event_name, additional_events,
+                     time_group, num_cols, system, with_replacement, now, dates, known):
+    """
+    Describe a cohort as a spec (see :func:`get_cohort_script`) and have
+    ``compute`` (the cohort script or the local engine) work it out.
+    """
+    groups = _chain_groups(additional_events)
+
+    # Rows share most of their periods, so each distinct chain is sent once
+    chains = []
+    chain_indexes = {}
+    rows = []
+    spec_rows = []  # indexes of the rows sent to the script
+    for i, event_time in enumerate(dates):
+        total = known.get((i, None))
+        cells = []
+        for j in range(num_cols):
+            incremented = event_time + relativedelta(**{time_group: j})
+            if incremented > now or (with_replacement and (i, j) in known):
+                cells.append(0)
+                continue
+
+            chain = {
+                'base': _event_keys(secondary_event_name, incremented, time_group, system),
+                'steps': [{'op': op.upper(),
+                           'keys': [key for name in names
+                                    for key in _event_keys(name, incremented, time_group, system)]}
+                          for op, names in groups],
+            }
+            chain_key = json.dumps(chain, sort_keys=True)
+            if chain_key not in chain_indexes:
+                chains.append(chain)
+                chain_indexes[chain_key] = len(chains)
+            # A known cell's users are still taken out of the primary event
+            # for the cells after it, but not counted
+            cells.append(-chain_indexes[chain_key] if (i, j) in known
+                         else chain_indexes[chain_key])
+
+        if total is not None and (total == 0 or all(c <= 0 for c in cells)):
+            continue
+
+        row = {'primary': _event_keys(primary_event_name, event_time, time_group, system),
+               'cells': cells}
+        if total is not None:
+            row['total'] = total
+        rows.append(row)
+        spec_rows.append(i)
+
+    cohort = [[None] * num_cols for _ in dates]
+    primary_event_totals = [known.get((i, None)) for i in range(len(dates))]
+    if rows:
+        counts, totals = compute(
+            {'with_replacement': with_replacement, 'chains': chains, 'rows': rows}, system)
+        for i, row, total in zip(spec_rows, counts, totals):
+            cohort[i] = row
+            primary_event_totals[i] = total
+
+    for (i, j), value in known.items():
+        if j is not None and primary_event_totals[i]:
+            cohort[i][j] = value
+    return cohort, primary_event_totals
+
+
+@_metrics.tracked('chain_events')
 def chain_events(base_event_name, events_to_chain, now, time_group,
-                 system='default'):
+                 system='default', engine=None, temp_keys=None):
     """
     Chain additional events with a base set of events.
 
@@ -153,6 +881,11 @@ def chain_events(base_event_name, events_to_chain, now, time_group,
     ``A && B && C || D`` will be handled as ``A && B && (C || D)``, and
     ``A && B || C && D`` will be handled as ``A && (B || C) && D``).
 
+    Events are checked for anything marked (and counted, with cached counts
+    reused) in a single pipeline beforehand. The two ANDed operands with the
+    fewest events marked are chained first, and the rest only if anything is
+    left, in a single ``BITOP``.
+
     :param str base_event_name: Name of event to chain additional events to/with
     :param list events_to_chain: List of additional event names to chain
                                  (e.g., ``[{'name': 'user:logged_in',
@@ -161,49 +894,152 @@ def chain_events(base_event_name, events_to_chain, now, time_group,
     :param str time_group: Time scale by which to group results; can be `days`,
                            `weeks`, `months`, `years`
     :param str system: Which bitmapist should be used
-    :returns: Bitmapist events collection
+    :param str engine: ``local`` to fetch the events' bitmaps and chain them
+                       in-process; anything else (defaults to
+                       ``COHORT_ENGINE``) chains them with ``BITOP``
+    :param TempKeys temp_keys: Temporary keys to hold intermediate results
+                               and the result in, for the caller to clean up
+                               once done with it; defaults to new ones, which
+                               are deleted before returning, except for the
+                               result's, which is left to expire after
+                               ``TEMP_KEY_TTL`` seconds
+    :returns: Bitmapist events collection, or a
+              :class:`flask_bitmapist.local.Bitmap` with the ``local`` engine
     """
+    if (engine or COHORT_ENGINE) == 'local':
+        return _chain_events_local(base_event_name, events_to_chain, now, time_group, system)
+
+    if temp_keys is not None:
+        return _chain_events(base_event_name, events_to_chain, now, time_group, system,
+                             temp_keys)
 
-    fn_get_events = _events_fn(time_group)
-    base_event = fn_get_events(base_event_name, now, system)
+    temp_keys = TempKeys(system)
+    result = _chain_events(base_event_name, events_to_chain, now, time_group, system, temp_keys)
+    return _keep_result(result, temp_keys)
 
-    if not base_event.has_events_marked():
+
+def _keep_result(result, temp_keys):
+    """
+    Delete a query's temporary keys, except for the one holding its result,
+    if any, which is left to expire with the rest of its TTL.
+    """
+    key = getattr(result, 'redis_key', None)
+    if key in temp_keys.keys:
+        temp_keys.keys.remove(key)
+    temp_keys.cleanup()
+    return result
+
+
+def _chain_events(base_event_name, events_to_chain, now, time_group, system, temp_keys):
+    "Chain events with ``BITOP``, holding the results in ``temp_keys``"
+    def get_events(name):
+        return _period_events(name, now, time_group, system, temp_keys)
+
+    if not events_to_chain:
+        base_event = get_events(base_event_name)
+        return base_event if base_event.has_events_marked() else ''
+
+    # Every operand is ANDed with the others, so they may be chained in any
+    # order; starting from the smallest keeps intermediate results small
+    operands = _chain_operands(base_event_name, events_to_chain)
+    keys = dict((name, _event_keys(name, now, time_group, system))
+                for operand in operands for name in operand)
+    # With two operands there is nothing to order
+    marked, counts = _chain_stats(keys, now, time_group, system, count=len(operands) > 2)
+
+    if base_event_name not in marked:
         return ''
 
-    if events_to_chain:
-        chain_events = []
+    def operand_keys(operand):
+        return [key for name in operand for key in keys[name]]
 
-        # for idx, event_to_chain in enumerate(events_to_chain):
-        for event_to_chain in events_to_chain:
-            event_name = event_to_chain.get('name')
-            chain_event = fn_get_events(event_name, now, system)
-            chain_events.append(chain_event)
+    operands.sort(key=lambda operand: sum(counts[key] for key in operand_keys(operand)))
 
-        # Each OR should operate only on its immediate predecessor, e.g.,
-        #     `A && B && C || D` should be handled as ~ `A && B && (C || D)`,
-        #     and
-        #     `A && B || C && D` should be handled as ~ `A && (B || C) && D`.
-        op_or_indices = [idx for idx, e in enumerate(events_to_chain) if e['op'] == 'or']
+    for operand in operands:
+        if not any(name in marked for name in operand):
+            # Nothing marked, so nothing is left once it is ANDed
+            return get_events(operand[0])
 
-        # Work backwards; least impact on operator combos + list indexing
-        for idx in reversed(op_or_indices):
-            # If first of events to chain, OR will just operate on base event
-            if idx > 0:
-                prev_event = chain_events[idx - 1]
-                or_event = chain_events.pop(idx)
+    operand_events = []
+    for operand in operands:
+        events = [get_events(name) for name in operand]
+        operand_events.append(events[0] if len(events) == 1 else temp_keys.bitop('OR', *events))
 
-                # OR events should not be re-chained below
-                events_to_chain.pop(idx)
+    # The two smallest operands are likely to leave little, if anything; if
+    # something is left, the rest are ANDed with it in a single BITOP
+    result = temp_keys.bitop('AND', *operand_events[:2])
+    if len(operand_events) > 2 and len(result):
+        result = temp_keys.bitop('AND', result, *operand_events[2:])
+    return result
 
-                chain_events[idx - 1] = BitOpOr(prev_event, or_event)
 
-        for idx, name_and_op in enumerate(events_to_chain):
-            if name_and_op.get('op') == 'or':
-                base_event = BitOpOr(base_event, chain_events[idx])
-            else:
-                base_event = BitOpAnd(base_event, chain_events[idx])
+def _chain_operands(base_event_name, events_to_chain):
+    """
+    Compile a base event and events to chain to it into operands to AND
+    together, each a list of event names to OR together; e.g., ``A && B || C
+    && D`` becomes ``[[A], [B, C], [D]]``. The caller's list is left as it is.
+    """
+    operands = [[base_event_name]]
+    for op, names in _chain_groups(events_to_chain):
+        if op == 'or':
+            # Only the first group can be an OR, which applies to the base event
+            operands[0].extend(names)
+        else:
+            operands.append(list(names))
+    return operands
+
+
+def _chain_stats(keys, now, time_group, system, count=True):
+    """
+    Which events have anything marked, and (unless ``count`` is False, when
+    they are all 0) how many bits each of their keys has set, checked in a
+    single pipeline. ``keys`` are each event's keys for the period.
+
+    Events are looked up in the event catalog when ``EVENT_CATALOG`` is on,
+    and their keys checked with ``EXISTS`` otherwise. Counts only decide the
+    order events are chained in, so they are taken from
+    ``CARDINALITY_CACHE`` while it has them.
+    """
+    all_keys = sorted(set(key for name_keys in keys.values() for key in name_keys))
+    counts = {}
+    for key in all_keys:
+        cached = CARDINALITY_CACHE.get((system, key)) if count else 0
+        if cached is not None:
+            counts[key] = cached
+    uncounted = [key for key in all_keys if key not in counts]
+
+    pipe = get_redis(system).pipeline(transaction=False)
+    if EVENT_CATALOG:
+        get_marked = _catalog.marked_events(list(keys), now, time_group, pipe=pipe)
+        checks = 1
+    else:
+        for key in all_keys:
+            pipe.exists(key)
+        checks = len(all_keys)
+    for key in uncounted:
+        pipe.bitcount(key)
+    results = pipe.execute()
+
+    for key, count in zip(uncounted, results[checks:]):
+        counts[key] = count
+        CARDINALITY_CACHE.set((system, key), count)
+
+    if EVENT_CATALOG:
+        return get_marked(results[0]), counts
+    exists = dict(zip(all_keys, results[:checks]))
+    return set(name for name, name_keys in keys.items()
+               if any(exists[key] for key in name_keys)), counts
+
+
+def _chain_events_local(base_event_name, events_to_chain, now, time_group, system):
+    base = _event_keys(base_event_name, now, time_group, system)
+    steps = [(op, [key for name in names
+                   for key in _event_keys(name, now, time_group, system)])
+             for op, names in _chain_groups(events_to_chain)]
 
-    return base_event
+    bitmaps = _local_fetch(base + [key for _, keys in steps for key in keys], system)
+    chained = _local_chain(bitmaps, base, steps)
+    return '' if chained is None else chained
 
 
 # PRIVATE methods: copied directly from Bitmapist because you can't import
@@ -8,16 +8,20 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import csv
 import json
 import os
 
 from datetime import datetime
 
-from flask import Blueprint, render_template, request
+from flask import (Blueprint, Response, abort, get_template_attribute, render_template, request,
+                   stream_with_context)
 
-from bitmapist import get_event_names
-
-from .utils import get_cohort, get_event_data
+from ._compat import StringIO, string_types
+from . import metrics
+from .memory import GROWTH_DAYS, SPARSE_DENSITY, memory_report
+from .retention import EXPIRED
+from .utils import get_cohort, get_event_counts, get_event_names, iter_cohort
 
 
 root = os.path.abspath(os.path.dirname(__file__))
@@ -38,10 +42,8 @@ def inject_version():
 def index():
     now = datetime.utcnow()
 
-    day_events = len(list(get_event_data('user:logged_in', 'days', now)))
-    week_events = len(list(get_event_data('user:logged_in', 'weeks', now)))
-    month_events = len(list(get_event_data('user:logged_in', 'months', now)))
-    year_events = len(list(get_event_data('user:logged_in', 'years', now)))
+    counts = get_event_counts(['user:logged_in'], ['days', 'weeks', 'months', 'years'], now)
+    day_events, week_events, month_events, year_events = counts['user:logged_in']
     return render_template('bitmapist/index.html', events=get_event_names(),
                            day_events=day_events, week_events=week_events,
                            month_events=month_events, year_events=year_events)
@@ -66,15 +68,8 @@ def cohort():
 
         # FOR DEMO PURPOSES: list of totals per event
         now = datetime.utcnow()
-        events = {}
-        for event_name in event_names:
-            # TODO: + hourly
-            day = len(get_event_data(event_name, 'days', now))
-            week = len(get_event_data(event_name, 'weeks', now))
-            month = len(get_event_data(event_name, 'months', now))
-            year = len(get_event_data(event_name, 'years', now))
-            event = (year, month, week, day)
-            events[event_name] = event
+        # TODO: + hourly
+        events = get_event_counts(event_names, ['years', 'months', 'weeks', 'days'], now)
 
         time_groups = ['day', 'week', 'month', 'year']  # singular for display
         return render_template('bitmapist/cohort.html',
@@ -84,91 +79,276 @@ def cohort():
 
     elif request.method == 'POST':
         data = json.loads(request.data)
-
-        # Cohort events
-        primary_event = data.get('primary_event')
-        secondary_event = data.get('secondary_event')
-        additional_events = data.get('additional_events', [])
-        # Cohort settings
-        time_group = data.get('time_group', 'days')
+        settings = _cohort_settings(data, page=True)
         as_percent = data.get('as_percent', False)
-        with_replacement = data.get('with_replacement', False)
-        num_rows = int(data.get('num_rows', 20))
-        num_cols = int(data.get('num_cols', 10))
-
-        if time_group == 'years':
-            # Three shall be the number thou shalt count, and the number of the
-            # counting shall be three. Four shalt thou not count, neither count thou
-            # two, excepting that thou then proceed to three. Five is right out.
-            num_rows = 3
-
-        # Columns > rows would extend into future and thus would just be empty
-        num_cols = num_rows if num_cols > num_rows else num_cols
+        num_cols = settings['num_cols']
 
         # Get cohort data and associated dates
-        cohort_data = get_cohort(primary_event, secondary_event,
-                                 additional_events=additional_events,
-                                 time_group=time_group,
-                                 num_rows=num_rows, num_cols=num_cols,
-                                 with_replacement=with_replacement)
-        cohort, dates, row_totals = cohort_data
+        cohort, dates, row_totals = get_cohort(**settings)
 
         # Format dates for table
-        if time_group == 'years':
-            dt_format = '%Y'
-        elif time_group == 'months':
-            dt_format = '%b %Y'
-        elif time_group == 'weeks':
-            dt_format = 'Week %U - %d %b %Y'
-        else:
-            dt_format = '%d %b %Y'
-
+        dt_format = _date_format(settings['time_group'])
         date_strings = [dt.strftime(dt_format) for dt in dates]
 
-        # Get overall total
-        overall_total = sum(row_totals)
-
-        # Get column totals (pre-percent)
-        col_counts = []
-        col_totals = []
-        for j in range(num_cols):
-            col = [row[j] for row in cohort if row[j] is not None]
-            col_counts.append(len(col))
-            col_totals.append(sum(col))
-
-        # Get each cohort value as percents if as_percent
-        if as_percent:
-            for i, row in enumerate(cohort):
-                if row_totals[i]:
-                    # calculate percent value for each (unless None)
-                    cohort[i] = [float(r) / row_totals[i] if r is not None else r for r in row]
-
-        # Get column averages (post-percent)
-        # TODO: do not loop range(num_cols) twice, but necessary as-is so that,
-        #       if getting results as percents, col totals are calculated with
-        #       numbers of users (always) but col averages are calculated with
-        #       percent values
-        averages = []
-        for j in range(num_cols):
-            col = [row[j] for row in cohort if row[j] is not None]
-            average = float(sum(col)) / col_counts[j] if col_counts[j] else 0
-            averages.append(average)
+        # Column totals are calculated with numbers of users (always) but
+        # column averages with the values shown, i.e. percents if as_percent
+        totals = _CohortTotals(num_cols, as_percent)
+        cohort = [totals.add(row, row_total) for row, row_total in zip(cohort, row_totals)]
 
         # TODO: remove unnecessary keys from json return
         cohort_data = {
             'cohort': cohort,
             'dates': date_strings,
-            'total': overall_total,
+            'total': totals.total,
             'row_totals': row_totals,
-            'col_totals': col_totals,
-            'averages': averages,
-            'time_group': time_group,
+            'col_totals': totals.col_totals,
+            'averages': totals.averages(),
+            'time_group': settings['time_group'],
             'as_percent': as_percent,
-            'num_rows': num_rows,
+            'num_rows': settings['num_rows'],
             'num_cols': num_cols
         }
 
         if request.args.get('json'):
-            return json.dumps(cohort_data, indent=4)
+            return json.dumps(cohort_data, indent=4, default=str)
         else:
-            return render_template('bitmapist/_heatmap.html', **cohort_data)
+            return render_template(HEATMAP_TEMPLATE, **cohort_data)
+
+
+HEATMAP_TEMPLATE = 'bitmapist/_heatmap.html'
+HEATMAP_ROWS_TEMPLATE = 'bitmapist/_heatmap_rows.html'
+
+
+@bitmapist_bp.route('/cohort/stream')
+def cohort_stream():
+    """
+    Stream the cohort heatmap as server-sent events, a row at a time as the
+    rows are computed: ``start`` with the empty table, then ``row`` for each
+    row with the averages and totals so far, then ``done``. Takes the same
+    settings as the cohort page as query string arguments
+    (``additional_events`` JSON-encoded), since ``EventSource`` only GETs.
+    """
+    settings = _cohort_settings(request.args, page=True)
+    as_percent = _flag(request.args.get('as_percent'))
+    num_cols = settings['num_cols']
+    dt_format = _date_format(settings['time_group'])
+
+    heatmap_row = get_template_attribute(HEATMAP_ROWS_TEMPLATE, 'heatmap_row')
+    summary_rows = get_template_attribute(HEATMAP_ROWS_TEMPLATE, 'summary_rows')
+
+    def events():
+        totals = _CohortTotals(num_cols, as_percent)
+        yield _event('start', {
+            'num_rows': settings['num_rows'],
+            'num_cols': num_cols,
+            'html': render_template(HEATMAP_TEMPLATE, cohort=[], dates=[], row_totals=[],
+                                    total=0, col_totals=totals.col_totals,
+                                    averages=totals.averages(), num_rows=0, num_cols=num_cols,
+                                    time_group=settings['time_group'], as_percent=as_percent),
+        })
+
+        # The first row is computed on its own, so it shows as soon as it can
+        rows = iter_cohort(first_chunk_size=1, **settings)
+        for i, (date, row_total, row) in enumerate(rows):
+            row = totals.add(row, row_total)
+            averages = totals.averages()
+            yield _event('row', {
+                'index': i,
+                'date': date.strftime(dt_format),
+                'total': row_total,
+                'cohort': row,
+                'html': heatmap_row(date.strftime(dt_format), row_total, row, num_cols,
+                                    as_percent),
+                'summary': summary_rows(totals.total, totals.num_rows, averages,
+                                        totals.col_totals, as_percent),
+            })
+
+        yield _event('done', {'total': totals.total, 'col_totals': totals.col_totals,
+                              'averages': totals.averages()})
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keep proxies such as nginx from buffering the events
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _event(name, data):
+    return 'event: %s\ndata: %s\n\n' % (name, json.dumps(data, default=str))
+
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+@bitmapist_bp.route('/cohort/export', methods=['GET', 'POST'])
+def cohort_export():
+    """
+    Stream a cohort as CSV or NDJSON (``format``), a row at a time as the
+    rows are computed. Takes the same settings as the cohort page, as a JSON
+    body or as query string arguments (``additional_events`` JSON-encoded).
+    """
+    data = json.loads(request.data) if request.data else request.args
+    export_format = data.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+
+    settings = _cohort_settings(data)
+    rows = iter_cohort(**settings)
+
+    if export_format == 'csv':
+        lines = _csv_lines(rows, settings['num_cols'])
+    else:
+        lines = _ndjson_lines(rows)
+
+    response = Response(stream_with_context(lines), mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = 'attachment; filename=cohort.%s' % export_format
+    return response
+
+
+def _csv_lines(rows, num_cols):
+    def line(values):
+        buf = StringIO()
+        csv.writer(buf).writerow(values)
+        return buf.getvalue()
+
+    yield line(['date', 'total'] + list(range(num_cols)))
+    for date, total, row in rows:
+        yield line([date.strftime('%Y-%m-%d'), total] + ['' if r is None else r for r in row])
+
+
+def _ndjson_lines(rows):
+    for date, total, row in rows:
+        yield json.dumps({'date': date.strftime('%Y-%m-%d'), 'total': total,
+                          'cohort': row}, default=str) + '\n'
+
+
+# Most sparse keys and growing events the memory page lists
+MAX_MEMORY_TOP = 1000
+
+
+@bitmapist_bp.route('/memory')
+def memory():
+    """
+    The memory event keys take by event and time group, with sparse keys and
+    the fastest-growing events; see :func:`flask_bitmapist.memory.memory_report`.
+    """
+    # None for a ``top`` that is not an integer
+    top = request.args.get('top', type=int) if 'top' in request.args else 10
+    if top is None or top < 1:
+        abort(400)
+    report = memory_report(top=min(top, MAX_MEMORY_TOP))
+    if request.args.get('json'):
+        return json.dumps(report, indent=4)
+    return render_template('bitmapist/memory.html', growth_days=GROWTH_DAYS,
+                           sparse_density=SPARSE_DENSITY, **report)
+
+
+@bitmapist_bp.route('/metrics')
+def metrics_text():
+    "Marking and query metrics in the Prometheus text format, with ``BITMAPIST_METRICS``"
+    if not metrics.ENABLED:
+        abort(404)
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def _flag(value):
+    return value in (True, 'true', '1')
+
+
+# Most rows and columns a cohort request may ask for, a year of days
+MAX_COHORT_SIZE = 366
+
+
+def _cohort_size(data, name, default):
+    try:
+        size = int(data.get(name, default))
+    except (TypeError, ValueError):
+        abort(400)
+    if size < 1:
+        abort(400)
+    return min(size, MAX_COHORT_SIZE)
+
+
+def _cohort_settings(data, page=False):
+    """
+    Arguments for :func:`~flask_bitmapist.utils.get_cohort` from a cohort
+    request, either a JSON body or query string arguments; the number of rows
+    and columns is limited to ``MAX_COHORT_SIZE``, and with ``page`` to what
+    the cohort page shows.
+    """
+    additional_events = data.get('additional_events', [])
+    if isinstance(additional_events, string_types):
+        additional_events = json.loads(additional_events)
+    time_group = data.get('time_group', 'days')
+    num_rows = _cohort_size(data, 'num_rows', 20)
+    num_cols = _cohort_size(data, 'num_cols', 10)
+
+    if page:
+        if time_group == 'years':
+            # Three shall be the number thou shalt count, and the number of the
+            # counting shall be three. Four shalt thou not count, neither count thou
+            # two, excepting that thou then proceed to three. Five is right out.
+            num_rows = 3
+
+        # Columns > rows would extend into future and thus would just be empty
+        num_cols = num_rows if num_cols > num_rows else num_cols
+
+    return {
+        'primary_event_name': data.get('primary_event'),
+        'secondary_event_name': data.get('secondary_event'),
+        'additional_events': additional_events,
+        'time_group': time_group,
+        'num_rows': num_rows,
+        'num_cols': num_cols,
+        'with_replacement': _flag(data.get('with_replacement')),
+    }
+
+
+def _date_format(time_group):
+    if time_group == 'years':
+        return '%Y'
+    elif time_group == 'months':
+        return '%b %Y'
+    elif time_group == 'weeks':
+        return 'Week %U - %d %b %Y'
+    return '%d %b %Y'
+
+
+class _CohortTotals(object):
+    """
+    Running totals and averages of a cohort's rows, as shown under its
+    heatmap: column totals are of numbers of users, while column averages are
+    of the values shown, i.e. of percents with ``as_percent``. Rows past their
+    retention are left out.
+    """
+
+    def __init__(self, num_cols, as_percent=False):
+        self.as_percent = as_percent
+        self.total = 0
+        self.num_rows = 0
+        self.col_counts = [0] * num_cols
+        self.col_totals = [0] * num_cols
+        self._col_sums = [0] * num_cols
+
+    def add(self, row, row_total):
+        "Add a row to the totals, returning its values as shown"
+        if row_total is EXPIRED:
+            return row
+        self.total += row_total
+        self.num_rows += 1
+        shown = row
+        if self.as_percent and row_total:
+            shown = [float(r) / row_total if r is not None else r for r in row]
+        for j, (value, shown_value) in enumerate(zip(row, shown)):
+            if value is not None:
+                self.col_counts[j] += 1
+                self.col_totals[j] += value
+                self._col_sums[j] += shown_value
+        return shown
+
+    def averages(self):
+        return [float(col_sum) / col_count if col_count else 0
+                for col_sum, col_count in zip(self._col_sums, self.col_counts)]
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_bitmapist.worker
+    ~~~~~~~~~~~~~~~~~~~~~~
+    Background thread that writes marks to Redis in batches.
+
+    :copyright: (c) 2016 by Cuttlesoft, LLC.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from ._compat import queue
+from .utils import mark_events
+
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+_STOP = object()
+
+
+class MarkWorker(object):
+    """
+    Writes queued marks from a background thread, so that marking only costs
+    a request an in-memory enqueue.
+
+    :param int maxsize: Maximum number of marks waiting to be written
+    :param int batch_size: Maximum number of marks written per pipeline
+    :param int batch_interval: Maximum time (in milliseconds) to wait for a
+                               batch to fill up before writing it
+    :param str policy: What to do with a new mark when the queue is full;
+                       ``block`` until there is room, ``drop_oldest`` queued
+                       mark, or ``drop_newest`` (the new mark)
+    :param on_drop: Called with ``system``, ``track_hourly`` and a list of
+                    ``(event_name, uuid, now)`` marks whenever marks are
+                    dropped or fail to be written
+    """
+
+    def __init__(self, maxsize=10000, batch_size=500, batch_interval=50,
+                 policy='block', on_drop=None):
+        if policy not in POLICIES:
+            raise ValueError("policy must be one of %s" % ', '.join(POLICIES))
+
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval / 1000.0
+        self.policy = policy
+        self.on_drop = on_drop
+
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.stopped = False
+
+        # Held while starting and stopping, and while an enqueue checks
+        # whether to queue its mark (but not while it queues it, which may
+        # block), so that a process starts a single thread; marks being
+        # queued are counted, so that the thread writes them before it stops.
+        # The counters have a lock of their own
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._queueing = 0
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+
+        atexit.register(self.stop)
+
+    @property
+    def depth(self):
+        "Number of marks waiting to be written"
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'dropped': self.dropped,
+            'written': self.written,
+            'errors': self.errors,
+        }
+
+    def start(self):
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        self.queue = queue.Queue(self.maxsize)
+        self.pid = os.getpid()
+        self.stopped = False
+        self._queueing = 0
+        self.thread = threading.Thread(target=self._run, name='bitmapist-marks')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Write whatever is still queued and stop the thread; marks enqueued
+        from then on are written straight away
+        """
+        with self._lock:
+            if self.thread is None or self.pid != os.getpid() or self.stopped:
+                return
+            self.stopped = True
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def flush(self):
+        "Block until every mark queued so far has been written"
+        if self.queue is not None:
+            self.queue.join()
+
+    def enqueue(self, event_name, uuid, now, system='default', track_hourly=None):
+        with self._lock:
+            # Threads do not survive a fork; start over in the child process
+            if self.pid != os.getpid():
+                self._start()
+            stopped = self.stopped
+            if not stopped:
+                self._queueing += 1
+
+        if stopped:
+            return mark_events([(event_name, uuid, now)], system, track_hourly)
+
+        try:
+            self._put(((system, track_hourly), (event_name, uuid, now)))
+        finally:
+            with self._lock:
+                self._queueing -= 1
+
+    def _put(self, item):
+        if self.policy == 'block':
+            self.queue.put(item)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                if self.policy == 'drop_newest':
+                    self._drop([item])
+                    return
+
+            try:
+                oldest = self.queue.get_nowait()
+                self.queue.task_done()
+                self._drop([oldest])
+            except queue.Empty:
+                pass
+
+    def _drop(self, items):
+        with self._stats_lock:
+            self.dropped += len(items)
+        self._lost(items)
+
+    def _lost(self, items):
+        "Let ``on_drop`` know about queued marks that will never be written"
+        if self.on_drop is None:
+            return
+        marks = defaultdict(list)
+        for key, mark in items:
+            marks[key].append(mark)
+        for (system, track_hourly), events in marks.items():
+            try:
+                self.on_drop(system, track_hourly, events)
+            except Exception:
+                logger.exception('Failed to handle dropped bitmapist marks')
+
+    def _next_batch(self, block=True):
+        try:
+            batch = [self.queue.get(timeout=None if block else self.batch_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.time() + self.batch_interval
+
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _done(self):
+        "Whether nothing is queued, or being queued, once stopped"
+        with self._lock:
+            return not self._queueing and self.queue.empty()
+
+    def _run(self):
+        stopping = False
+        while True:
+            # Once stopped, marks that were being queued meanwhile may still
+            # arrive, after _STOP
+            batch = self._next_batch(block=not stopping)
+            stopping = stopping or _STOP in batch
+            marks = defaultdict(list)
+            for item in batch:
+                if item is not _STOP:
+                    marks[item[0]].append(item[1])
+
+            try:
+                for key, events in marks.items():
+                    try:
+                        mark_events(events, key[0], key[1])
+                        with self._stats_lock:
+                            self.written += len(events)
+                    except Exception:
+                        with self._stats_lock:
+                            self.errors += 1
+                        logger.exception('Failed to write a batch of bitmapist marks')
+                        self._lost([(key, mark) for mark in events])
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+            if stopping and self._done():
+                return
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+""" Rough latency benchmarks for Flask-Bitmapist.
+
+Usage:
+
+    $ python scripts/benchmark.py [name ...]
+
+Redis server must be running (defaults to redis://localhost:6399, override
+with BITMAPIST_REDIS_URL).
+"""
+
+import os
+import sys
+import time
+from datetime import datetime
+
+import redis
+from dateutil.relativedelta import relativedelta
+from flask import Flask
+
+import bitmapist
+from flask_bitmapist import FlaskBitmapist, get_cohort, local, mark, mark_events, utils
+from flask_bitmapist.tempkeys import TempKeys
+
+
+REDIS_URL = os.environ.get('BITMAPIST_REDIS_URL', 'redis://localhost:6399')
+REQUESTS = 1000
+EVENTS_PER_VIEW = [1, 5, 10]
+
+
+def percentile(timings, p):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * p / 100.0))]
+
+
+def report(label, timings):
+    print('%-40s p50 %7.3fms   p99 %7.3fms' % (
+        label, percentile(timings, 50) * 1000, percentile(timings, 99) * 1000))
+
+
+def make_app(**config):
+    app = Flask(__name__)
+    app.config['BITMAPIST_REDIS_URL'] = REDIS_URL
+    app.config['BITMAPIST_DISABLE_BLUEPRINT'] = True
+    app.config.update(config)
+    FlaskBitmapist(app)
+    return app
+
+
+def add_view(app, num_events):
+    def view():
+        return ''
+
+    for i in range(num_events):
+        view = mark('bench:event_%s' % i, i + 1)(view)
+
+    app.add_url_rule('/', 'view', view)
+
+
+def time_view(app, requests=REQUESTS):
+    """
+    Time how long each request takes to produce its response; closing the
+    response (and anything deferred until then) is not counted.
+    """
+    timings = []
+    client = app.test_client()
+    for _ in range(requests):
+        start = time.time()
+        response = client.get('/')
+        timings.append(time.time() - start)
+        response.close()
+    return timings
+
+
+def bench_buffered_marks():
+    for num_events in EVENTS_PER_VIEW:
+        for label, config in [('direct', {}),
+                              ('buffered', {'BITMAPIST_BUFFER_MARKS': True})]:
+            app = make_app(**config)
+            add_view(app, num_events)
+            report('%s, %s events/view' % (label, num_events), time_view(app))
+
+
+def time_calls(fn, calls=REQUESTS):
+    timings = []
+    for i in range(calls):
+        start = time.time()
+        fn(i)
+        timings.append(time.time() - start)
+    return timings
+
+
+def bench_mark_engines():
+    bitmapist.SYSTEMS['default'] = redis.Redis.from_url(REDIS_URL)
+    now = datetime.utcnow()
+
+    for batch_size in [1, 10, 100]:
+        for engine in ['pipeline', 'script']:
+            def fn(i):
+                mark_events([('bench:event_%s' % j, i, now) for j in range(batch_size)],
+                            engine=engine)
+            report('%s, %s marks/call' % (engine, batch_size), time_calls(fn))
+
+
+def bench_rollup_marks():
+    # keys written per batch of marks, with and without rollup mode
+    bitmapist.SYSTEMS['default'] = redis.Redis.from_url(REDIS_URL)
+
+    for rollup_mode in [False, True]:
+        utils.ROLLUP_MODE = rollup_mode
+        for batch_size in [1, 100]:
+            def fn(i):
+                mark_events([('bench:event_%s' % j, i, None) for j in range(batch_size)])
+            commands = utils._mark_commands([('bench:event_%s' % j, 1, None)
+                                             for j in range(batch_size)], False)
+            report('%s, %s marks/call, %s commands' % (
+                'rollup' if rollup_mode else 'direct', batch_size, len(commands)),
+                time_calls(fn))
+    utils.ROLLUP_MODE = False
+
+
+def seed_cohort(time_group, periods, users=1000):
+    marks = []
+    now = datetime.utcnow()
+    for i in range(periods):
+        date = now - relativedelta(**{time_group: i})
+        for uuid in range(users):
+            if (uuid + i) % 3:
+                marks.append(('bench:primary', uuid, date))
+            if (uuid + i) % 2:
+                marks.append(('bench:secondary', uuid, date))
+            if (uuid + i) % 5:
+                marks.append(('bench:filter', uuid, date))
+    mark_events(marks)
+
+
+def bench_cohort_engines():
+    bitmapist.SYSTEMS['default'] = redis.Redis.from_url(REDIS_URL)
+    filters = [{'name': 'bench:filter', 'op': 'and'}, {'name': 'bench:secondary', 'op': 'or'}]
+
+    for time_group, size in [('days', 12), ('weeks', 12), ('months', 6)]:
+        seed_cohort(time_group, size)
+        for engine in ['bitop', 'script', 'local']:
+            def fn(i):
+                get_cohort('bench:primary', 'bench:secondary', list(filters), time_group,
+                           size, size, engine=engine)
+            report('%s, %s %sx%s' % (engine, time_group, size, size), time_calls(fn, 10))
+
+
+def bench_cohort_commands():
+    # Redis commands and temporary keys per cohort, rather than time
+    bitmapist.SYSTEMS['default'] = redis.Redis.from_url(REDIS_URL)
+    cli = bitmapist.SYSTEMS['default']
+    filters = [{'name': 'bench:filter', 'op': 'and'}, {'name': 'bench:secondary', 'op': 'or'}]
+
+    for time_group, size in [('days', 12), ('weeks', 12)]:
+        seed_cohort(time_group, size)
+        for with_replacement in [False, True]:
+            temp_keys = TempKeys()
+            commands = cli.info()['total_commands_processed']
+            get_cohort('bench:primary', 'bench:secondary', list(filters), time_group,
+                       size, size, with_replacement=with_replacement, temp_keys=temp_keys)
+            # less the INFO command itself
+            commands = cli.info()['total_commands_processed'] - commands - 1
+            stats = temp_keys.stats()
+            print('%-40s %6s commands %6s temp keys %8s bytes' % (
+                '%s %sx%s%s' % (time_group, size, size,
+                                ', with replacement' if with_replacement else ''),
+                commands, stats['keys'], stats['bytes']))
+
+
+def bench_sparse_cohort():
+    # a few thousand ids each, out of 50M
+    bitmapist.SYSTEMS['default'] = redis.Redis.from_url(REDIS_URL)
+    marks = []
+    now = datetime.utcnow()
+    for i in range(10):
+        date = now - relativedelta(days=i)
+        for n in range(2000):
+            uuid = (n * 24989 + i * 7919) % 50000000
+            marks.append(('bench:sparse_primary', uuid, date))
+            if n % 3:
+                marks.append(('bench:sparse_secondary', uuid, date))
+    mark_events(marks)
+
+    for label, threshold in [('dense', 0), ('roaring', local.SPARSE_THRESHOLD)]:
+        local.SPARSE_THRESHOLD = threshold
+
+        def fn(i):
+            get_cohort('bench:sparse_primary', 'bench:sparse_secondary', [], 'days', 10, 10,
+                       engine='local')
+        report('local %s, days 10x10' % label, time_calls(fn, 10))
+
+
+BENCHMARKS = {
+    'cohort_commands': bench_cohort_commands,
+    'buffered_marks': bench_buffered_marks,
+    'cohort_engines': bench_cohort_engines,
+    'mark_engines': bench_mark_engines,
+    'rollup_marks': bench_rollup_marks,
+    'sparse_cohort': bench_sparse_cohort,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print('== %s' % name)
+        BENCHMARKS[name]()
@@ -73,6 +73,9 @@ setup(
         'Flask>=0.9',
         'bitmapist>=3.97'
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     tests_require=get_requirements('-test'),
     cmdclass={'test': PyTest},
     classifiers=[
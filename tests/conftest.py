@@ -3,6 +3,7 @@
 import pytest
 import redis
 import os
+import sys
 
 from flask import Flask
 # from flask_login import LoginManager
@@ -11,6 +12,10 @@ from flask_bitmapist import FlaskBitmapist
 from flask_bitmapist.mixins import Bitmapistable
 
 
+# The asyncio API is Python 3 only
+collect_ignore = ['test_aio.py'] if sys.version_info[0] == 2 else []
+
+
 @pytest.fixture(scope='session')
 def app(request):
     app = Flask(__name__)
@@ -76,7 +81,7 @@ def setup_redis_for_bitmapist():
 @pytest.fixture(autouse=True)
 def clean_redis():
     cli = redis.Redis(host='localhost', port=6399)
-    keys = cli.keys('trackist_*')
+    keys = cli.keys('trackist_*') + cli.keys('flask_bitmapist:*')
     if len(keys) > 0:
         cli.delete(*keys)
 
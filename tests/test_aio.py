@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('redis.asyncio')
+
+from bitmapist import WeekEvents  # noqa: E402
+
+from flask_bitmapist import (EXPIRED, aio, get_cohort, get_event_members, retention,  # noqa: E402
+                             utils)
+from flask_bitmapist.idmap import IdMap  # noqa: E402
+
+
+now = datetime.utcnow()
+
+
+@pytest.fixture(autouse=True)
+def setup_aio_redis():
+    aio.setup_redis('default', 'redis://localhost:6399')
+
+
+def test_aio_mark_events():
+    async def run():
+        await aio.mark_events([('aio', 1, now), ('aio', 2, now)])
+        await aio.mark_event('aio', 3, now=now)
+
+        day = await aio.get_event_data('aio', 'days', now)
+        assert await day.get_count() == 3
+        assert await day.includes(3)
+        assert not await day.includes(4)
+
+        year = await aio.get_event_data('aio', 'years', now)
+        assert await year.get_count() == 3
+
+    asyncio.run(run())
+
+
+def test_aio_rollup_mode(monkeypatch):
+    monkeypatch.setattr(utils, 'ROLLUP_MODE', True)
+
+    async def run():
+        await aio.mark_events([('aio_rollup', 1, now), ('aio_rollup', 2, now)])
+        assert not await aio.get_redis().exists(WeekEvents.from_date('aio_rollup', now).redis_key)
+        for time_group in ('weeks', 'months', 'years'):
+            events = await aio.get_event_data('aio_rollup', time_group, now)
+            assert await events.get_count() == 2
+
+    asyncio.run(run())
+
+
+def test_aio_retention(monkeypatch):
+    monkeypatch.setattr(retention, 'RETENTION', {'days': 1})
+
+    async def run():
+        await aio.mark_events([('aio_retained', 1, now - timedelta(days=i)) for i in range(3)])
+        assert await aio.get_event_data('aio_retained', 'days', now - timedelta(days=3)) is EXPIRED
+        cohort, _, totals = await aio.get_cohort('aio_retained', 'aio_retained', num_rows=3,
+                                                 num_cols=1)
+        assert totals == [EXPIRED, 1, 1]
+        assert cohort == [[EXPIRED], [1], [1]]
+
+    asyncio.run(run())
+
+
+def test_aio_id_map(monkeypatch):
+    id_map = IdMap(prefix='flask_bitmapist:aio_ids:')
+    monkeypatch.setattr(utils, 'ID_MAP', id_map)
+
+    async def run():
+        await aio.get_redis().delete(*id_map.keys)
+        await aio.mark_events([('aio_mapped', 'u-1', now), ('aio_mapped', 2 ** 63, now)])
+        day = await aio.get_event_data('aio_mapped', 'days', now)
+        assert await day.includes('u-1')
+        assert await day.includes(2 ** 63)
+        assert not await day.includes('u-2')
+        # 1 is u-1's compact id, not an external id that has been marked
+        assert not await day.includes(1)
+
+        # ids that are not cached are looked up in Redis
+        id_map.clear()
+        assert await day.includes('u-1')
+
+    asyncio.run(run())
+    assert id_map.lookup(['u-1', 2 ** 63]) == [1, 0]
+    assert get_event_members('aio_mapped', 'days', now) == [str(2 ** 63), 'u-1']
+
+
+def test_aio_mark_decorator():
+    @aio.mark(['aio_a', 'aio_b'], lambda: 5)
+    async def view():
+        return ''
+
+    @aio.mark('aio_after', 6, when='after', condition=lambda rv: rv == 'ok')
+    async def failing_view():
+        return 'error'
+
+    async def run():
+        await view()
+        await failing_view()
+        for event_name in ['aio_a', 'aio_b']:
+            assert await (await aio.get_event_data(event_name, 'days')).includes(5)
+        assert not await (await aio.get_event_data('aio_after', 'days')).includes(6)
+
+    asyncio.run(run())
+
+
+def test_aio_chain_events():
+    async def run():
+        await aio.mark_events([('aio_base', uuid, now) for uuid in (1, 2, 3)] +
+                              [('aio_and', uuid, now) for uuid in (2, 3)] +
+                              [('aio_or', uuid, now) for uuid in (1,)])
+
+        events = [{'name': 'aio_and', 'op': 'and'}, {'name': 'aio_or', 'op': 'or'}]
+        chained = await aio.chain_events('aio_base', events, now, 'days')
+        assert await chained.get_count() == 3
+        assert len(events) == 2  # the caller's list is left alone
+
+        # the result is left to expire, and nothing else is left at all
+        cli = aio.get_redis()
+        assert 0 < await cli.ttl(chained.redis_key) <= 60
+        assert await cli.keys('flask_bitmapist:tmp:*') == [chained.redis_key.encode()]
+        await cli.delete(chained.redis_key)
+
+        assert await aio.chain_events('aio_nothing', events, now, 'days') is None
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('with_replacement', [False, True])
+def test_aio_get_cohort(with_replacement):
+    async def run():
+        await aio.mark_events([('aio_primary', uuid, now) for uuid in (1, 2, 3)] +
+                              [('aio_secondary', uuid, now) for uuid in (1, 2)])
+        result = await aio.get_cohort('aio_primary', 'aio_secondary', time_group='days',
+                                      num_rows=3, num_cols=3, with_replacement=with_replacement)
+        # only the query's own keys are deleted, and none are left behind
+        assert not await aio.get_redis().keys('flask_bitmapist:tmp:*')
+        return result
+
+    cohort, _, totals = asyncio.run(run())
+    expected, _, expected_totals = get_cohort('aio_primary', 'aio_secondary', time_group='days',
+                                              num_rows=3, num_cols=3,
+                                              with_replacement=with_replacement)
+    assert cohort == expected
+    assert totals == expected_totals
@@ -1,16 +1,37 @@
 # -*- coding: utf-8 -*-
 
+from array import array
+from copy import deepcopy
 from datetime import datetime, timedelta
+import json
 import mock
+import os
+import pytest
 from random import randint
-
-from flask import request
+import threading
+import time
+
+from bitmapist import SYSTEMS
+from dateutil.relativedelta import relativedelta
+from flask import Flask, request
+import redis
+from redis.connection import Connection, SSLConnection, UnixDomainSocketConnection
+from redis.exceptions import RedisError
 from flask_login import LoginManager, UserMixin, current_user, login_user, logout_user
+from sqlalchemy import event as sqlalchemy_event
 
-from flask_bitmapist import (chain_events, get_cohort, get_event_data,
-                             mark, mark_event, unmark_event,
+from flask_bitmapist import (EXPIRED, FlaskBitmapist, chain_events, get_cohort, get_event_counts,
+                             get_event_data, get_event_members, get_event_names, iter_cohort,
+                             mark, mark_event,
+                             mark_events, unmark_event,
                              MonthEvents, WeekEvents, DayEvents, HourEvents)
+from flask_bitmapist import local, roaring, rollup, utils, views
+from flask_bitmapist._compat import queue
+from flask_bitmapist.cache import COHORT_CACHE_PREFIX, COHORT_CACHE_TTL, CohortCache, LRUCache
 from flask_bitmapist.extensions.flask_login import mark_login, mark_logout
+from flask_bitmapist.roaring import RoaringBitmap, Runs
+from flask_bitmapist.tempkeys import TempKeys
+from flask_bitmapist.worker import _STOP, MarkWorker
 
 
 # import necessary for test_user_login/logout, but unused fails pyflakes
@@ -20,6 +41,18 @@ mark_logout
 now = datetime.utcnow()
 
 
+def make_app(**config):
+    # separate app for tests that need non-default config, since the `app`
+    # fixture is shared by the whole session
+    app = Flask(__name__)
+    app.config['TESTING'] = True
+    app.config['BITMAPIST_REDIS_URL'] = 'redis://localhost:6399'
+    app.config['BITMAPIST_DISABLE_BLUEPRINT'] = True
+    app.config.update(config)
+    FlaskBitmapist(app)
+    return app
+
+
 # COHORTS
 
 def setup_users(now=None):
@@ -69,6 +102,63 @@ def setup_chain_events(time_group='days'):
     return setup_users(), addons
 
 
+def test_chain_events_leaves_events_to_chain():
+    time_group = 'days'
+    users, addons = setup_chain_events(time_group)
+    events = [addons['and_o'], addons['or_c'], addons['and_d'], addons['or_u']]
+    copied = deepcopy(events)
+
+    chained = chain_events('user:logged_in', events, now, time_group)
+    assert events == copied
+    assert len(chain_events('user:logged_in', events, now, time_group)) == len(chained)
+
+
+def test_chain_events_order():
+    for uuid in range(300, 340):
+        mark_event('ordered:base', uuid)
+        mark_event('ordered:big', uuid)
+        if uuid % 10 == 0:
+            mark_event('ordered:small', uuid)
+    mark_event('ordered:disjoint', 1)
+
+    ands = []
+    real_bitop = TempKeys.bitop
+
+    def bitop(temp_keys, op_name, *events):
+        if op_name == 'AND':
+            ands.append([event.redis_key for event in events])
+        return real_bitop(temp_keys, op_name, *events)
+
+    with mock.patch.object(TempKeys, 'bitop', bitop):
+        chained = chain_events('ordered:base', [{'name': 'ordered:big', 'op': 'and'},
+                                                {'name': 'ordered:small', 'op': 'and'}],
+                               now, 'days')
+        assert len(chained) == 4
+        # the smallest event is chained first
+        assert 'ordered:small' in ands[0][0]
+        assert len(ands) == 2
+
+        # chaining stops once nothing is left
+        ands[:] = []
+        chained = chain_events('ordered:base', [{'name': 'ordered:disjoint', 'op': 'and'},
+                                                {'name': 'ordered:big', 'op': 'and'},
+                                                {'name': 'ordered:small', 'op': 'and'}],
+                               now, 'days')
+        assert len(chained) == 0
+        assert len(ands) == 1
+
+        # nothing is chained to an event that has nothing marked
+        ands[:] = []
+        chained = chain_events('ordered:base', [{'name': 'ordered:big', 'op': 'and'},
+                                                {'name': 'ordered:missing', 'op': 'and'}],
+                               now, 'days')
+        assert len(chained) == 0
+        assert ands == []
+
+    assert chain_events('ordered:missing', [{'name': 'ordered:big', 'op': 'and'}],
+                        now, 'days') == ''
+
+
 # Test contents of cohort returns
 def test_get_cohort_contents():
     # Generate events to ensure specific cohort returns
@@ -177,35 +267,16 @@ def test_get_cohort_contents():
 
 
 # Test structure of cohort returns
-@mock.patch('flask_bitmapist.utils.BitOpAnd')
-@mock.patch('flask_bitmapist.utils.BitOpOr')
-@mock.patch('flask_bitmapist.utils.BitOpXor')
-@mock.patch('flask_bitmapist.utils.chain_events')
-@mock.patch('flask_bitmapist.utils.YearEvents')
-@mock.patch('flask_bitmapist.utils.MonthEvents')
-@mock.patch('flask_bitmapist.utils.WeekEvents')
-def test_get_cohort_structure(mock_week_events, mock_month_events,
-                              mock_year_events, mock_chain_events,
-                              mock_bit_op_xor, mock_bit_op_or, mock_bit_op_and):
-    # Generate list of ints to act as user ids;
-    # - between calls, should have some duplicate and some distinct
-    # - temporarily convert to a set to force unique list items
-
-    def e():
-        return list(set([randint(1, 25) for n in range(10)]))
-
-    def ee():
-        return [e() for n in range(100)]
-
-    mock_week_events.side_effect = ee()
-    mock_month_events.side_effect = ee()
-    mock_year_events.side_effect = ee()
-    mock_chain_events.side_effect = ee()
-
-    # Simulate BitOpAnd & BitOpOr returns but with lists
-    mock_bit_op_and.side_effect = lambda x, y: list(set(x) & set(y))
-    mock_bit_op_or.side_effect = lambda x, y: list(set(x) | set(y))
-    mock_bit_op_xor.side_effect = lambda x, y: list(set(x) ^ set(y))
+def test_get_cohort_structure():
+    # Mark random user ids for both events over the past couple of years;
+    # - between periods, should have some duplicate and some distinct ids
+    marks = []
+    for days_ago in range(0, 730, 5):
+        for uuid in set([randint(1, 25) for n in range(10)]):
+            marks.append(('A', uuid, now - timedelta(days=days_ago)))
+        for uuid in set([randint(1, 25) for n in range(10)]):
+            marks.append(('B', uuid, now - timedelta(days=days_ago)))
+    mark_events(marks, track_hourly=False)
 
     c1, d1, t1 = get_cohort('A', 'B', time_group='weeks', num_rows=4, num_cols=4)
     c2, d2, t2 = get_cohort('A', 'B', time_group='months', num_rows=6, num_cols=5)
@@ -225,6 +296,9 @@ def test_get_cohort_structure(mock_week_events, mock_month_events,
     assert len(c1[0]) == 4
     assert len(c2[0]) == 5
     assert len(c3[0]) == 3
+    # No working keys are left behind
+    assert not SYSTEMS['default'].keys('flask_bitmapist:tmp:*')
+    assert not SYSTEMS['default'].keys('trackist_bitop_*')
 
     # Assert date values based on time_group given
     #     - dates are old->new, so use num_rows-1 to adjust index for timedelta
@@ -268,6 +342,83 @@ def test_chain_events():
         assert u[1] in get_event_data('user:logged_in', time_group, now)
 
 
+def test_get_event_counts():
+    last_month = now - relativedelta(months=1)
+    mark_events([('counted:a', 1, now), ('counted:a', 2, now), ('counted:a', 2, last_month),
+                 ('counted:a', 3, last_month), ('counted:b', 4, now)], track_hourly=False)
+
+    counts = get_event_counts(['counted:a', 'counted:b', 'counted:none'], now=now)
+    for event_name in ['counted:a', 'counted:b', 'counted:none']:
+        assert counts[event_name] == [len(get_event_data(event_name, time_group, now))
+                                      for time_group in ['days', 'weeks', 'months', 'years']]
+    if last_month.year == now.year:
+        assert counts['counted:a'][3] == 3
+
+    assert get_event_counts(['counted:a'], ['years', 'days'], now) == {
+        'counted:a': [counts['counted:a'][3], 2]}
+    assert get_event_counts([], now=now) == {}
+
+    # no working keys are left behind
+    assert not SYSTEMS['default'].keys('flask_bitmapist:tmp:*')
+
+
+def test_event_count_views():
+    app = make_app(BITMAPIST_DISABLE_BLUEPRINT=False)
+    mark_events([('user:logged_in', 1, now), ('user:created', 1, now)], track_hourly=False)
+
+    client = app.test_client()
+    with mock.patch('flask_bitmapist.views.get_event_counts',
+                    wraps=get_event_counts) as counts:
+        assert client.get('/bitmapist/').status_code == 200
+        assert client.get('/bitmapist/cohort').status_code == 200
+    assert counts.call_count == 2
+
+
+def test_temp_keys():
+    mark_events([('temp:a', uuid, now) for uuid in range(100, 140)] +
+                [('temp:b', uuid, now) for uuid in range(120, 160)])
+    a, b = DayEvents.from_date('temp:a', now), DayEvents.from_date('temp:b', now)
+
+    with TempKeys(ttl=30) as temp_keys:
+        both = temp_keys.bitop('AND', a, b)
+        assert both.redis_key.startswith(temp_keys.namespace)
+        assert 0 < SYSTEMS['default'].ttl(both.redis_key) <= 30
+        assert len(both) == 20
+        assert 125 in both
+        # repeated operations reuse their result
+        assert temp_keys.bitop('AND', a, b).redis_key == both.redis_key
+
+        # another query's keys are its own, and cleaning them up leaves these
+        other = TempKeys()
+        assert other.bitop('AND', a, b).redis_key != both.redis_key
+        other.cleanup()
+        assert len(both) == 20
+        assert other.stats()['keys'] == 1
+
+    assert not SYSTEMS['default'].exists(both.redis_key)
+    stats = temp_keys.stats()
+    assert stats['keys'] == 1
+    assert stats['bytes'] == len(b'\x00' * (159 // 8 + 1))
+
+    # a cohort's intermediate results are reported and cleaned up with it
+    temp_keys = TempKeys()
+    get_cohort('temp:a', 'temp:b', [{'name': 'temp:a', 'op': 'and'}], 'days', 3, 3,
+               engine='bitop', temp_keys=temp_keys)
+    assert temp_keys.stats()['keys'] > 2
+    assert temp_keys.stats()['bytes'] > 0
+    assert not SYSTEMS['default'].keys('flask_bitmapist:tmp:*')
+
+    # without temp keys of the caller's, chain_events' result expires, and
+    # the intermediate results are cleaned up
+    chained = chain_events('temp:a', [{'name': 'temp:b', 'op': 'and'}], now, 'years')
+    assert len(chained) == 20
+    assert 0 < SYSTEMS['default'].ttl(chained.redis_key) <= 60
+    assert SYSTEMS['default'].keys('flask_bitmapist:tmp:*') == [chained.redis_key.encode()]
+    chained.delete()
+    assert not SYSTEMS['default'].keys('flask_bitmapist:tmp:*')
+    assert not SYSTEMS['default'].keys('trackist_bitop_*')
+
+
 def test_chain_events_with_and():
     base = 'user:logged_in'
     time_group = 'days'
@@ -562,6 +713,99 @@ def test_sqlalchemy_before_delete(sqlalchemy):
         assert user_id in MonthEvents('user:deleted', now.year, now.month)
 
 
+def test_sqlalchemy_marks_written_on_commit(sqlalchemy):
+    db, User = sqlalchemy
+
+    with db.app.test_request_context():
+        user = User(name='Test User')
+        db.session.add(user)
+        db.session.flush()
+
+        # flushed, but not committed yet
+        assert user.id not in DayEvents('user:created', now.year, now.month, now.day)
+
+        db.session.commit()
+        assert user.id in DayEvents('user:created', now.year, now.month, now.day)
+
+
+def test_metrics_mixin(sqlalchemy, monkeypatch):
+    from flask_bitmapist import metrics
+
+    db, User = sqlalchemy
+    monkeypatch.setattr(metrics, 'ENABLED', True)
+    mixin_calls = metrics.CALL_SECONDS.get('mixin_mark')[0]
+    marks = metrics.MARKS.get('user:created')
+    with db.app.test_request_context():
+        db.session.add(User(name='Test User'))
+        db.session.commit()
+    assert metrics.CALL_SECONDS.get('mixin_mark')[0] == mixin_calls + 1
+    assert metrics.MARKS.get('user:created') == marks + 1
+
+
+def test_sqlalchemy_marks_discarded_on_rollback(sqlalchemy):
+    db, User = sqlalchemy
+
+    with db.app.test_request_context():
+        user = User(name='Test User')
+        db.session.add(user)
+        db.session.flush()
+        user_id = user.id
+
+        db.session.rollback()
+        db.session.commit()
+        assert user_id not in DayEvents('user:created', now.year, now.month, now.day)
+
+
+def test_sqlalchemy_marks_discarded_on_savepoint_rollback(sqlalchemy):
+    db, User = sqlalchemy
+
+    with db.app.test_request_context():
+        # pysqlite needs a hand to support SAVEPOINT; see "Serializable
+        # isolation / Savepoints / Transactional DDL" in the SQLAlchemy docs
+        @sqlalchemy_event.listens_for(db.engine, 'connect')
+        def do_connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @sqlalchemy_event.listens_for(db.engine, 'begin')
+        def do_begin(connection):
+            connection.execute('BEGIN')
+
+        kept = User(name='Kept User')
+        db.session.add(kept)
+        db.session.flush()
+
+        db.session.begin_nested()
+        discarded = User(name='Discarded User')
+        db.session.add(discarded)
+        db.session.flush()
+        discarded_id = discarded.id
+        db.session.rollback()
+
+        db.session.commit()
+        assert kept.id in DayEvents('user:created', now.year, now.month, now.day)
+        assert discarded_id not in DayEvents('user:created', now.year, now.month, now.day)
+
+
+def test_sqlalchemy_bulk_update_and_delete(sqlalchemy):
+    db, User = sqlalchemy
+
+    with db.app.test_request_context():
+        db.session.add_all([User(name='Bulk User') for _ in range(3)])
+        db.session.commit()
+        user_ids = [user.id for user in User.query.all()]
+
+        query = User.query.filter(User.id.in_(user_ids))
+        query.update({'name': 'Bulk Updated'}, synchronize_session='fetch')
+        db.session.commit()
+        for user_id in user_ids:
+            assert user_id in DayEvents('user:updated', now.year, now.month, now.day)
+
+        query.delete(synchronize_session='fetch')
+        db.session.commit()
+        for user_id in user_ids:
+            assert user_id in DayEvents('user:deleted', now.year, now.month, now.day)
+
+
 # GENERAL (redis, decorator, marking events, etc.)
 
 def test_redis_url_config(app, bitmap):
@@ -572,6 +816,71 @@ def test_redis_system_name_config(app, bitmap):
     assert 'default' in bitmap.SYSTEMS.keys()
 
 
+def test_redis_connection_pool():
+    pool = utils._get_connection_pool('redis://:secret@localhost:6380/3', max_connections=5,
+                                      socket_connect_timeout=None)
+    assert pool.connection_class is Connection
+    assert pool.max_connections == 5
+    assert pool.connection_kwargs['host'] == 'localhost'
+    assert pool.connection_kwargs['port'] == 6380
+    assert pool.connection_kwargs['db'] == 3
+    assert pool.connection_kwargs['password'] == 'secret'
+    assert 'socket_connect_timeout' not in pool.connection_kwargs
+
+    pool = utils._get_connection_pool('rediss://localhost:6380')
+    assert pool.connection_class is SSLConnection
+
+    # TCP-only options are dropped for unix sockets
+    pool = utils._get_connection_pool('unix:///tmp/redis.sock?db=2', socket_timeout=1,
+                                      socket_keepalive=True)
+    assert pool.connection_class is UnixDomainSocketConnection
+    assert pool.connection_kwargs['path'] == '/tmp/redis.sock'
+    assert pool.connection_kwargs['db'] == 2
+    assert pool.connection_kwargs['socket_timeout'] == 1
+    assert 'socket_keepalive' not in pool.connection_kwargs
+
+
+def test_redis_connection_pool_config():
+    app = make_app(BITMAPIST_REDIS_MAX_CONNECTIONS=7, BITMAPIST_REDIS_SOCKET_TIMEOUT=2)
+    ext = app.extensions['bitmapist']
+
+    assert ext.pool.max_connections == 7
+    assert ext.pool.connection_kwargs['socket_timeout'] == 2
+    assert SYSTEMS['default'].connection_pool is ext.pool
+
+
+def test_redis_connection_pool_after_fork():
+    app = make_app()
+    ext = app.extensions['bitmapist']
+
+    @app.route('/forked')
+    @mark('forked', 134)
+    def forked():
+        return ''
+
+    def fork():
+        # pretend the pool was set up in a parent process
+        SYSTEMS['default'].get('forked')
+        ext.pool.pid = -1
+
+    fork()
+    with app.test_client() as client:
+        client.get('/forked')
+    assert len(ext.pool.inherited) == 1
+    assert ext.pool.pid == os.getpid()
+
+    # marks and queries outside of a request start it over too
+    fork()
+    mark_events([('forked', 135, now)])
+    assert len(ext.pool.inherited) == 2
+    fork()
+    assert get_event_data('forked').get_count() == 2
+    assert len(ext.pool.inherited) == 3
+
+    assert SYSTEMS['default'].connection_pool is ext.pool
+    assert 134 in DayEvents('forked', now.year, now.month, now.day)
+
+
 def test_track_hourly_config(app, bitmap):
     assert bitmap.TRACK_HOURLY is False
 
@@ -632,3 +941,1199 @@ def test_unmark_function(app, client):
 
     unmark_event('active', 126)
     assert 126 not in MonthEvents('active', now.year, now.month)
+
+
+def test_mark_events(app, client):
+    yesterday = now - timedelta(days=1)
+    mark_events([('batch_a', 127, None), ('batch_b', 128, yesterday)])
+
+    assert 127 in DayEvents('batch_a', now.year, now.month, now.day)
+    assert 128 in DayEvents('batch_b', yesterday.year, yesterday.month, yesterday.day)
+    assert 128 not in DayEvents('batch_b', now.year, now.month, now.day)
+
+
+@mock.patch('flask_bitmapist.utils.BITFIELD_CHUNK_SIZE', 3)
+def test_mark_events_coalesced(app, client):
+    mark_events([('coalesced', uuid, now) for uuid in range(200, 210)] +
+                [('coalesced_single', 210, now)])
+
+    day = DayEvents('coalesced', now.year, now.month, now.day)
+    assert len(day) == 10
+    for uuid in range(200, 210):
+        assert uuid in day
+        assert uuid in MonthEvents('coalesced', now.year, now.month)
+    assert 210 in DayEvents('coalesced_single', now.year, now.month, now.day)
+
+
+@mock.patch('flask_bitmapist.scripting.SCRIPT_BATCH_SIZE', 2)
+def test_mark_events_script(app, client):
+    # month/year and ISO week boundaries, a leap day and the last hour of a day
+    dates = [datetime(2015, 12, 31, 23, 59), datetime(2016, 1, 1), datetime(2016, 2, 29, 12),
+             datetime(2018, 12, 31, 6), datetime(2021, 1, 3, 23, 30), now]
+    marks = [('scripted', 300 + i, date) for i, date in enumerate(dates)]
+
+    mark_events(marks, track_hourly=True, engine='script')
+
+    for _, uuid, date in marks:
+        for cls in (MonthEvents, WeekEvents, DayEvents, HourEvents):
+            assert uuid in cls.from_date('scripted', date)
+        assert uuid not in DayEvents.from_date('scripted', date - timedelta(days=1))
+
+
+def test_mark_engine_config():
+    make_app(BITMAPIST_MARK_ENGINE='script')
+    assert utils.MARK_ENGINE == 'script'
+
+    with pytest.raises(ValueError):
+        make_app(BITMAPIST_MARK_ENGINE='carrier_pigeon')
+
+    make_app()
+    assert utils.MARK_ENGINE == 'pipeline'
+
+
+def test_buffered_marks():
+    app = make_app(BITMAPIST_BUFFER_MARKS=True)
+
+    @app.route('/buffered')
+    @mark('buffered_a', 129)
+    @mark('buffered_b', 130)
+    def buffered():
+        # nothing is written while the view runs
+        assert 129 not in DayEvents('buffered_a', now.year, now.month, now.day)
+        return ''
+
+    with app.test_client() as client:
+        response = client.get('/buffered')
+
+        # marks are written once the response is closed
+        assert 129 not in DayEvents('buffered_a', now.year, now.month, now.day)
+        response.close()
+
+    assert 129 in DayEvents('buffered_a', now.year, now.month, now.day)
+    assert 130 in DayEvents('buffered_b', now.year, now.month, now.day)
+
+
+def test_buffered_marks_flushed_on_error():
+    app = make_app(BITMAPIST_BUFFER_MARKS=True)
+
+    @app.route('/buffered_error')
+    @mark('buffered_error', 131)
+    def buffered_error():
+        raise ValueError
+
+    with app.test_client() as client:
+        with pytest.raises(ValueError):
+            client.get('/buffered_error')
+
+    assert 131 in DayEvents('buffered_error', now.year, now.month, now.day)
+
+
+def test_async_marks():
+    app = make_app(BITMAPIST_ASYNC_MARKING=True)
+    worker = app.extensions['bitmapist'].worker
+
+    @app.route('/async')
+    @mark('async_a', 132)
+    @mark('async_b', 133)
+    def async_view():
+        return ''
+
+    with app.test_client() as client:
+        client.get('/async')
+
+    worker.flush()
+    assert 132 in DayEvents('async_a', now.year, now.month, now.day)
+    assert 133 in DayEvents('async_b', now.year, now.month, now.day)
+    assert worker.stats() == {'depth': 0, 'dropped': 0, 'written': 2, 'errors': 0}
+
+    # after a fork, concurrent marks start a single thread
+    worker.pid = -1
+    with mock.patch.object(worker, '_start', wraps=worker._start) as start:
+        threads = [threading.Thread(target=worker.enqueue, args=('async_c', uuid, now))
+                   for uuid in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert start.call_count == 1
+    worker.flush()
+    assert len(DayEvents('async_c', now.year, now.month, now.day)) == 10
+
+    worker.stop()
+    assert not worker.thread
+
+    # once stopped, marks are written straight away rather than queued
+    worker.enqueue('async_d', 133, now)
+    assert worker.depth == 0
+    assert 133 in DayEvents('async_d', now.year, now.month, now.day)
+
+
+def test_mark_worker_policies():
+    lost = []
+
+    def fill(policy):
+        worker = MarkWorker(maxsize=2, policy=policy,
+                            on_drop=lambda system, track_hourly, marks: lost.extend(marks))
+        # no thread consuming the queue, so that it fills up
+        worker.queue = queue.Queue(2)
+        worker.pid = os.getpid()
+        for uuid in range(4):
+            worker.enqueue('full', uuid, now)
+        return worker
+
+    worker = fill('drop_oldest')
+    assert worker.depth == 2
+    assert worker.dropped == 2
+    assert [item[1][1] for item in worker.queue.queue] == [2, 3]
+    assert [uuid for _, uuid, _ in lost] == [0, 1]
+
+    del lost[:]
+    worker = fill('drop_newest')
+    assert worker.depth == 2
+    assert worker.dropped == 2
+    assert [item[1][1] for item in worker.queue.queue] == [0, 1]
+    assert [uuid for _, uuid, _ in lost] == [2, 3]
+
+    with pytest.raises(ValueError):
+        MarkWorker(policy='drop_everything')
+
+
+def test_mark_worker_blocked_enqueue():
+    worker = MarkWorker(maxsize=1)
+    # no thread consuming the queue yet, so that it fills up
+    worker.queue = queue.Queue(1)
+    worker.pid = os.getpid()
+    worker.enqueue('blocked', 0, now)
+    blocked = threading.Thread(target=worker.enqueue, args=('blocked', 1, now))
+    blocked.start()
+    time.sleep(0.05)
+
+    # an enqueue waiting for room holds up neither other enqueues nor stop
+    assert blocked.is_alive()
+    assert worker._lock.acquire(False)
+    worker._lock.release()
+    worker.thread = threading.Thread(target=worker._run)
+    worker.thread.start()
+    worker.stop()
+    blocked.join()
+    assert not worker.thread
+    assert len(DayEvents('blocked', now.year, now.month, now.day)) == 2
+
+    # marks that arrive after the thread has been told to stop are written
+    worker.queue = queue.Queue()
+    worker.queue.put(_STOP)
+    worker.queue.put((('default', None), ('blocked', 2, now)))
+    worker._run()
+    assert 2 in DayEvents('blocked', now.year, now.month, now.day)
+
+
+def test_mark_decorator_dynamic():
+    app = make_app()
+    users = iter([135, 136])
+
+    @app.route('/dynamic')
+    @mark(['dynamic_a', 'dynamic_b'], lambda: next(users), now=lambda: now)
+    def dynamic():
+        return ''
+
+    @app.route('/anonymous')
+    @mark('dynamic_anonymous', lambda: None)
+    def anonymous():
+        return ''
+
+    with app.test_client() as client:
+        client.get('/dynamic')
+        client.get('/dynamic')
+        client.get('/anonymous')
+
+    for event_name in ['dynamic_a', 'dynamic_b']:
+        assert 135 in DayEvents(event_name, now.year, now.month, now.day)
+        assert 136 in DayEvents(event_name, now.year, now.month, now.day)
+    assert DayEvents('dynamic_anonymous', now.year, now.month, now.day).get_count() == 0
+
+    with pytest.raises(ValueError):
+        mark('dynamic', 1, when='eventually')
+
+
+def test_mark_decorator_after_response():
+    app = make_app()
+
+    def successful(response):
+        return response.status_code < 300
+
+    @app.route('/after/<int:status>')
+    @mark('after', 137, when='after', condition=successful)
+    @mark('after_response', 137, when='after_response', condition=successful)
+    def after(status):
+        # nothing is written while the view runs
+        assert 137 not in DayEvents('after', now.year, now.month, now.day)
+        return '', status
+
+    with app.test_client() as client:
+        response = client.get('/after/500')
+        response.close()
+        assert 137 not in DayEvents('after', now.year, now.month, now.day)
+        assert 137 not in DayEvents('after_response', now.year, now.month, now.day)
+
+        response = client.get('/after/200')
+        assert 137 in DayEvents('after', now.year, now.month, now.day)
+        assert 137 not in DayEvents('after_response', now.year, now.month, now.day)
+        response.close()
+
+    assert 137 in DayEvents('after_response', now.year, now.month, now.day)
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    # 'b' is the least recently used entry
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+    with mock.patch('flask_bitmapist.cache.time.time', return_value=time.time() + 61):
+        assert cache.get('a') is None
+
+    cache.set('d', 4, ttl=120)
+    with mock.patch('flask_bitmapist.cache.time.time', return_value=time.time() + 61):
+        assert cache.get('d') == 4
+
+    stats = cache.stats()
+    assert stats['hits'] == 3
+    assert stats['misses'] == 2
+    assert stats['evictions'] == 1
+    assert stats['size'] == 2
+
+
+def test_activity_marks():
+    app = make_app(BITMAPIST_ACTIVITY_EVENT='active_user', BITMAPIST_ACTIVITY_UUID=lambda: 138)
+    cache = app.extensions['bitmapist'].suppression_cache
+
+    @app.route('/activity')
+    def activity():
+        return ''
+
+    with app.test_client() as client:
+        with mock.patch('flask_bitmapist.core.FlaskBitmapist.mark') as mock_mark:
+            for _ in range(3):
+                client.get('/activity')
+            # only the first request writes to Redis
+            assert mock_mark.call_count == 1
+
+        cache.clear()
+        client.get('/activity')
+
+    assert 138 in DayEvents('active_user', now.year, now.month, now.day)
+    assert cache.stats()['hits'] == 2
+
+
+def test_mark_once_forgets_lost_marks():
+    app = make_app(BITMAPIST_ASYNC_MARKING=True, BITMAPIST_ASYNC_FULL_POLICY='drop_newest')
+    ext = app.extensions['bitmapist']
+    try:
+        with app.app_context():
+            with mock.patch('flask_bitmapist.core.FlaskBitmapist.mark',
+                            side_effect=RedisError):
+                with pytest.raises(RedisError):
+                    ext.mark_once('lost_mark', 139)
+            # a mark that failed is not suppressed
+            ext.mark_once('lost_mark', 139)
+            ext.worker.flush()
+            assert 139 in DayEvents('lost_mark', now.year, now.month, now.day)
+
+            # neither is a mark the worker dropped, nor one it failed to write
+            with mock.patch.object(ext.worker.queue, 'put_nowait', side_effect=queue.Full):
+                ext.mark_once('lost_mark', 140)
+            with mock.patch('flask_bitmapist.worker.mark_events', side_effect=RedisError):
+                ext.mark_once('lost_mark', 141)
+                ext.worker.flush()
+            assert ext.worker.stats()['dropped'] == 1
+            assert ext.worker.stats()['errors'] == 1
+
+            ext.mark_once('lost_mark', 140)
+            ext.mark_once('lost_mark', 141)
+            ext.worker.flush()
+            assert 140 in DayEvents('lost_mark', now.year, now.month, now.day)
+            assert 141 in DayEvents('lost_mark', now.year, now.month, now.day)
+    finally:
+        ext.worker.stop()
+        make_app()
+
+
+@pytest.mark.parametrize('time_group', ['days', 'weeks', 'months', 'years'])
+def test_get_cohort_script(time_group):
+    additional_events = [{'name': 'scripted:and', 'op': 'and'},
+                         {'name': 'scripted:or', 'op': 'or'},
+                         {'name': 'scripted:or_first', 'op': 'or'}]
+    delta = {'days': timedelta(days=1), 'weeks': timedelta(weeks=1),
+             'months': timedelta(days=31), 'years': timedelta(days=366)}[time_group]
+
+    for i in range(4):
+        date = now - delta * i
+        for uuid in range(140, 160):
+            if (uuid + i) % 3:
+                mark_event('scripted:primary', uuid, now=date)
+            if (uuid + i) % 2:
+                mark_event('scripted:secondary', uuid, now=date)
+            if (uuid + i) % 4 < 2:
+                mark_event('scripted:and', uuid, now=date)
+            if uuid % 5 == i:
+                mark_event('scripted:or', uuid, now=date)
+
+    cases = [([], 4), (additional_events[:1], 4), (additional_events[1:2], 4),
+             (additional_events, 4)]
+
+    for with_replacement in [False, True]:
+        for events, size in cases:
+            args = ('scripted:primary', 'scripted:secondary', events, time_group, size, size,
+                    'default', with_replacement)
+            script_cohort, _, script_totals = get_cohort(*args, engine='script')
+            bitop_cohort, _, bitop_totals = get_cohort(*deepcopy(args))
+
+            assert script_cohort == bitop_cohort
+            assert script_totals == bitop_totals
+
+            # split into several script calls
+            with mock.patch('flask_bitmapist.scripting.COHORT_SCRIPT_ROWS', 3):
+                assert get_cohort(*args, engine='script')[0] == bitop_cohort
+
+    # no keys are left behind
+    assert not SYSTEMS['default'].keys('flask_bitmapist:cohort:*')
+    assert not SYSTEMS['default'].keys('trackist_bitop_*')
+
+
+@pytest.fixture(params=['numpy', 'int', 'roaring'])
+def local_backend(request):
+    if request.param == 'numpy' and local.np is None:
+        pytest.skip('numpy is not installed')
+    local.USE_NUMPY = request.param == 'numpy'
+    # every bitmap is held in roaring containers, or none are
+    local.SPARSE_THRESHOLD = 2 if request.param == 'roaring' else 0
+
+    def reset():
+        local.USE_NUMPY = local.np is not None
+        local.SPARSE_THRESHOLD = 1 / 16.0
+    request.addfinalizer(reset)
+    return request.param
+
+
+def to_redis_bytes(ids):
+    data = bytearray(max(ids) // 8 + 1)
+    for uuid in ids:
+        data[uuid // 8] |= 0x80 >> (uuid % 8)
+    return bytes(data)
+
+
+def test_roaring_bitmap():
+    ids = {
+        'array': set([3, 70000, 70001, 1 << 20]),
+        'bitmap': set(range(0, 65536, 3)) | set([65536 * 2 + 5]),
+        'runs': set(range(100, 20000)) | set(range(65536 * 3, 65536 * 3 + 10)),
+    }
+    bitmaps = dict((name, RoaringBitmap.from_bytes(to_redis_bytes(values)))
+                   for name, values in ids.items())
+
+    assert isinstance(bitmaps['array'].containers[1], array)
+    assert not isinstance(bitmaps['bitmap'].containers[0], (array, Runs))
+    assert isinstance(bitmaps['runs'].containers[0], Runs)
+
+    for name, bitmap in bitmaps.items():
+        assert len(bitmap) == len(ids[name])
+        assert all(uuid in bitmap for uuid in ids[name])
+        assert 65536 * 4 not in bitmap and 1 not in bitmap
+        assert bitmap.to_bytes().rstrip(b'\x00') == to_redis_bytes(ids[name])
+        assert bitmap.ids() == sorted(ids[name])
+
+    # without numpy, blocks of zeros are skipped instead
+    with mock.patch.object(roaring, 'np', None):
+        for name, values in ids.items():
+            assert RoaringBitmap.from_bytes(to_redis_bytes(values)).containers == \
+                bitmaps[name].containers
+
+    ops = {'AND': set.intersection, 'OR': set.union, 'XOR': set.symmetric_difference,
+           'ANDNOT': set.difference}
+    for op_name, fn in ops.items():
+        for a in ids:
+            for b in ids:
+                result = bitmaps[a].bitop(op_name, bitmaps[b])
+                expected = fn(ids[a], ids[b])
+                assert len(result) == len(expected)
+                assert result.to_bytes().rstrip(b'\x00') == \
+                    (to_redis_bytes(expected) if expected else b'')
+
+
+def test_local_bitmap_ids(local_backend):
+    ids = [0, 7, 9, 70000]
+    bitmap = local.Bitmap.from_bytes(to_redis_bytes(ids))
+    assert bitmap.ids() == ids
+    assert local.Bitmap.empty().ids() == []
+
+
+def test_local_bitmap_mixed(local_backend):
+    # the default threshold picks the representation by density
+    local.SPARSE_THRESHOLD = 1 / 16.0
+
+    sparse_ids = set([5, 10 ** 6, 10 ** 6 + 1])
+    dense_ids = set(range(0, 200000, 2))
+    sparse = local.Bitmap.from_bytes(to_redis_bytes(sparse_ids))
+    dense = local.Bitmap.from_bytes(to_redis_bytes(dense_ids))
+    assert sparse.is_sparse() and not dense.is_sparse()
+
+    for op_name, fn in [('AND', set.intersection), ('OR', set.union),
+                        ('XOR', set.symmetric_difference), ('ANDNOT', set.difference)]:
+        for a, b, a_ids, b_ids in [(sparse, dense, sparse_ids, dense_ids),
+                                   (dense, sparse, dense_ids, sparse_ids)]:
+            result = local.bitop(op_name, a, b)
+            expected = fn(a_ids, b_ids)
+            assert len(result) == len(expected)
+            assert all(uuid in result for uuid in list(expected)[:100])
+            assert 10 ** 6 + 1 in result if 10 ** 6 + 1 in expected else True
+    assert local.bitop('AND', sparse, dense).is_sparse()
+
+
+def test_local_bitmap(local_backend):
+    a = local.Bitmap.from_bytes(b'\xc0\x01')  # 0, 1, 15
+    b = local.Bitmap.from_bytes(b'\x40')  # 1
+    c = local.Bitmap.from_bytes(b'\x00\x00\x80')  # 16
+
+    assert len(a) == 3
+    assert 0 in a and 15 in a and 2 not in a and 1000 not in a
+    assert list(i for i in range(24) if i in a | c) == [0, 1, 15, 16]
+    assert len(a & b) == 1
+    assert len(a ^ b) == 2
+    assert len(a - b) == 2 and 1 not in a - b
+    assert len(local.bitop('OR', a, b, c)) == 4
+
+    missing = local.Bitmap.from_bytes(None)
+    assert not missing.has_events_marked()
+    assert len(missing) == 0
+    assert (a | missing).has_events_marked()
+
+
+@pytest.mark.parametrize('time_group', ['days', 'weeks', 'months', 'years'])
+def test_get_cohort_local(time_group, local_backend):
+    delta = {'days': timedelta(days=1), 'weeks': timedelta(weeks=1),
+             'months': timedelta(days=31), 'years': timedelta(days=366)}[time_group]
+
+    for i in range(4):
+        date = now - delta * i
+        for uuid in range(200, 220):
+            if (uuid + i) % 3:
+                mark_event('local:primary', uuid, now=date)
+            if (uuid + i) % 2:
+                mark_event('local:secondary', uuid, now=date)
+            if (uuid + i) % 4 < 2:
+                mark_event('local:and', uuid, now=date)
+            if uuid % 5 == i:
+                mark_event('local:or', uuid, now=date)
+
+    for events in [[], [{'name': 'local:and', 'op': 'and'}],
+                   [{'name': 'local:or', 'op': 'or'}],
+                   [{'name': 'local:missing', 'op': 'and'}]]:
+        for with_replacement in [False, True]:
+            args = ('local:primary', 'local:secondary', events, time_group, 4, 4,
+                    'default', with_replacement)
+            local_cohort, _, local_totals = get_cohort(*args, engine='local')
+            bitop_cohort, _, bitop_totals = get_cohort(*deepcopy(args))
+
+            assert local_cohort == bitop_cohort
+            assert local_totals == bitop_totals
+
+    events = [{'name': 'local:and', 'op': 'and'}, {'name': 'local:or', 'op': 'or'}]
+    dates = [now - delta * i for i in range(4)]
+    chains = [chain_events('local:secondary', deepcopy(events), chain_date, time_group,
+                           engine='local') for chain_date in dates]
+    assert chain_events('local:missing', [], now, time_group, engine='local') == ''
+
+    # no keys are created
+    assert not SYSTEMS['default'].keys('trackist_bitop_*')
+
+    for chained, date in zip(chains, dates):
+        expected = chain_events('local:secondary', deepcopy(events), date, time_group)
+        assert len(chained) == len(expected)
+        assert [uuid for uuid in range(200, 220) if uuid in chained] == \
+            [uuid for uuid in range(200, 220) if uuid in expected]
+
+
+@pytest.mark.parametrize('engine', ['bitop', 'script', 'local'])
+@pytest.mark.parametrize('time_group', ['days', 'weeks', 'months'])
+def test_cohort_cache(time_group, engine):
+    delta = {'days': timedelta(days=1), 'weeks': timedelta(weeks=1),
+             'months': timedelta(days=31)}[time_group]
+
+    marks = []
+    for i in range(4):
+        date = now - delta * i
+        for uuid in range(160, 180):
+            if (uuid + i) % 3:
+                marks.append(('cached:primary', uuid, date))
+            if (uuid + i) % 2:
+                marks.append(('cached:secondary', uuid, date))
+            if (uuid + i) % 4 < 2:
+                marks.append(('cached:and', uuid, date))
+    mark_events(marks)
+
+    def cohorts(num_cols=4):
+        results = []
+        for with_replacement in [False, True]:
+            cohort, _, totals = get_cohort('cached:primary', 'cached:secondary',
+                                           [{'name': 'cached:and', 'op': 'and'}], time_group,
+                                           4, num_cols, with_replacement=with_replacement,
+                                           engine=engine)
+            results.append((cohort, totals))
+        return results
+
+    expected = cohorts()
+
+    app = make_app(BITMAPIST_COHORT_CACHE=True)
+    cache = app.extensions['bitmapist'].cohort_cache
+    try:
+        # the first two columns are cached, then the rest are computed around them
+        cohorts(num_cols=2)
+        cached = cache.stats()['cells_computed']
+        assert cached > 0
+        assert cohorts() == expected
+        assert cache.stats()['cells_cached'] == cached
+
+        # everything from ended periods is cached now
+        assert cohorts() == expected
+        assert cache.stats()['commands_saved'] > 0
+
+        # a back-dated mark leaves the cells depending on its period stale
+        mark_events([(event_name, 190, now - delta * 3)
+                     for event_name in ['cached:primary', 'cached:secondary', 'cached:and']])
+        utils.COHORT_CACHE = None
+        updated = cohorts()
+        utils.COHORT_CACHE = cache
+        assert updated != expected
+        assert cohorts() == updated
+    finally:
+        make_app()
+
+    assert utils.COHORT_CACHE is None
+    assert not SYSTEMS['default'].keys('trackist_bitop_*')
+
+
+def test_cohort_cache_shared():
+    cache = CohortCache(shared=True, ttl=60)
+    cache.set_many({'a': 3, 'b': 0})
+    assert SYSTEMS['default'].ttl(COHORT_CACHE_PREFIX + 'a') <= 60
+
+    # another process only finds them in Redis
+    other = CohortCache(shared=True)
+    assert other.get_many(['a', 'b', 'c']) == {'a': 3, 'b': 0}
+    assert other.get_many(['a', 'b']) == {'a': 3, 'b': 0}
+    stats = other.stats()
+    assert stats['shared_hits'] == 2
+    assert stats['size'] == 2
+
+    # results never live in Redis forever
+    other.set_many({'d': 1})
+    assert 0 < SYSTEMS['default'].ttl(COHORT_CACHE_PREFIX + 'd') <= COHORT_CACHE_TTL
+
+
+def test_cohort_cache_versions():
+    app = make_app(BITMAPIST_COHORT_CACHE=True)
+    cache = app.extensions['bitmapist'].cohort_cache
+    yesterday = now - timedelta(days=1)
+    key = utils._version_key('versioned', utils._period_id(yesterday, 'days'))
+    try:
+        # every way of writing a back-dated mark bumps its periods' versions
+        for engine in utils.MARK_ENGINES:
+            mark_events([('versioned', 191, yesterday)], engine=engine)
+        mark_event('versioned', 192, now=yesterday)
+        mark_event('versioned', 193, now=yesterday, use_pipeline=False)
+        unmark_event('versioned', 193, now=yesterday)
+        assert int(SYSTEMS['default'].get(key)) == 5
+        assert 0 < SYSTEMS['default'].ttl(key) <= cache.version_ttl
+
+        # so do processes that do not cache cohorts themselves, e.g. workers,
+        # going by the TTL the processes that do are configured with
+        make_app(BITMAPIST_COHORT_CACHE_TTL=100)
+        mark_event('versioned', 194, now=yesterday)
+        assert int(SYSTEMS['default'].get(key)) == 6
+        assert 100 < SYSTEMS['default'].ttl(key) <= 200
+    finally:
+        make_app()
+
+
+def test_cohort_engine_config():
+    make_app(BITMAPIST_COHORT_ENGINE='script')
+    assert utils.COHORT_ENGINE == 'script'
+
+    make_app(BITMAPIST_COHORT_ENGINE='local')
+    assert utils.COHORT_ENGINE == 'local'
+
+    with pytest.raises(ValueError):
+        make_app(BITMAPIST_COHORT_ENGINE='abacus')
+
+    make_app()
+    assert utils.COHORT_ENGINE == 'bitop'
+
+
+def test_event_catalog():
+    catalog_day = 'flask_bitmapist:catalog:days:%s-%s-%s' % (now.year, now.month, now.day)
+    catalog_year = 'flask_bitmapist:catalog:years:%s' % now.year
+    last_month = now - relativedelta(months=1)
+
+    app = make_app(BITMAPIST_EVENT_CATALOG=True)
+    try:
+        mark_events([('catalog:a', 1, now), ('catalog:b', 1, now), ('catalog:b', 2, last_month)])
+        mark_events([('catalog:c', 3, now)], engine='script')
+        app.extensions['bitmapist'].mark('catalog:d', 4)
+        # marks written around the extension are cataloged too
+        mark_event('catalog:e', 5, use_pipeline=False)
+        pipe = SYSTEMS['default'].pipeline()
+        mark_event('catalog:f', 6, system=pipe)
+        pipe.execute()
+
+        assert SYSTEMS['default'].smembers(catalog_day) == set(
+            [b'catalog:a', b'catalog:b', b'catalog:c', b'catalog:d', b'catalog:e',
+             b'catalog:f'])
+        assert b'catalog:b' in SYSTEMS['default'].smembers(catalog_year)
+
+        # names are read from the catalog, without scanning the keyspace
+        with mock.patch('bitmapist.get_event_names') as scan:
+            assert sorted(get_event_names()) == ['catalog:a', 'catalog:b', 'catalog:c',
+                                                 'catalog:d', 'catalog:e', 'catalog:f']
+            assert sorted(get_event_names(prefix='catalog:a')) == ['catalog:a']
+        assert not scan.called
+
+        # existence checks too; the catalog's answers match the keys'
+        events = [{'name': 'catalog:b', 'op': 'and'}, {'name': 'catalog:none', 'op': 'and'}]
+        assert chain_events('catalog:a', events[:1], now, 'days').get_count() == 1
+        assert chain_events('catalog:none', events[:1], now, 'days') == ''
+        with mock.patch('redis.StrictRedis.exists') as exists:
+            missing = chain_events('catalog:a', events, now, 'days')
+            assert chain_events('catalog:b', events[:1], last_month, 'months').get_count() == 1
+        assert not exists.called
+        assert missing.redis_key == DayEvents.from_date('catalog:none', now).redis_key
+    finally:
+        make_app()
+
+    assert utils.EVENT_CATALOG is False
+
+
+def test_rebuild_catalog():
+    from click.testing import CliRunner
+    from flask.cli import ScriptInfo
+
+    mark_event('rebuilt:a_b', 1, now=now)
+    mark_event('rebuilt:c', 2, now=now - relativedelta(years=1), track_hourly=True)
+
+    app = make_app(BITMAPIST_EVENT_CATALOG=True)
+    try:
+        result = CliRunner().invoke(app.cli, ['bitmapist', 'rebuild-catalog'],
+                                    obj=ScriptInfo(create_app=lambda info: app))
+        assert result.exit_code == 0
+        assert 'Cataloged 2 event names' in result.output
+
+        assert sorted(get_event_names()) == ['rebuilt:a_b', 'rebuilt:c']
+        cli = SYSTEMS['default']
+        assert cli.smembers('flask_bitmapist:catalog:weeks:W%s-%s' % (
+            now.year, now.isocalendar()[1])) == set([b'rebuilt:a_b'])
+        assert cli.smembers('flask_bitmapist:catalog:years:%s' % (now.year - 1)) == set(
+            [b'rebuilt:c'])
+    finally:
+        make_app()
+
+
+def test_rollup_mode():
+    from click.testing import CliRunner
+    from flask.cli import ScriptInfo
+
+    cli = SYSTEMS['default']
+    cli.delete(rollup.PERIODS_KEY)
+    last_week = now - timedelta(weeks=1)
+    last_month = now - relativedelta(months=1)
+
+    app = make_app(BITMAPIST_ROLLUP_MODE=True)
+    try:
+        # only the current day is written for the current week and month
+        assert len(utils._mark_commands([('rollup:a', 1, None)], False)) == 1
+        mark_events([('rollup:a', 1, now), ('rollup:a', 2, now)])
+        mark_events([('rollup:a', 3, now)], engine='script')
+        assert cli.exists(DayEvents.from_date('rollup:a', now).redis_key)
+        assert not cli.exists(WeekEvents.from_date('rollup:a', now).redis_key)
+        assert not cli.exists(MonthEvents.from_date('rollup:a', now).redis_key)
+
+        # periods that have ended are written as usual
+        mark_events([('rollup:a', 4, last_month)], engine='script')
+        assert cli.getbit(MonthEvents.from_date('rollup:a', last_month).redis_key, 4)
+
+        # the current week and month are built from their days
+        assert get_event_data('rollup:a', 'weeks', now).get_count() == 3
+        assert get_event_data('rollup:a', 'months', now).get_count() == 3
+        assert get_event_counts(['rollup:a'], ['days', 'weeks', 'months'], now) == {
+            'rollup:a': [3, 3, 3]}
+        year_count = 4 if now.year == last_month.year else 1
+        assert get_event_data('rollup:a', 'years', last_month).get_count() == year_count
+        with TempKeys() as temp_keys:
+            year = get_event_data('rollup:a', 'years', now, temp_keys=temp_keys)
+            assert year.redis_key.startswith(temp_keys.namespace)
+            assert 2 in year
+        assert not cli.exists(year.redis_key)
+        assert 2 in chain_events('rollup:a', [{'name': 'rollup:a', 'op': 'and'}], now, 'weeks',
+                                 engine='local')
+        for engine in utils.COHORT_ENGINES:
+            cohort, _, totals = get_cohort('rollup:a', 'rollup:a', time_group='months',
+                                           num_rows=1, num_cols=1, engine=engine)
+            assert cohort == [[3]] and totals == [3]
+
+        # until the rollup job has run, so are weeks that have ended
+        cli.setbit(DayEvents.from_date('rollup:b', last_week).redis_key, 5, 1)
+        assert 5 in get_event_data('rollup:b', 'weeks', last_week)
+
+        runner = CliRunner()
+        obj = ScriptInfo(create_app=lambda info: app)
+        result = runner.invoke(app.cli, ['bitmapist', 'rollup', '--periods', '1'], obj=obj)
+        assert result.exit_code == 0
+        week = rollup.period_name(last_week, 'weeks')
+        assert week in result.output
+
+        assert cli.getbit(WeekEvents.from_date('rollup:b', last_week).redis_key, 5)
+        assert week.encode() in cli.smembers(rollup.PERIODS_KEY)
+        events = get_event_data('rollup:b', 'weeks', last_week)
+        assert events.redis_key == WeekEvents.from_date('rollup:b', last_week).redis_key
+
+        result = runner.invoke(app.cli, ['bitmapist', 'rollup', '--periods', '1'], obj=obj)
+        assert 'Rolled up nothing' in result.output
+    finally:
+        make_app()
+
+    assert utils.ROLLUP_MODE is False
+
+
+def test_rollup_mode_retention():
+    cli = SYSTEMS['default']
+    cli.delete(rollup.PERIODS_KEY)
+    last_week = now - timedelta(weeks=1)
+    last_month = now - relativedelta(months=1)
+
+    make_app(BITMAPIST_ROLLUP_MODE=True,
+             BITMAPIST_RETENTION={'days': 400, 'weeks': 400, 'months': 400})
+    try:
+        # marks writing different granularities share a single script call,
+        # sent along with their expiries
+        with mock.patch('flask_bitmapist.utils.mark_events_script',
+                        wraps=utils.mark_events_script) as script:
+            assert mark_events([('rollup:c', 1, now), ('rollup:c', 2, last_month)],
+                               engine='script') == 2
+        assert script.call_count == 1
+        assert cli.getbit(DayEvents.from_date('rollup:c', now).redis_key, 1)
+        assert not cli.exists(MonthEvents.from_date('rollup:c', now).redis_key)
+        assert cli.getbit(MonthEvents.from_date('rollup:c', last_month).redis_key, 2)
+        assert cli.ttl(DayEvents.from_date('rollup:c', now).redis_key) > 0
+        assert cli.ttl(MonthEvents.from_date('rollup:c', last_month).redis_key) > 0
+
+        # rolled up weeks and months expire like the ones marks write
+        cli.setbit(DayEvents.from_date('rollup:d', last_week).redis_key, 5, 1)
+        rollup.rollup(['rollup:d'], periods=1)
+        assert cli.ttl(WeekEvents.from_date('rollup:d', last_week).redis_key) > 0
+    finally:
+        make_app()
+
+
+def test_retention():
+    from click.testing import CliRunner
+    from flask.cli import ScriptInfo
+
+    cli = SYSTEMS['default']
+    long_ago = now - timedelta(days=500)
+
+    with pytest.raises(ValueError):
+        make_app(BITMAPIST_RETENTION={'decades': 1})
+
+    app = make_app(BITMAPIST_RETENTION={'hours': 14, 'days': 400, 'weeks': None},
+                   BITMAPIST_EVENT_CATALOG=True)
+    try:
+        mark_events([('retained:a', 1, now)], track_hourly=True)
+        mark_events([('retained:b', 1, now)], engine='script')
+        day = DayEvents.from_date('retained:a', now).redis_key
+        assert 399 * 86400 < cli.ttl(day) <= 401 * 86400
+        assert 0 < cli.ttl(HourEvents.from_date('retained:a', now).redis_key) <= 15 * 86400
+        assert cli.ttl(WeekEvents.from_date('retained:a', now).redis_key) in (None, -1)
+        assert cli.ttl(DayEvents.from_date('retained:b', now).redis_key) > 0
+        assert cli.ttl('flask_bitmapist:catalog:days:%s-%s-%s' % (
+            now.year, now.month, now.day)) > 0
+
+        # marks past their retention expire at once
+        mark_events([('retained:a', 2, long_ago)])
+        assert not cli.exists(DayEvents.from_date('retained:a', long_ago).redis_key)
+        assert get_event_data('retained:a', 'days', long_ago) is EXPIRED
+        assert 2 in get_event_data('retained:a', 'months', long_ago)
+        assert get_event_counts(['retained:a'], ['days', 'months'], long_ago) == {
+            'retained:a': [EXPIRED, 1]}
+
+        # keys written without expiry get it from the sweep
+        mark_event('retained:c', 1, now=long_ago)
+        mark_event('retained:c', 1, now=now)
+        result = CliRunner().invoke(app.cli, ['bitmapist', 'sweep'],
+                                    obj=ScriptInfo(create_app=lambda info: app))
+        assert result.exit_code == 0
+        assert 'Expired' in result.output
+        assert not cli.exists(DayEvents.from_date('retained:c', long_ago).redis_key)
+        assert cli.ttl(DayEvents.from_date('retained:c', now).redis_key) > 0
+        assert cli.ttl(MonthEvents.from_date('retained:c', long_ago).redis_key) in (None, -1)
+    finally:
+        make_app()
+
+
+def test_retention_cohort():
+    mark_events([('retained:d', 1, now - timedelta(days=i)) for i in range(4)])
+    app = make_app(BITMAPIST_RETENTION={'days': 1}, BITMAPIST_DISABLE_BLUEPRINT=False)
+    client = app.test_client()
+    try:
+        for engine in utils.COHORT_ENGINES:
+            cohort, _, totals = get_cohort('retained:d', 'retained:d', num_rows=4, num_cols=2,
+                                           engine=engine)
+            assert totals == [EXPIRED, EXPIRED, 1, 1]
+            assert cohort == [[EXPIRED, EXPIRED], [EXPIRED, EXPIRED], [1, 0], [1, None]]
+
+        settings = {'primary_event': 'retained:d', 'secondary_event': 'retained:d',
+                    'num_rows': 4, 'num_cols': 2, 'as_percent': True}
+        page = json.loads(client.post('/bitmapist/cohort?json=true',
+                                      data=json.dumps(settings)).get_data(as_text=True))
+        assert page['row_totals'] == ['expired', 'expired', 1, 1]
+        assert page['total'] == 2
+        assert 'expired' in client.post('/bitmapist/cohort', data=json.dumps(settings)).get_data(
+            as_text=True)
+        lines = client.get('/bitmapist/cohort/export?primary_event=retained:d'
+                           '&secondary_event=retained:d&num_rows=4&num_cols=2').get_data(
+                               as_text=True).splitlines()
+        assert lines[1].endswith(',expired,expired,expired')
+    finally:
+        make_app()
+
+
+@pytest.mark.parametrize('engine', ['bitop', 'script', 'local'])
+def test_iter_cohort(engine):
+    marks = []
+    for i in range(7):
+        for uuid in range(230, 250):
+            if (uuid + i) % 3:
+                marks.append(('streamed:primary', uuid, now - timedelta(days=i)))
+            if (uuid + i) % 2:
+                marks.append(('streamed:secondary', uuid, now - timedelta(days=i)))
+    mark_events(marks)
+
+    args = ('streamed:primary', 'streamed:secondary', [], 'days', 7, 5)
+    for with_replacement in [False, True]:
+        cohort, dates, totals = get_cohort(*args, with_replacement=with_replacement,
+                                           engine=engine)
+        for chunk_size in [1, 3, 30]:
+            rows = list(iter_cohort(*args, with_replacement=with_replacement, engine=engine,
+                                    chunk_size=chunk_size))
+            assert [row for _, _, row in rows] == cohort
+            assert [total for _, total, _ in rows] == totals
+            assert [date.date() for date, _, _ in rows] == [date.date() for date in dates]
+
+    # rows come a chunk at a time, as they are computed
+    with mock.patch('flask_bitmapist.utils._compute_cohort',
+                    wraps=utils._compute_cohort) as compute:
+        rows = iter_cohort(*args, engine=engine, chunk_size=3)
+        next(rows)
+        assert compute.call_count == 1
+        assert len(list(rows)) == 6
+        assert compute.call_count == 3
+
+        # chunks of 1, 2 then 4 rows
+        compute.reset_mock()
+        rows = list(iter_cohort(*args, with_replacement=True, engine=engine, chunk_size=4,
+                                first_chunk_size=1))
+        assert [row for _, _, row in rows] == cohort
+        assert compute.call_count == 3
+    assert not SYSTEMS['default'].keys('flask_bitmapist:tmp:*')
+
+
+def test_cohort_export():
+    app = make_app(BITMAPIST_DISABLE_BLUEPRINT=False)
+    client = app.test_client()
+    mark_events([('exported:primary', 1, now), ('exported:primary', 2, now),
+                 ('exported:secondary', 2, now)])
+    cohort, dates, totals = get_cohort('exported:primary', 'exported:secondary',
+                                       num_rows=3, num_cols=2)
+
+    response = client.get('/bitmapist/cohort/export?primary_event=exported:primary'
+                          '&secondary_event=exported:secondary&num_rows=3&num_cols=2')
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'text/csv'
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[0] == 'date,total,0,1'
+    assert lines[1] == '%s,0,,' % dates[0].strftime('%Y-%m-%d')
+    assert lines[-1] == '%s,2,1,' % now.strftime('%Y-%m-%d')
+
+    response = client.post('/bitmapist/cohort/export', data=json.dumps({
+        'primary_event': 'exported:primary', 'secondary_event': 'exported:secondary',
+        'additional_events': [{'name': 'exported:primary', 'op': 'and'}],
+        'num_rows': 3, 'num_cols': 2, 'format': 'ndjson'}))
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row['cohort'] for row in rows] == cohort
+    assert [row['total'] for row in rows] == totals
+
+    assert client.get('/bitmapist/cohort/export?format=xlsx').status_code == 400
+    for num_rows in ['many', '0', '-1']:
+        assert client.get('/bitmapist/cohort/export?num_rows=' + num_rows).status_code == 400
+    assert client.post('/bitmapist/cohort/export', data=json.dumps({
+        'num_cols': None})).status_code == 400
+
+    # however many rows and columns are asked for, at most MAX_COHORT_SIZE are computed
+    with mock.patch('flask_bitmapist.views.iter_cohort', return_value=iter([])) as rows:
+        client.get('/bitmapist/cohort/export?num_rows=1000000&num_cols=1000000').get_data()
+    assert rows.call_args[1]['num_rows'] == views.MAX_COHORT_SIZE
+    assert rows.call_args[1]['num_cols'] == views.MAX_COHORT_SIZE
+
+
+def test_cohort_views_script_engine():
+    mark_events([('scripted:primary', 1, now), ('scripted:primary', 2, now),
+                 ('scripted:secondary', 2, now)])
+    settings = {'primary_event': 'scripted:primary', 'secondary_event': 'scripted:secondary',
+                'num_rows': 3, 'num_cols': 2}
+    cohort, _, totals = get_cohort('scripted:primary', 'scripted:secondary', num_rows=3,
+                                   num_cols=2, engine='bitop')
+
+    app = make_app(BITMAPIST_DISABLE_BLUEPRINT=False, BITMAPIST_COHORT_ENGINE='script')
+    try:
+        client = app.test_client()
+        with mock.patch('flask_bitmapist.utils.get_cohort_script',
+                        wraps=utils.get_cohort_script) as script:
+            page = json.loads(client.post('/bitmapist/cohort?json=true',
+                                          data=json.dumps(settings)).get_data(as_text=True))
+            assert script.call_count == 1
+            assert page['cohort'] == cohort
+            assert page['row_totals'] == totals
+
+            stream = client.get('/bitmapist/cohort/stream', query_string=settings)
+            assert 'event: done' in stream.get_data(as_text=True)
+            assert script.call_count > 1
+
+            script.reset_mock()
+            export = client.get('/bitmapist/cohort/export', query_string=dict(
+                settings, format='ndjson'))
+            rows = [json.loads(line) for line in export.get_data(as_text=True).splitlines()]
+            assert script.call_count >= 1
+            assert [row['cohort'] for row in rows] == cohort
+    finally:
+        make_app()
+
+
+def test_cohort_stream():
+    app = make_app(BITMAPIST_DISABLE_BLUEPRINT=False)
+    client = app.test_client()
+    mark_events([('progressive:primary', 1, now - timedelta(days=1)),
+                 ('progressive:primary', 2, now), ('progressive:primary', 3, now),
+                 ('progressive:secondary', 2, now), ('progressive:secondary', 1, now)])
+    settings = {'primary_event': 'progressive:primary',
+                'secondary_event': 'progressive:secondary',
+                'num_rows': 3, 'num_cols': 2, 'as_percent': True}
+    page = json.loads(client.post('/bitmapist/cohort?json=true',
+                                  data=json.dumps(settings)).get_data(as_text=True))
+
+    response = client.get('/bitmapist/cohort/stream', query_string=dict(
+        settings, as_percent='true', additional_events=json.dumps([])))
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'text/event-stream'
+
+    events = []
+    for message in response.get_data(as_text=True).split('\n\n')[:-1]:
+        event, data = message.split('\n')
+        events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+
+    assert [name for name, _ in events] == ['start', 'row', 'row', 'row', 'done']
+    assert 'cohort-heatmap' in events[0][1]['html']
+    rows = [row for name, row in events if name == 'row']
+    assert [row['cohort'] for row in rows] == page['cohort']
+    assert [row['date'] for row in rows] == page['dates']
+    assert [row['total'] for row in rows] == page['row_totals']
+    assert '100.0%' in rows[1]['html']
+    assert 'class="averages"' in rows[0]['summary']
+
+    # the averages and totals come with each row, and add up to the page's
+    done = events[-1][1]
+    assert done['total'] == page['total']
+    assert done['col_totals'] == page['col_totals']
+    assert done['averages'] == page['averages']
+
+
+def test_id_map():
+    from flask_bitmapist.core import _mark
+
+    cli = SYSTEMS['default']
+    snowflake = 1234567890123456789
+
+    app = make_app(BITMAPIST_ID_MAP=True)
+    id_map = app.extensions['bitmapist'].id_map
+    cli.delete(*id_map.keys)
+    id_map.clear()
+    try:
+        mark_events([('mapped', snowflake, now), ('mapped', 'f3a1-uuid', now),
+                     ('mapped:other', snowflake, now)])
+        mark_events([('mapped:script', 'b', now)], engine='script')
+        assert id_map.lookup([snowflake, 'f3a1-uuid', 'b', 'unmarked']) == [0, 1, 2, None]
+        assert cli.strlen(DayEvents.from_date('mapped', now).redis_key) == 1
+
+        # queries take and give external ids
+        events = get_event_data('mapped', 'days', now)
+        assert snowflake in events and 'f3a1-uuid' in events
+        assert 'b' not in events and 'unmarked' not in events
+        assert 'b' in get_event_data('mapped:script', 'days', now)
+        assert list(events) == [str(snowflake), 'f3a1-uuid']
+        assert len(events) == 2
+        both = events & get_event_data('mapped:other', 'days', now)
+        assert snowflake in both and 'f3a1-uuid' not in both
+
+        # marks through bitmapist's own functions are mapped too, and
+        # unmarks, with the system given by name or by a pipeline
+        _mark('mapped:direct', 'c', now=now, use_pipeline=False)
+        pipe = SYSTEMS['default'].pipeline()
+        _mark('mapped:direct', 'e', system=pipe, now=now)
+        pipe.execute()
+        assert get_event_members('mapped:direct', 'days', now) == ['c', 'e']
+        unmark_event('mapped:direct', 'c', now=now)
+        unmark_event('mapped:direct', 'never-marked', now=now)
+        assert get_event_members('mapped:direct', 'days', now) == ['e']
+        assert id_map.lookup(['never-marked']) == [None]
+        with pytest.raises(ValueError):
+            mark_event('mapped:direct', 'f', system=redis.StrictRedis(port=6399), now=now)
+
+        # members are reverse-mapped, from Redis once the cache is cleared
+        id_map.clear()
+        assert get_event_members('mapped', 'months', now) == [str(snowflake), 'f3a1-uuid']
+        assert id_map.to_external([1, 100]) == ['f3a1-uuid', None]
+        assert id_map.assign(['f3a1-uuid', 'd', str(snowflake)]) == [1, 5, 0]
+    finally:
+        make_app()
+
+    assert get_event_members('mapped', 'days', now) == [0, 1]
+
+
+def test_memory_report():
+    from click.testing import CliRunner
+    from flask.cli import ScriptInfo
+    from flask_bitmapist.memory import memory_report
+
+    cli = SYSTEMS['default']
+    report_time = datetime(2016, 3, 15)
+    for key in cli.keys('trackist_memory:*'):
+        cli.delete(key)
+
+    mark_events([('memory:sparse', 100000, report_time)] +
+                [('memory:growing', uuid, report_time - timedelta(days=1))
+                 for uuid in range(800)] +
+                [('memory:growing', 1, report_time - timedelta(days=10))])
+
+    report = memory_report(now=report_time, batch=7, top=1000)
+    groups = dict(((group['event'], group['time_group']), group) for group in report['events'])
+    days = groups[('memory:growing', 'days')]
+    assert days['keys'] == 2
+    assert days['bits'] == 801
+    assert days['bytes'] >= 101
+    assert days['density'] == 801 / 808.0
+    assert groups[('memory:sparse', 'months')]['bits'] == 1
+    assert report['total']['keys'] >= 6
+
+    sparse = [key['key'] for key in report['sparse']]
+    assert DayEvents.from_date('memory:sparse', report_time).redis_key in sparse
+    assert not [key for key in sparse if 'memory:growing' in key]
+    # only the largest are kept, ties by name
+    assert len(sparse) > 2
+    assert sparse == [key['key'] for key in sorted(report['sparse'],
+                                                   key=lambda key: (-key['bytes'], key['key']))]
+    assert memory_report(now=report_time, batch=7, top=2)['sparse'] == report['sparse'][:2]
+    growing = dict((event['event'], event) for event in report['growing'])
+    assert growing['memory:growing']['recent_bytes'] > growing['memory:growing']['previous_bytes']
+    assert growing['memory:growing']['previous_bytes'] > 0
+
+    app = make_app(BITMAPIST_DISABLE_BLUEPRINT=False)
+    try:
+        page = json.loads(app.test_client().get('/bitmapist/memory?json=true&top=1000')
+                          .get_data(as_text=True))
+        assert DayEvents.from_date('memory:sparse', report_time).redis_key in \
+            [key['key'] for key in page['sparse']]
+        assert b'memory:growing' in app.test_client().get('/bitmapist/memory').data
+        for top in ['0', '-1', 'many']:
+            assert app.test_client().get('/bitmapist/memory?top=' + top).status_code == 400
+        with mock.patch('flask_bitmapist.views.memory_report', wraps=memory_report) as report:
+            app.test_client().get('/bitmapist/memory?json=true&top=100000')
+        report.assert_called_once_with(top=1000)
+
+        result = CliRunner().invoke(app.cli, ['bitmapist', 'memory', '--top', '1000'],
+                                    obj=ScriptInfo(create_app=lambda info: app))
+        assert result.exit_code == 0
+        assert 'memory:sparse' in result.output
+        assert 'Sparse keys' in result.output
+    finally:
+        make_app()
+
+
+def test_metrics():
+    from flask_bitmapist import metrics
+
+    def calls(operation):
+        return metrics.CALL_SECONDS.get(operation)[0]
+
+    app = make_app(BITMAPIST_METRICS=True, BITMAPIST_DISABLE_BLUEPRINT=False)
+    try:
+        assert isinstance(SYSTEMS['default'], metrics.CountingRedis)
+        marks = metrics.MARKS.get('metrics:event')
+        mark_calls = calls('mark')
+        commands = metrics.CALL_COMMANDS.get('mark')[1]
+        round_trips = metrics.CALL_ROUND_TRIPS.get('mark')[1]
+        redis_commands = metrics.REDIS_COMMANDS.get()
+
+        # a month, week and day BITFIELD, in one pipeline
+        mark_events([('metrics:event', 1, now), ('metrics:event', 2, now)])
+        assert metrics.MARKS.get('metrics:event') == marks + 2
+        assert calls('mark') == mark_calls + 1
+        assert metrics.CALL_COMMANDS.get('mark')[1] == commands + 3
+        assert metrics.CALL_ROUND_TRIPS.get('mark')[1] == round_trips + 1
+        assert metrics.REDIS_COMMANDS.get() == redis_commands + 3
+
+        cohort_calls = calls('get_cohort')
+        temp_keys = metrics.TEMP_KEYS.get()
+        get_cohort('metrics:event', 'metrics:event', time_group='weeks', num_rows=2, num_cols=2)
+        assert calls('get_cohort') == cohort_calls + 1
+        assert metrics.TEMP_KEYS.get() > temp_keys
+        assert metrics.CALL_ROUND_TRIPS.get('get_cohort')[1] > 0
+
+        login_calls = calls('flask_login_mark')
+        with app.test_request_context():
+            user = User()
+            user.id = 3
+            mark_login(app, user)
+        assert calls('flask_login_mark') == login_calls + 1
+        assert metrics.MARKS.get('user:logged_in') > 0
+
+        # the extension's marks are timed by event, buffered or not
+        timed = metrics.MARK_SECONDS.get('metrics:event')[0]
+        app.extensions['bitmapist'].mark('metrics:event', 3)
+        assert metrics.MARK_SECONDS.get('metrics:event')[0] == timed + 1
+
+        # marks around the extension are counted too
+        mark_event('metrics:event', 4, use_pipeline=False)
+        assert metrics.MARKS.get('metrics:event') == marks + 4
+
+        response = app.test_client().get('/bitmapist/metrics')
+        assert response.content_type == metrics.CONTENT_TYPE
+        text = response.get_data(as_text=True)
+        assert '# TYPE bitmapist_call_duration_seconds histogram' in text
+        assert 'bitmapist_marks_total{event="metrics:event"} %s' % (marks + 4) in text
+        assert 'bitmapist_mark_duration_seconds_count{event="metrics:event"}' in text
+        assert 'bitmapist_call_redis_commands_bucket{operation="mark",le="+Inf"}' in text
+    finally:
+        make_app()
+
+    assert not metrics.ENABLED
+    assert not isinstance(SYSTEMS['default'], metrics.CountingRedis)
+    mark_calls = calls('mark')
+    mark_events([('metrics:event', 1, now)])
+    assert calls('mark') == mark_calls
+    app = make_app(BITMAPIST_DISABLE_BLUEPRINT=False)
+    assert app.test_client().get('/bitmapist/metrics').status_code == 404
+    make_app()